@@ -0,0 +1,525 @@
+"""
+python3 benchmark.py checkpointing -batch_size=80 -steps=5
+python3 benchmark.py similarity -batch_size=16 -num_prototypes=400
+python3 benchmark.py eval -batch_size=100 -batches=20
+python3 benchmark.py bottleneck -widths 64 128 256 -checkpoints full.ppnet bottleneck128.ppnet
+python3 benchmark.py sampling -target_accu=0.95 [-set num_train_epochs=60]
+python3 benchmark.py startup -model=./saved_models/densenet121/2/80push.ppnet -repeats=3 [-set data_path=...]
+"""
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import subprocess
+import itertools
+import statistics
+import multiprocessing
+
+
+def build_ppnet(base_architecture='densenet121', num_classes=4, num_prototypes=400,
+                prototype_channels=1024, img_size=224, prototype_bottleneck=None):
+    from prototype_bottleneck import construct_PPNet
+    return construct_PPNet(base_architecture=base_architecture,
+                           pretrained=False, img_size=img_size,
+                           prototype_shape=(num_prototypes, prototype_channels, 2, 2),
+                           num_classes=num_classes, topk_k=1, m=0.1,
+                           add_on_layers_type='upsample',
+                           using_deform=True,
+                           incorrect_class_connection=-0.5,
+                           deformable_conv_hidden_channels=128,
+                           prototype_dilation=2,
+                           prototype_bottleneck=prototype_bottleneck)
+
+
+def time_train_steps(ppnet, batch_size, steps, img_size=224, warmup=1):
+    '''
+    Runs `steps` joint-phase SGD steps on random images and returns
+    (seconds per step, peak CUDA memory in MiB).
+    '''
+    import torch
+    import train_and_test_modified as tnt
+    ppnet_multi = torch.nn.DataParallel(ppnet.cuda())
+    tnt.joint(model=ppnet_multi, log=lambda *_: None, last_layer_fixed=True)
+    ppnet_multi.train()
+    optimizer = torch.optim.Adam([p for p in ppnet.parameters() if p.requires_grad], lr=1e-5)
+    num_classes = ppnet.num_classes
+
+    def step():
+        image = torch.randn(batch_size, 3, img_size, img_size).cuda()
+        label = torch.randint(0, num_classes, (batch_size,))
+        prototypes_of_wrong_class = 1 - torch.t(ppnet.prototype_class_identity[:, label]).cuda()
+        output, _ = ppnet_multi(image, is_train=True, prototypes_of_wrong_class=prototypes_of_wrong_class)
+        loss = torch.nn.functional.cross_entropy(output, label.cuda())
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    for _ in range(warmup):
+        step()
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+    for _ in range(steps):
+        step()
+    torch.cuda.synchronize()
+    return (time.time() - start) / steps, torch.cuda.max_memory_allocated() / 2**20
+
+
+def bench_checkpointing(args):
+    import torch
+    from checkpointing import enable_activation_checkpointing
+
+    results = {}
+    for enabled in (False, True):
+        ppnet = build_ppnet(base_architecture=args.arch)
+        if enabled:
+            enable_activation_checkpointing(ppnet, segments=args.segments)
+        results[enabled] = time_train_steps(ppnet, args.batch_size, args.steps)
+        print('checkpointing={0}: {1:.3f} s/step, peak memory {2:.0f} MiB'.format(enabled, *results[enabled]))
+        del ppnet
+        torch.cuda.empty_cache()
+
+    print('compute overhead: {0:.2f}x, memory saved: {1:.1f}%'.format(
+        results[True][0] / results[False][0], 100 * (1 - results[True][1] / results[False][1])))
+
+
+def _reference_similarity(x, offset, prototypes, epsilon_val, n_eps_channels, dilation):
+    '''
+    The explicit concat / sqrt / square / divide normalization followed by a
+    deformable convolution, as done before the fused operator; the timing baseline
+    (parity with the model's own cos_activation is checked by check_similarity_parity).
+    '''
+    import torch
+    from torchvision.ops import deform_conv2d
+    from prototype_similarity import normalize_prototypes, same_padding
+
+    normalizing_factor = (prototypes.shape[-2] * prototypes.shape[-1])**0.5
+    epsilon_channel_x = torch.ones(x.shape[0], n_eps_channels, x.shape[2], x.shape[3]) * epsilon_val
+    x = torch.cat((x, epsilon_channel_x), -3)
+    input_length = torch.sqrt(torch.sum(torch.square(x), dim=-3))
+    input_length = input_length.view(input_length.size()[0], 1, input_length.size()[1], input_length.size()[2])
+    x_normalized = x / input_length / normalizing_factor
+    normalized_prototypes = normalize_prototypes(prototypes, epsilon_val, normalizing_factor)
+    return deform_conv2d(x_normalized, offset, normalized_prototypes,
+                         padding=same_padding(prototypes.shape[-2:], dilation), dilation=dilation)
+
+
+def _fused_similarity(x, offset, prototypes, epsilon_val, n_eps_channels, dilation, prototype_chunk_size=None):
+    from prototype_similarity import normalize_input, normalize_prototypes, deformable_prototype_similarity
+
+    normalizing_factor = (prototypes.shape[-2] * prototypes.shape[-1])**0.5
+    x_normalized = normalize_input(x, epsilon_val, n_eps_channels, 1., normalizing_factor)
+    normalized_prototypes = normalize_prototypes(prototypes, epsilon_val, normalizing_factor)
+    return deformable_prototype_similarity(x_normalized, offset, normalized_prototypes, dilation=dilation,
+                                           prototype_chunk_size=prototype_chunk_size)
+
+
+def _similarity_inputs(args):
+    import torch
+    torch.manual_seed(0)
+    x = torch.relu(torch.randn(args.batch_size, args.channels, args.fmap_size, args.fmap_size))
+    offset = torch.randn(args.batch_size, 2 * 2 * 2, args.fmap_size, args.fmap_size)
+    prototypes = torch.rand(args.num_prototypes, args.channels + args.n_eps_channels, 2, 2)
+    return [t.requires_grad_() for t in (x, offset, prototypes)]
+
+
+def _similarity_worker(args, fused, queue):
+    inputs = _similarity_inputs(args)
+    similarity_args = (args.epsilon_val, args.n_eps_channels, args.dilation)
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    for _ in range(args.steps):
+        if fused:
+            out = _fused_similarity(*inputs, *similarity_args, prototype_chunk_size=args.chunk_size)
+        else:
+            out = _reference_similarity(*inputs, *similarity_args)
+        out.max(dim=-1)[0].max(dim=-1)[0].sum().backward()
+    elapsed = (time.time() - start) / args.steps
+    # ru_maxrss is reported in KiB on Linux
+    queue.put((elapsed, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_rss) / 1024))
+
+
+def _cos_activation_and_grads(ppnet, cos_activation, x, prototypes_of_wrong_class):
+    '''
+    (activations, marginless activations, gradients w.r.t. x, the prototypes and the
+    offset network's weights) of one cos_activation implementation
+    '''
+    import torch
+    x = x.detach().clone().requires_grad_()
+    activations, marginless = cos_activation(x, prototypes_of_wrong_class=prototypes_of_wrong_class)
+    parameters = [ppnet.prototype_vectors] + list(ppnet.conv_offset.parameters())
+    loss = activations.pow(2).sum() + marginless.pow(2).sum()
+    grads = torch.autograd.grad(loss, [x] + parameters)
+    return [activations.detach(), marginless.detach()] + list(grads)
+
+
+def check_similarity_parity(args, rtol=1e-3, atol=1e-4, grad_tolerance=1e-3):
+    '''
+    Asserts that FusedPPNet.cos_activation matches PPNet.cos_activation on the same
+    model (outputs and gradients w.r.t. the conv features, the prototypes and the
+    offset weights), in training and eval mode (where the margin is off), with and
+    without the class margin and with and without prototype chunking. Gradients may
+    differ by grad_tolerance times the largest reference gradient entry.
+    '''
+    import torch
+    from DeformableProtoPNet.model import PPNet
+    from prototype_similarity import fused_cos_activation
+
+    torch.manual_seed(0)
+    # the upstream cos_activation allocates its epsilon channels with .cuda()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    ppnet = build_ppnet(base_architecture=args.arch, num_prototypes=args.num_prototypes,
+                        prototype_channels=args.channels).to(device)
+    ppnet.eval()
+    with torch.no_grad():
+        x = ppnet.conv_features(torch.randn(args.parity_batch_size, 3, ppnet.img_size, ppnet.img_size,
+                                            device=device))
+    labels = torch.randint(0, ppnet.num_classes, (x.size(0),), device=device)
+    prototype_classes = torch.argmax(ppnet.prototype_class_identity, dim=1).to(device)
+    wrong_class = (prototype_classes.unsqueeze(0) != labels.unsqueeze(1)).float()
+
+    names = ['activations', 'marginless activations', 'grad x', 'grad prototypes'] + \
+            ['grad conv_offset.' + name for name, _ in ppnet.conv_offset.named_parameters()]
+    for training, prototypes_of_wrong_class in itertools.product((True, False), (None, wrong_class)):
+        ppnet.train(training)
+        reference = _cos_activation_and_grads(ppnet, lambda x, **kwargs: PPNet.cos_activation(ppnet, x, **kwargs),
+                                              x, prototypes_of_wrong_class)
+        for chunk_size in (None, args.chunk_size or max(1, args.num_prototypes // 3)):
+            fused = _cos_activation_and_grads(
+                ppnet, lambda x, **kwargs: fused_cos_activation(ppnet, x, prototype_chunk_size=chunk_size, **kwargs),
+                x, prototypes_of_wrong_class)
+            for name, expected, actual in zip(names, reference, fused):
+                tolerance = atol if not name.startswith('grad') \
+                    else grad_tolerance * expected.abs().max().item()
+                difference = (expected - actual).abs().max().item()
+                print('parity (training={0}, margin={1}, chunk={2}): max |diff| of {3} {4:.2e}'.format(
+                    training, prototypes_of_wrong_class is not None, chunk_size, name, difference))
+                torch.testing.assert_close(actual, expected, rtol=rtol, atol=tolerance,
+                                           msg='fused {0} differs from PPNet.cos_activation'.format(name))
+    print('parity: fused cos_activation matches PPNet.cos_activation')
+
+
+def bench_similarity(args):
+    check_similarity_parity(args)
+
+    # each variant runs in a fresh process so that peak RSS is not shared
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    for is_fused in (False, True):
+        queue = ctx.Queue()
+        worker = ctx.Process(target=_similarity_worker, args=(args, is_fused, queue))
+        worker.start()
+        results[is_fused] = queue.get()
+        worker.join()
+        print('{0}: {1:.3f} s/step (forward + backward), peak RSS growth {2:.0f} MiB'.format(
+            'fused' if is_fused else 'reference', *results[is_fused]))
+    print('speedup: {0:.2f}x'.format(results[False][0] / results[True][0]))
+
+
+def bench_eval(args):
+    import torch
+    import train_and_test_modified as tnt
+    ppnet = build_ppnet(base_architecture=args.arch)
+    ppnet_multi = torch.nn.DataParallel(ppnet.cuda())
+    images = torch.randn(args.batch_size * args.batches, 3, 224, 224)
+    labels = torch.randint(0, ppnet.num_classes, (images.size(0),))
+    dataloader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(images, labels),
+                                             batch_size=args.batch_size, shuffle=False)
+    quiet = lambda *_: None
+
+    results = {}
+    for lean in (False, True, False, True):
+        torch.cuda.synchronize()
+        start = time.time()
+        tnt.test(model=ppnet_multi, dataloader=dataloader, class_specific=True, log=quiet,
+                 lean=lean, diagnostics_every=args.diagnostics_every)
+        torch.cuda.synchronize()
+        # the first run of each mode is warm-up
+        results[lean] = time.time() - start
+    for lean in (False, True):
+        print('{0}: {1:.1f} images/s'.format('lean' if lean else '_train_or_test',
+                                             images.size(0) / results[lean]))
+    print('eval speedup: {0:.2f}x'.format(results[False] / results[True]))
+
+
+def _time_similarity_layer(ppnet, batch_size, steps, warmup=1):
+    '''
+    Seconds per forward + backward of the prototype similarity layer (cos_activation)
+    on the conv features of random images.
+    '''
+    import torch
+    with torch.no_grad():
+        conv_features = ppnet.conv_features(torch.randn(batch_size, 3, ppnet.img_size, ppnet.img_size).cuda())
+    conv_features.requires_grad_()
+    label = torch.randint(0, ppnet.num_classes, (batch_size,))
+    prototypes_of_wrong_class = 1 - torch.t(ppnet.prototype_class_identity[:, label]).cuda()
+
+    def step():
+        activations, _ = ppnet.cos_activation(conv_features, prototypes_of_wrong_class=prototypes_of_wrong_class)
+        activations.flatten(start_dim=2).max(dim=-1)[0].sum().backward()
+
+    for _ in range(warmup):
+        step()
+    torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(steps):
+        step()
+    torch.cuda.synchronize()
+    return (time.time() - start) / steps
+
+
+def _checkpoint_accuracy(path, batch_size):
+    import torch
+    import train_and_test_modified as tnt
+    import torchvision.transforms as transforms
+    import torchvision.datasets as datasets
+    from DeformableProtoPNet.preprocess import mean, std
+    from compact_checkpoint import load_model
+    from config import val_dir
+
+    ppnet = load_model(path)[0]
+    dataset = datasets.ImageFolder(val_dir, transforms.Compose([
+        transforms.Resize(size=(ppnet.img_size, ppnet.img_size)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=mean, std=std),
+    ]))
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=4)
+    accu = tnt.test(model=torch.nn.DataParallel(ppnet.cuda()), dataloader=dataloader, class_specific=True,
+                    log=lambda *_: None, lean=True)
+    return ppnet.prototype_shape[1], accu
+
+
+def bench_bottleneck(args):
+    import torch
+    results = {}
+    for width in [None] + args.widths:
+        ppnet = build_ppnet(base_architecture=args.arch, num_prototypes=args.num_prototypes,
+                            prototype_channels=args.prototype_channels, prototype_bottleneck=width).cuda()
+        seconds = _time_similarity_layer(ppnet, args.batch_size, args.steps)
+        results[width] = seconds
+        print('{0} prototype channels: similarity layer {1:.4f} s/step ({2:.2f}x), prototypes {3:.1f} MiB'.format(
+            ppnet.prototype_shape[1], seconds, results[None] / seconds,
+            ppnet.prototype_vectors.numel() * ppnet.prototype_vectors.element_size() / 2**20))
+        del ppnet
+        torch.cuda.empty_cache()
+
+    # the accuracy effect needs trained models, e.g. from main.py with different prototype_bottleneck
+    for path in args.checkpoints:
+        channels, accu = _checkpoint_accuracy(path, args.eval_batch_size)
+        print('{0}: {1} prototype channels, test accuracy {2:.4f}'.format(path, channels, accu))
+
+
+def bench_sampling(args):
+    '''
+    Wall-clock time (from the start of main.run, setup included) until the test accuracy
+    first reaches args.target_accu, training once with the usual sampling and once with
+    loss-aware importance sampling (config.importance_sampling); a run that reaches it
+    stops there.
+    '''
+    import main
+    from config import settings
+    settings.apply_args(args)
+
+    results = {}
+    for name, importance_sampling in (('uniform', False), ('importance', True)):
+        settings.override(importance_sampling=importance_sampling)
+        start = time.time()
+        reached = []
+
+        def report_epoch(epoch, accu):
+            if accu >= args.target_accu:
+                reached.append((epoch, time.time() - start))
+                return False
+            return True
+
+        best_accu = main.run(gpuid=args.gpuid, hparams={'rand_seed': args.seed},
+                             experiment_run='sampling-{0}-{1}'.format(name, args.target_accu),
+                             report_epoch=report_epoch)
+        results[name] = reached[0] if reached else None
+        if reached:
+            print('{0}: accuracy {1} reached after epoch {2}, {3:.0f}s'.format(
+                name, args.target_accu, reached[0][0], reached[0][1]))
+        else:
+            print('{0}: accuracy {1} not reached (best {2:.4f}, {3:.0f}s)'.format(
+                name, args.target_accu, best_accu, time.time() - start))
+    if results['uniform'] is not None and results['importance'] is not None:
+        print('importance sampling reaches the target {0:.2f}x as fast as uniform sampling'.format(
+            results['uniform'][1] / results['importance'][1]))
+
+
+STARTUP_MILESTONES = ['imports', 'settings', 'first_batch', 'model_loaded', 'first_prediction']
+
+
+def _startup_probe(args):
+    '''
+    Runs in a fresh interpreter started by bench_startup: goes through the start of a
+    training run (settings, training loader, first batch) and of an analysis run (model
+    load, first prediction) and prints the wall-clock time of each milestone as JSON.
+    '''
+    times = {}
+    # what a training run imports before it reads data; the model code loads with the model
+    import main
+    import torch
+    import torchvision.transforms as transforms
+    import torchvision.datasets as datasets
+    from DeformableProtoPNet.preprocess import mean, std
+    from data import class_balanced_sampler, make_loader
+    times['imports'] = time.time()
+
+    from config import settings
+    settings.apply_args(args)
+    from config import img_size, train_dir, train_batch_size, balanced_sampling, balanced_epoch_size, \
+                       autotune_dataloaders, sharded_dataset_dir, base_architecture, num_classes, num_prototypes
+    times['settings'] = time.time()
+
+    transform = transforms.Compose([
+        transforms.RandomAffine(degrees=(-25, 25), shear=15),
+        transforms.RandomHorizontalFlip(),
+        transforms.Resize(size=(img_size, img_size)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=mean, std=std),
+    ])
+    sampler = None
+    if sharded_dataset_dir is not None:
+        from shards import ShardedImageDataset
+        dataset = ShardedImageDataset(os.path.join(sharded_dataset_dir, 'train'), transform, shuffle=True,
+                                      batch_size=train_batch_size, balanced=balanced_sampling,
+                                      epoch_size=balanced_epoch_size)
+    else:
+        dataset = datasets.ImageFolder(train_dir, transform)
+        if balanced_sampling:
+            sampler = class_balanced_sampler(dataset, num_samples=balanced_epoch_size)
+    loader = make_loader(dataset, batch_size=train_batch_size, shuffle=True, sampler=sampler,
+                         autotune=autotune_dataloaders, log=lambda *_: None)
+    image, _ = next(iter(loader))
+    times['first_batch'] = time.time()
+
+    if args.model is None:
+        prototype_shape, _ = main.prototype_layout(base_architecture, num_prototypes)
+        ppnet = build_ppnet(base_architecture, num_classes, num_prototypes, prototype_shape[1], img_size)
+    else:
+        from compact_checkpoint import load_model
+        ppnet = load_model(args.model)[0]
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    ppnet = ppnet.to(device).eval()
+    times['model_loaded'] = time.time()
+
+    with torch.inference_mode():
+        output, _ = ppnet(image.to(device), is_train=False, prototypes_of_wrong_class=None)
+        output.argmax(dim=1).cpu()
+    times['first_prediction'] = time.time()
+    print(json.dumps(times))
+
+
+def bench_startup(args):
+    '''
+    Time from process start to each milestone of _startup_probe, as the median over
+    args.repeats fresh interpreters.
+    '''
+    probe = [sys.executable, os.path.abspath(__file__), 'startup_probe']
+    if args.model is not None:
+        probe.append('-model=' + args.model)
+    if args.config is not None:
+        probe.append('-config=' + args.config)
+    probe += ['-set=' + assignment for assignment in args.set]
+
+    runs = []
+    for _ in range(args.repeats):
+        start = time.time()
+        output = subprocess.run(probe, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        times = json.loads(output.strip().splitlines()[-1])
+        runs.append({milestone: times[milestone] - start for milestone in STARTUP_MILESTONES})
+    for milestone in STARTUP_MILESTONES:
+        seconds = [run[milestone] for run in runs]
+        print('{0:>16}: {1:7.2f}s (min {2:.2f}s, max {3:.2f}s)'.format(
+            milestone, statistics.median(seconds), min(seconds), max(seconds)))
+
+    if args.import_profile:
+        # cumulative import cost of the top-level packages a training run pulls in
+        imports = 'import main, torch, torchvision, data, prototype_bottleneck, train_and_test_modified'
+        stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', imports], check=True,
+                                stderr=subprocess.PIPE, universal_newlines=True).stderr
+        cumulative = {}
+        for line in stderr.splitlines():
+            fields = line[len('import time:'):].split('|')
+            if not line.startswith('import time:') or not fields[1].strip().isdigit():
+                continue
+            # nested imports are indented below the package that imported them
+            name = fields[2][1:]
+            if not name.startswith(' '):
+                cumulative[name] = int(fields[1])
+        print('slowest imports of a training run:')
+        for name, microseconds in sorted(cumulative.items(), key=lambda item: -item[1])[:args.import_profile]:
+            print('{0:>16}: {1:7.2f}s'.format(name, microseconds / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    checkpointing_parser = subparsers.add_parser('checkpointing')
+    checkpointing_parser.add_argument('-arch', type=str, default='densenet121')
+    checkpointing_parser.add_argument('-batch_size', type=int, default=80)
+    checkpointing_parser.add_argument('-steps', type=int, default=5)
+    checkpointing_parser.add_argument('-segments', type=int, default=4)
+    checkpointing_parser.set_defaults(func=bench_checkpointing)
+
+    similarity_parser = subparsers.add_parser('similarity')
+    similarity_parser.add_argument('-batch_size', type=int, default=16)
+    similarity_parser.add_argument('-channels', type=int, default=1024)
+    similarity_parser.add_argument('-fmap_size', type=int, default=7)
+    similarity_parser.add_argument('-num_prototypes', type=int, default=400)
+    similarity_parser.add_argument('-n_eps_channels', type=int, default=2)
+    similarity_parser.add_argument('-epsilon_val', type=float, default=1e-5)
+    similarity_parser.add_argument('-dilation', type=int, default=2)
+    similarity_parser.add_argument('-chunk_size', type=int, default=None)
+    similarity_parser.add_argument('-steps', type=int, default=5)
+    similarity_parser.add_argument('-arch', type=str, default='densenet121')
+    similarity_parser.add_argument('-parity_batch_size', type=int, default=4)
+    similarity_parser.set_defaults(func=bench_similarity)
+
+    eval_parser = subparsers.add_parser('eval')
+    eval_parser.add_argument('-arch', type=str, default='densenet121')
+    eval_parser.add_argument('-batch_size', type=int, default=100)
+    eval_parser.add_argument('-batches', type=int, default=20)
+    eval_parser.add_argument('-diagnostics_every', type=int, default=10)
+    eval_parser.set_defaults(func=bench_eval)
+
+    bottleneck_parser = subparsers.add_parser('bottleneck')
+    bottleneck_parser.add_argument('-arch', type=str, default='densenet121')
+    bottleneck_parser.add_argument('-prototype_channels', type=int, default=1024)
+    bottleneck_parser.add_argument('-num_prototypes', type=int, default=400)
+    bottleneck_parser.add_argument('-widths', type=int, nargs='+', default=[64, 128, 256])
+    bottleneck_parser.add_argument('-batch_size', type=int, default=80)
+    bottleneck_parser.add_argument('-steps', type=int, default=10)
+    bottleneck_parser.add_argument('-checkpoints', type=str, nargs='*', default=[])
+    bottleneck_parser.add_argument('-eval_batch_size', type=int, default=100)
+    bottleneck_parser.set_defaults(func=bench_bottleneck)
+
+    from config import settings
+    sampling_parser = subparsers.add_parser('sampling')
+    sampling_parser.add_argument('-gpuid', type=str, default='0')
+    sampling_parser.add_argument('-target_accu', type=float, default=0.95)
+    sampling_parser.add_argument('-seed', type=int, default=1)
+    settings.add_arguments(sampling_parser)
+    sampling_parser.set_defaults(func=bench_sampling)
+
+    startup_parser = subparsers.add_parser('startup')
+    startup_parser.add_argument('-model', type=str, default=None)
+    startup_parser.add_argument('-repeats', type=int, default=3)
+    startup_parser.add_argument('-import_profile', type=int, default=10)
+    settings.add_arguments(startup_parser)
+    startup_parser.set_defaults(func=bench_startup)
+
+    probe_parser = subparsers.add_parser('startup_probe')
+    probe_parser.add_argument('-model', type=str, default=None)
+    settings.add_arguments(probe_parser)
+    probe_parser.set_defaults(func=_startup_probe)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
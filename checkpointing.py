@@ -0,0 +1,66 @@
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint, checkpoint_sequential
+
+from DeformableProtoPNet.model import PPNet
+from prototype_similarity import FusedPPNet
+
+
+class CheckpointedSequential(nn.Module):
+    '''
+    Wraps an nn.Sequential backbone stage so that, while training with gradients
+    enabled, only the activations at the boundaries of `segments` chunks are kept
+    and everything in between is recomputed during the backward pass.
+    '''
+    def __init__(self, sequential, segments=4):
+        super(CheckpointedSequential, self).__init__()
+        self.sequential = sequential
+        self.segments = min(segments, len(sequential))
+
+    def forward(self, x):
+        if self.training and torch.is_grad_enabled():
+            return checkpoint_sequential(self.sequential, self.segments, x, use_reentrant=False)
+        return self.sequential(x)
+
+
+class CheckpointedPPNet(PPNet):
+    '''
+    PPNet whose deformable prototype-similarity computation (normalization, offset
+    prediction and deformable cosine similarity) is recomputed in the backward pass
+    instead of keeping its (B, C * k * k, H * W) sampling buffers alive.
+    Defined at module level so checkpoints saved with torch.save stay loadable.
+    '''
+    def cos_activation(self, *args, **kwargs):
+        if self.training and torch.is_grad_enabled():
+            return checkpoint(super(CheckpointedPPNet, self).cos_activation, *args,
+                              use_reentrant=False, **kwargs)
+        return super(CheckpointedPPNet, self).cos_activation(*args, **kwargs)
+
+
+class CheckpointedFusedPPNet(CheckpointedPPNet, FusedPPNet):
+    pass
+
+
+def enable_activation_checkpointing(ppnet, segments=4, checkpoint_backbone=True,
+                                    checkpoint_prototype_layer=True, log=print):
+    '''
+    ppnet: the (unwrapped) PPNet; call before wrapping it in DataParallel
+    segments: number of checkpointed chunks per backbone stage
+    Note that BatchNorm running statistics are updated again when a checkpointed
+    segment is recomputed, so they move slightly faster than without checkpointing.
+    '''
+    if checkpoint_backbone:
+        # densenet features keep every block in one nn.Sequential (`features`),
+        # resnet features keep one nn.Sequential per stage (`layer1` ... `layer4`)
+        wrapped = []
+        for name, child in list(ppnet.features.named_children()):
+            if isinstance(child, nn.Sequential):
+                setattr(ppnet.features, name, CheckpointedSequential(child, segments=segments))
+                wrapped.append(name)
+        log('activation checkpointing on backbone stages: {0} ({1} segments each)'.format(wrapped, segments))
+
+    if checkpoint_prototype_layer:
+        ppnet.__class__ = CheckpointedFusedPPNet if isinstance(ppnet, FusedPPNet) else CheckpointedPPNet
+        log('activation checkpointing on the deformable prototype layer')
+
+    return ppnet
@@ -0,0 +1,202 @@
+import os
+import re
+import json
+import struct
+import argparse
+
+import numpy as np
+import torch
+
+"""
+Compact PPNet checkpoint: a state_dict-based file that can be memory-mapped.
+
+    8 bytes   magic b'PPNETCK1'
+    8 bytes   little-endian uint64, length of the JSON header
+    JSON header, padded to a multiple of ALIGNMENT bytes
+    raw tensor data, every tensor starting at a multiple of ALIGNMENT bytes
+
+The header holds the construct_PPNet keyword arguments, the push epoch and, per
+tensor, its dtype, shape and byte offset (relative to the start of the data).
+
+python3 compact_checkpoint.py -model=./saved_models/densenet121/2/80push0.9660.pth -fp16
+"""
+
+MAGIC = b'PPNETCK1'
+ALIGNMENT = 64
+
+# construct_PPNet arguments that cannot be read back from a pickled model,
+# defaulted to the values main.py trains with
+DEFAULT_CONSTRUCT_KWARGS = {
+    'base_architecture': 'densenet121',
+    'add_on_layers_type': 'upsample',
+    'using_deform': True,
+    'incorrect_class_connection': -0.5,
+    'deformable_conv_hidden_channels': 128,
+}
+
+# tensors the model needs that are plain attributes rather than registered buffers
+EXTRA_TENSOR_ATTRIBUTES = ['prototype_class_identity']
+
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def construct_kwargs_from_model(ppnet, **overrides):
+    '''
+    Best-effort construct_PPNet keyword arguments for an already built model.
+    '''
+    if hasattr(ppnet, 'prototype_dilation'):
+        dilation = ppnet.prototype_dilation
+    else:
+        dilation = ppnet.prototype_dillation
+    if isinstance(dilation, (tuple, list)):
+        dilation = dilation[0]
+    kwargs = dict(DEFAULT_CONSTRUCT_KWARGS)
+    kwargs.update({
+        'img_size': ppnet.img_size,
+        'prototype_shape': list(ppnet.prototype_shape),
+        'num_classes': ppnet.num_classes,
+        'topk_k': ppnet.topk_k,
+        'm': ppnet.m,
+        'prototype_dilation': dilation,
+        'prototype_bottleneck': getattr(ppnet, 'prototype_bottleneck', None),
+    })
+    kwargs.update(overrides)
+    return kwargs
+
+
+def _plain_state_dict(ppnet):
+    # checkpointing.CheckpointedSequential adds a `sequential.` level to backbone names
+    return {name.replace('.sequential.', '.'): tensor for name, tensor in ppnet.state_dict().items()}
+
+
+def export_compact(ppnet, path, construct_kwargs, push_epoch=None, fp16=False):
+    '''
+    ppnet: the (unwrapped) PPNet
+    construct_kwargs: the keyword arguments it was built with by construct_PPNet
+        (pretrained is ignored)
+    fp16: store floating point tensors in half precision
+    '''
+    tensors = _plain_state_dict(ppnet)
+    extra = [name for name in EXTRA_TENSOR_ATTRIBUTES
+             if name not in tensors and isinstance(getattr(ppnet, name, None), torch.Tensor)]
+    for name in extra:
+        tensors[name] = getattr(ppnet, name)
+
+    entries, arrays, offset = {}, [], 0
+    for name, tensor in tensors.items():
+        tensor = tensor.detach().cpu().contiguous()
+        if fp16 and tensor.is_floating_point():
+            tensor = tensor.half()
+        array = tensor.numpy()
+        entries[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        arrays.append((offset, array))
+        offset = _aligned(offset + array.nbytes)
+
+    construct_kwargs = {k: v for k, v in construct_kwargs.items() if k != 'pretrained'}
+    header = json.dumps({'construct_kwargs': construct_kwargs, 'push_epoch': push_epoch, 'fp16': fp16,
+                         'tensors': entries, 'extra_tensors': extra}).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for array_offset, array in arrays:
+            f.seek(data_start + array_offset)
+            f.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{0} is not a compact PPNet checkpoint'.format(path))
+        header_length, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    header['data_start'] = _aligned(len(MAGIC) + 8 + header_length)
+    return header
+
+
+def load_tensors(path, header=None):
+    '''
+    Memory-maps the checkpoint and returns {name: tensor} views into it; pages are
+    only read when a tensor is first touched. The mapping is copy-on-write, so the
+    file itself is never modified.
+    '''
+    header = header or read_header(path)
+    mapped = np.memmap(path, dtype=np.uint8, mode='c')
+    tensors = {}
+    for name, entry in header['tensors'].items():
+        dtype = np.dtype(entry['dtype'])
+        start = header['data_start'] + entry['offset']
+        n_bytes = int(np.prod(entry['shape'], dtype=np.int64)) * dtype.itemsize
+        array = mapped[start:start + n_bytes].view(dtype).reshape(entry['shape'])
+        tensors[name] = torch.from_numpy(array)
+    return tensors
+
+
+def load_compact(path, dtype=torch.float32):
+    '''
+    Builds the model with prototype_bottleneck.construct_PPNet (no pretrained download) and points its
+    parameters at the memory-mapped tensors. Returns (ppnet, header).
+    dtype: floating point tensors stored in another precision are cast to this
+        (pass torch.float16 to keep an fp16 checkpoint memory-mapped)
+    '''
+    from prototype_bottleneck import construct_PPNet
+
+    header = read_header(path)
+    kwargs = dict(header['construct_kwargs'])
+    kwargs['prototype_shape'] = tuple(kwargs['prototype_shape'])
+    ppnet = construct_PPNet(pretrained=False, **kwargs)
+
+    tensors = load_tensors(path, header)
+    for name, tensor in tensors.items():
+        if tensor.is_floating_point() and tensor.dtype != dtype:
+            tensors[name] = tensor.to(dtype)
+    for name in header['extra_tensors']:
+        setattr(ppnet, name, tensors.pop(name))
+    try:
+        ppnet.load_state_dict(tensors, assign=True)
+    except TypeError:
+        # torch < 2.1 has no assign, copy into the freshly built parameters instead
+        ppnet.load_state_dict(tensors)
+    return ppnet, header
+
+
+def load_model(path, map_location='cpu'):
+    '''
+    (ppnet, header) of a compact .ppnet checkpoint or a pickled .pth one (whose header is empty).
+    '''
+    if path.endswith('.ppnet'):
+        return load_compact(path)
+    return torch.load(path, map_location=map_location), {}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-model', type=str, required=True)
+    parser.add_argument('-out', type=str, default=None)
+    parser.add_argument('-fp16', action='store_true')
+    parser.add_argument('-push_epoch', type=int, default=None)
+    parser.add_argument('-base_architecture', type=str, default=None)
+    args = parser.parse_args()
+
+    ppnet = torch.load(args.model, map_location='cpu')
+    overrides = {}
+    if args.base_architecture is not None:
+        overrides['base_architecture'] = args.base_architecture
+    else:
+        # saved_models/<architecture>/<run>/<name>.pth
+        architecture = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(args.model))))
+        if re.match('^(vgg|resnet|densenet)[0-9]+', architecture):
+            overrides['base_architecture'] = architecture
+    out = args.out or os.path.splitext(args.model)[0] + '.ppnet'
+    export_compact(ppnet, out, construct_kwargs_from_model(ppnet, **overrides),
+                   push_epoch=args.push_epoch, fp16=args.fp16)
+    print('wrote {0} ({1:.1f} MiB)'.format(out, os.path.getsize(out) / 2**20))
+
+if __name__ == "__main__":
+    main()
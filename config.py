@@ -1,48 +1,134 @@
+"""
+Defaults of all settings. Importing this module has no side effects: the names below
+are served by config.settings, which applies the overrides from a settings file, the
+environment and the command line (see settings.py), so `from config import x` returns
+the effective value.
+"""
+
+from settings import Settings, derived
+
 base_architecture = 'densenet121'
 img_size = 224
 
 experiment_run = None
 
-import socket
-hostname = socket.gethostname()
-if hostname.endswith('local'):  # Example check for local machine names
-    print("Running on Macbook locally")
-    data_path = '/Users/youssefshaarawy/Documents/Datasets/OCT2017/'
-    # data_path = '/Users/youssefshaarawy/Documents/Datasets/JustRAIGS'
-    # data_path = '/Users/youssefshaarawy/Downloads/CUB_200_2011/CUB_200_2011/'
-else:
-    print(f"Running on remote server: {hostname}")
-    data_path = "/users/adfx751/Datasets/OCT2017/"
-    # data_path = '/users/adfx751/Datasets/JustRAIGS'
-    # data_path = '/users/adfx751/Datasets/CUB_200_2011/'
+# Dataset root. By default it follows the host the code runs on (the MacBook copy on
+# *.local machines, the server copy elsewhere); set it explicitly with
+# -set data_path=... , PPNET_DATA_PATH or a settings file (see settings.py).
+@derived
+def data_path(settings):
+    import socket
+    if socket.gethostname().endswith('local'):
+        return '/Users/youssefshaarawy/Documents/Datasets/OCT2017/'
+        # return '/Users/youssefshaarawy/Documents/Datasets/JustRAIGS'
+        # return '/Users/youssefshaarawy/Downloads/CUB_200_2011/CUB_200_2011/'
+    return "/users/adfx751/Datasets/OCT2017/"
+    # return '/users/adfx751/Datasets/JustRAIGS'
+    # return '/users/adfx751/Datasets/CUB_200_2011/'
 
 # Full set: './datasets/CUB_200_2011/'
 # Cropped set: './datasets/cub200_cropped/'
 # Stanford dogs: './datasets/stanford_dogs/'
-# data_path = './datasets/CUB_200_2011/'
 
 
 #120 classes in stanford_dogs, 200 in CUB_200_2011
-if 'stanford_dogs' in data_path:
-    num_classes = 120
-elif 'OCT2017' in data_path:
-    num_classes = 4
-elif 'JustRAIGS' in data_path:
-    num_classes = 2
-else:
-    num_classes = 200
-
-num_prototypes = num_classes * 100
+@derived
+def num_classes(settings):
+    if 'stanford_dogs' in settings.data_path:
+        return 120
+    elif 'OCT2017' in settings.data_path:
+        return 4
+    elif 'JustRAIGS' in settings.data_path:
+        return 2
+    return 200
+
+@derived
+def num_prototypes(settings):
+    return settings.num_classes * 100
+
+# Channels of the prototype space (e.g. 64, 128 or 256). None keeps the prototypes as
+# wide as the backbone output (1024 for densenet121); a number adds a 1x1 projection
+# to the add-on layers, shrinking similarity cost and prototype memory accordingly.
+prototype_bottleneck = None
 
 # Cropped set: train_cropped & test_cropped
 # Full set: train & test
-train_dir = data_path + 'train_balanced'
-val_dir = data_path + 'val/'
-train_push_dir = data_path + 'train_balanced/'
-test_dir = data_path + "test_upsampled/"
+# Class balance comes from the sampler (see balanced_sampling) rather than from
+# physically balanced/upsampled copies such as train_balanced/ and test_upsampled/
+train_dir = derived(lambda settings: settings.data_path + 'train')
+val_dir = derived(lambda settings: settings.data_path + 'val/')
+train_push_dir = derived(lambda settings: settings.data_path + 'train/')
+test_dir = derived(lambda settings: settings.data_path + "test/")
+# draw every class with equal probability from train_dir; balanced_epoch_size images
+# per epoch (None = size of the training set), seeded by the run's rand_seed
+balanced_sampling = True
+balanced_epoch_size = None
+# Draw training images by their last loss and own-class prototype activation instead of
+# uniformly (data.LossAwareSampler), with importance weights keeping the losses unbiased.
+# From the joint phase on, an epoch holds importance_sampling_fraction of the usual
+# images, except every importance_sampling_full_pass_every-th epoch, which is a full
+# pass; importance_sampling_uniform_mix of the draws stay (class-balanced) uniform.
+importance_sampling = False
+importance_sampling_fraction = 0.5
+importance_sampling_full_pass_every = 5
+importance_sampling_uniform_mix = 0.3
+importance_sampling_activation_weight = 1.0
+# pick DataLoader workers / prefetch / pinning per dataset from a short calibration
+# run and keep workers alive across epochs; False uses 8 unpinned workers
+autotune_dataloaders = True
+# number of runs sharing this host (sweep.py sets it to its number of parallel trials);
+# autotuned loaders only take their share of its cores and memory
+concurrent_runs = 1
+# drop byte-identical images from the push and evaluation sets
+deduplicate_eval_sets = True
+# local file caching the file digests deduplication computes, keyed by path, size and
+# mtime, so that only new or changed images are read again; None hashes every run
+dedup_digest_cache = './dataset_cache/digests.json'
+# Stream the splits from the tar shards written by `python3 shards.py -out=<dir>`
+# (<dir>/train, push, val and test) instead of walking the image folders, which is
+# much faster on network filesystems; None reads the folders
+sharded_dataset_dir = None
 train_batch_size = 80
 test_batch_size = 100
 train_push_batch_size = 75
+# train_batch_size is the effective (optimization) batch size. Set train_micro_batch_size
+# to forward/backward each batch in smaller chunks on low-memory devices, and
+# gradient_accumulation_steps > 1 to accumulate over several loader batches per step.
+train_micro_batch_size = None
+gradient_accumulation_steps = 1
+# Recompute backbone and prototype-layer activations in the backward pass instead of
+# storing them; trades roughly one extra forward for a much smaller activation footprint.
+activation_checkpointing = False
+activation_checkpointing_segments = 4
+# Compute prototype similarities with the fused normalize/sample/matmul operator in
+# prototype_similarity.py; a chunk size bounds the per-chunk (B, chunk, H, W) temporaries.
+fused_prototype_similarity = False
+prototype_chunk_size = None
+# Stream per-sample test predictions (path, label, prediction, logits, top-k prototypes)
+# to <model_dir>/predictions/ after every evaluation. 'parquet' needs pyarrow (main.py
+# falls back to 'npy' without it), 'npy' writes a directory of memory-mapped NumPy columns.
+save_test_predictions = False
+test_predictions_format = 'parquet'
+test_predictions_topk = 5
+# Evaluate with the inference-only path (logits, accuracy and cross entropy only),
+# computing cluster/separation/offset diagnostics on every n-th test batch
+lean_evaluation = True
+evaluation_diagnostics_every = 10
+# Evaluate on the full-resolution images instead of resizing them to img_size: each image
+# is cut into tile_size tiles (None = img_size) overlapping by tile_overlap pixels, tiles
+# are forwarded tile_batch_size at a time and prototype activations maxed over tiles.
+# The model sees the images at a finer scale than when resized, so this suits models
+# trained on crops at native resolution. main.py reports it as an extra test after each
+# evaluation; the standard resized test still decides checkpoints and early stopping.
+tiled_inference = False
+tile_size = None
+tile_overlap = 64
+tile_batch_size = 64
+
+# Next to every saved <epoch>push .pth also write <epoch>push.ppnet, a memory-mappable state_dict checkpoint
+# with a JSON header (see compact_checkpoint.py) that loads without unpickling the model
+save_compact_checkpoints = True
+compact_checkpoints_fp16 = False
 
 joint_optimizer_lrs = {'features': 1e-4,
                        'add_on_layers': 3e-3,
@@ -82,4 +168,24 @@ num_warm_epochs = 5
 num_secondary_warm_epochs = 5
 push_start = 20
 
-push_epochs = [i for i in range(num_train_epochs) if i % 10 == 0]
+push_epochs = derived(lambda settings: [i for i in range(settings.num_train_epochs) if i % 10 == 0])
+
+# Instead of pushing at push_epochs, push (from push_start on) only when prototypes have
+# drifted from their last pushed vectors or their best training-patch similarity has
+# dropped, at most every push_min_interval and at least every push_max_interval epochs
+adaptive_push = False
+push_drift_threshold = 0.02
+push_similarity_gap_threshold = 0.05
+push_drift_quantile = 0.9
+push_min_interval = 5
+push_max_interval = 20
+
+
+settings = Settings.from_namespace(globals())
+for _name in settings.names():
+    del globals()[_name]
+del _name
+
+
+def __getattr__(name):
+    return getattr(settings, name)
@@ -0,0 +1,425 @@
+import os
+import json
+import time
+import hashlib
+import itertools
+import multiprocessing
+from collections import defaultdict
+
+import numpy as np
+import torch
+import torch.utils.data
+
+
+def class_balanced_sampler(dataset, num_samples=None, seed=1):
+    '''
+    WeightedRandomSampler that draws every class with equal probability, replacing
+    the physically upsampled/balanced copies of the training set.
+    dataset: an ImageFolder (anything with `targets`)
+    num_samples: images drawn per epoch, defaults to len(dataset)
+    seed: seeds the sampler's own generator, so the sequence of epochs is reproducible
+    '''
+    targets = torch.as_tensor(dataset.targets)
+    class_counts = torch.bincount(targets)
+    weights = 1.0 / class_counts[targets].double()
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    return torch.utils.data.WeightedRandomSampler(weights, num_samples=num_samples or len(dataset),
+                                                  replacement=True, generator=generator)
+
+
+class LossAwareSampler(torch.utils.data.Sampler):
+    '''
+    Draws the training images the model still gets wrong more often than the ones it
+    already classifies with a high margin, and shortens the epoch to a fraction of
+    num_samples.
+
+    The priority of an image is its last observed cross entropy plus activation_weight
+    times how far its best own-class prototype activation lies below the best one
+    seen (0 to 1); images not seen yet get the highest priority. Sampling probabilities
+    mix the priority-weighted base distribution (class-balanced if balanced, else
+    uniform) with uniform_mix of the base distribution itself, which bounds the
+    importance weights base / probability by 1 / uniform_mix.
+
+    Before start_epoch and every full_pass_every-th epoch after it, the epoch is a
+    full pass over the base distribution (weights 1), which also refreshes the losses
+    of images that were not drawn for a while.
+
+    The training loop reads the indices of the current epoch (`indices`, in loader
+    order), weighs per-sample losses with weights() and reports them with update().
+    '''
+    def __init__(self, dataset, num_samples=None, balanced=True, fraction=0.5, full_pass_every=5, start_epoch=0,
+                 uniform_mix=0.3, activation_weight=1., seed=1):
+        targets = torch.as_tensor(dataset.targets)
+        base = 1.0 / torch.bincount(targets)[targets].double() if balanced else torch.ones(len(targets)).double()
+        self.base = base / base.sum()
+        self.num_samples = num_samples or len(targets)
+        self.fraction = fraction
+        self.full_pass_every = full_pass_every
+        self.start_epoch = start_epoch
+        self.uniform_mix = uniform_mix
+        self.activation_weight = activation_weight
+        # nan marks images whose loss has not been observed yet
+        self.losses = torch.full((len(targets),), float('nan'))
+        self.activations = torch.full((len(targets),), float('nan'))
+        self.generator = torch.Generator()
+        self.generator.manual_seed(seed)
+        self.full_pass = True
+        self.probabilities = self.base
+        self.indices = []
+
+    def set_epoch(self, epoch):
+        self.full_pass = epoch < self.start_epoch or (epoch - self.start_epoch + 1) % self.full_pass_every == 0
+        self.probabilities = self.base if self.full_pass else self._probabilities()
+
+    def _priorities(self):
+        seen = ~torch.isnan(self.losses)
+        if not seen.any():
+            return torch.ones_like(self.losses)
+        priorities = self.losses.clone()
+        if self.activation_weight:
+            top, bottom = self.activations[seen].max(), self.activations[seen].min()
+            priorities += self.activation_weight * (top - self.activations) / (top - bottom).clamp(min=1e-6)
+        priorities[~seen] = priorities[seen].max()
+        return priorities.clamp(min=0)
+
+    def _probabilities(self):
+        hard = self.base * self._priorities().double()
+        if hard.sum() <= 0:
+            return self.base
+        return (1 - self.uniform_mix) * hard / hard.sum() + self.uniform_mix * self.base
+
+    def __len__(self):
+        if self.full_pass:
+            return self.num_samples
+        return max(1, int(round(self.fraction * self.num_samples)))
+
+    def __iter__(self):
+        self.indices = torch.multinomial(self.probabilities, len(self), replacement=True,
+                                         generator=self.generator).tolist()
+        return iter(self.indices)
+
+    def weights(self, indices):
+        '''
+        Importance weights base / probability of the images at indices; their mean over
+        an epoch is about 1, so weighted batch means stay unbiased estimates of the
+        full-pass losses.
+        '''
+        indices = torch.as_tensor(indices)
+        return (self.base[indices] / self.probabilities[indices]).float()
+
+    def update(self, indices, losses, activations):
+        '''
+        Records per-sample cross entropies and own-class max prototype activations.
+        '''
+        indices = torch.as_tensor(indices)
+        self.losses[indices] = losses.detach().float().cpu()
+        self.activations[indices] = activations.detach().float().cpu()
+
+    def describe(self):
+        if self.full_pass:
+            return 'full pass of {0} images'.format(len(self))
+        weights = self.base / self.probabilities
+        return '{0} of {1} images by loss, importance weights {2:.2f} to {3:.2f}'.format(
+            len(self), self.num_samples, weights.min().item(), weights.max().item())
+
+
+def _file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _load_digest_cache(cache_path):
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_digest_cache(cache_path, digests):
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    tmp_path = '{0}.{1}.tmp'.format(cache_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(digests, f)
+    os.replace(tmp_path, cache_path)
+
+
+def deduplicate_samples(dataset, digest_cache=None, log=print):
+    '''
+    Drops byte-identical images from an ImageFolder in place (keeping the first of
+    each group), so that evaluation and push do not revisit upsampled copies.
+    Only files that share their size with another file are hashed, and digests are
+    reused from digest_cache (default config.dedup_digest_cache) while a file's size
+    and mtime are unchanged.
+    '''
+    if digest_cache is None:
+        from config import dedup_digest_cache
+        digest_cache = dedup_digest_cache
+    digests = _load_digest_cache(digest_cache) if digest_cache else {}
+
+    stats = {}
+    paths_by_size = defaultdict(list)
+    for path, _ in dataset.samples:
+        stats[path] = os.stat(path)
+        paths_by_size[stats[path].st_size].append(path)
+
+    duplicates = set()
+    n_hashed = 0
+    for paths in paths_by_size.values():
+        if len(paths) < 2:
+            continue
+        seen = set()
+        for path in paths:
+            key = os.path.abspath(path)
+            stamp = [stats[path].st_size, stats[path].st_mtime_ns]
+            if key in digests and digests[key][:2] == stamp:
+                digest = digests[key][2]
+            else:
+                digest = _file_digest(path)
+                digests[key] = stamp + [digest]
+                n_hashed += 1
+            if digest in seen:
+                duplicates.add(path)
+            seen.add(digest)
+    if digest_cache and n_hashed:
+        _save_digest_cache(digest_cache, digests)
+
+    if duplicates:
+        dataset.samples = [s for s in dataset.samples if s[0] not in duplicates]
+        dataset.imgs = dataset.samples
+        dataset.targets = [target for _, target in dataset.samples]
+        log('removed {0} duplicate images from {1}'.format(len(duplicates), dataset.root))
+    return dataset
+
+
+# rough per-worker memory besides its prefetched batches (interpreter, dataset copy)
+WORKER_OVERHEAD_BYTES = 300 * 2**20
+_tuned_loader_kwargs = {}
+
+
+def _available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _available_memory():
+    '''
+    Bytes that can be allocated without swapping: MemAvailable (free memory plus
+    reclaimable page cache) where /proc/meminfo exists, otherwise free memory.
+    '''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _loader_throughput(dataset, batch_size, num_workers, prefetch_factor, pin_memory, n_batches, seed=1,
+                       collate_fn=None):
+    '''
+    Images per second of a short unshuffled pass over a random subset, not counting
+    the first batch (worker start-up).
+    '''
+    if isinstance(dataset, torch.utils.data.IterableDataset):
+        # streamed datasets cannot be subset, time their first batches instead
+        subset = dataset
+    else:
+        generator = torch.Generator()
+        generator.manual_seed(seed)
+        n_images = min(len(dataset), batch_size * (n_batches + 1))
+        subset = torch.utils.data.Subset(dataset, torch.randperm(len(dataset), generator=generator)[:n_images].tolist())
+    kwargs = {'num_workers': num_workers, 'pin_memory': pin_memory}
+    if num_workers > 0:
+        kwargs['prefetch_factor'] = prefetch_factor
+    iterator = iter(torch.utils.data.DataLoader(subset, batch_size=batch_size, shuffle=False,
+                                                collate_fn=collate_fn, **kwargs))
+    next(iterator)
+    start = time.time()
+    n_loaded = sum(len(batch[0]) for batch in itertools.islice(iterator, n_batches))
+    return n_loaded / max(time.time() - start, 1e-9)
+
+
+def autotune_loader_kwargs(dataset, batch_size, calibration_batches=4, collate_fn=None, concurrent_loaders=1,
+                           log=print):
+    '''
+    Picks num_workers, prefetch_factor, pin_memory and persistent_workers for a dataset
+    by probing the host (usable cores, available memory, single-image decode time)
+    and timing a short calibration pass for a few worker counts. concurrent_loaders is
+    the number of persistent loaders the caller keeps alive together; the cores and
+    memory are split evenly between them. Results are cached per (dataset root,
+    transform, batch size, collate_fn, concurrent_loaders).
+    '''
+    key = (getattr(dataset, 'root', id(dataset)), repr(getattr(dataset, 'transform', None)), batch_size,
+           collate_fn, concurrent_loaders)
+    if key in _tuned_loader_kwargs:
+        return dict(_tuned_loader_kwargs[key])
+
+    concurrent_loaders = max(1, concurrent_loaders)
+    cores = max(1, _available_cores() // concurrent_loaders)
+    memory = _available_memory()
+    if memory is not None:
+        memory //= concurrent_loaders
+    pin_memory = torch.cuda.is_available()
+
+    n_probe = min(len(dataset), 16)
+    if n_probe == 0:
+        log('loader for {0}: empty dataset, loading in the main process'.format(key[0]))
+        return {'num_workers': 0, 'prefetch_factor': 2, 'pin_memory': pin_memory, 'persistent_workers': False}
+    start = time.time()
+    if isinstance(dataset, torch.utils.data.IterableDataset):
+        probe = itertools.islice(iter(dataset), n_probe)
+    else:
+        probe = (dataset[i] for i in range(n_probe))
+    sample = None
+    for sample in probe:
+        pass
+    decode_seconds = (time.time() - start) / max(n_probe, 1)
+    sample_bytes = sample[0].element_size() * sample[0].nelement() \
+        if sample is not None and torch.is_tensor(sample[0]) else 0
+
+    # slow decodes (large or network-mounted images) get deeper prefetch queues
+    prefetch_factor = 4 if decode_seconds * batch_size > 1.0 else 2
+    max_workers = cores
+    if memory is not None:
+        per_worker = prefetch_factor * batch_size * sample_bytes + WORKER_OVERHEAD_BYTES
+        # streamed datasets also buffer raw shard data in every worker
+        if hasattr(dataset, 'worker_buffer_bytes'):
+            per_worker += dataset.worker_buffer_bytes()
+        max_workers = max(1, min(cores, int(0.25 * memory // per_worker)))
+
+    candidates = sorted({max(1, max_workers // 4), max(1, max_workers // 2), max_workers})
+    best_workers, best_throughput = 0, 0.
+    for num_workers in candidates:
+        throughput = _loader_throughput(dataset, batch_size, num_workers, prefetch_factor, pin_memory,
+                                        calibration_batches, collate_fn=collate_fn)
+        log('\tloader calibration: {0} workers -> {1:.1f} images/s'.format(num_workers, throughput))
+        # prefer fewer workers unless more are clearly faster
+        if throughput > 1.05 * best_throughput:
+            best_workers, best_throughput = num_workers, throughput
+
+    kwargs = {'num_workers': best_workers, 'prefetch_factor': prefetch_factor,
+              'pin_memory': pin_memory, 'persistent_workers': best_workers > 0}
+    log('loader for {0} (batch size {1}, 1/{2} of the host): {3} cores, {4} available, {5:.1f} ms/image decode; '
+        'chose {6} ({7:.1f} images/s)'.format(key[0], batch_size, concurrent_loaders, cores,
+                                              '?' if memory is None else '{0:.1f} GiB'.format(memory / 2**30),
+                                              1000 * decode_seconds, kwargs, best_throughput))
+    _tuned_loader_kwargs[key] = kwargs
+    return dict(kwargs)
+
+
+def make_loader(dataset, batch_size, shuffle=False, sampler=None, autotune=True, num_workers=8,
+                collate_fn=None, concurrent_loaders=1, log=print):
+    '''
+    DataLoader factory used for every loader: with autotune the worker/prefetch/pinning
+    settings come from autotune_loader_kwargs (sharing the host between concurrent_loaders
+    loaders of each of config.concurrent_runs runs) and workers persist across epochs;
+    otherwise it falls back to num_workers unpinned workers.
+    '''
+    if autotune:
+        from config import concurrent_runs
+        kwargs = autotune_loader_kwargs(dataset, batch_size, collate_fn=collate_fn,
+                                        concurrent_loaders=concurrent_loaders * max(1, concurrent_runs), log=log)
+        if kwargs['num_workers'] == 0:
+            del kwargs['prefetch_factor'], kwargs['persistent_workers']
+    else:
+        kwargs = {'num_workers': num_workers, 'pin_memory': False}
+    # streamed (iterable) datasets shuffle themselves
+    shuffle = shuffle and sampler is None and not isinstance(dataset, torch.utils.data.IterableDataset)
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle,
+                                       sampler=sampler, collate_fn=collate_fn, **kwargs)
+
+
+def _cache_images(cache_path, start, paths, img_size):
+    import torchvision.transforms as transforms
+    from PIL import Image
+
+    resize = transforms.Resize(size=(img_size, img_size))
+    images = np.load(cache_path, mmap_mode='r+')
+    for i, path in enumerate(paths):
+        with Image.open(path) as img:
+            images[start + i] = np.asarray(resize(img.convert('RGB')))
+    images.flush()
+    return len(paths)
+
+
+def build_image_cache(image_dir, cache_dir, img_size, deduplicate=False, num_workers=None, log=print):
+    '''
+    Decodes and resizes every image of an ImageFolder once into a (N, img_size, img_size, 3)
+    uint8 memory-mapped array, so that concurrent runs share one decoded copy through
+    the page cache instead of each re-decoding the JPEGs. Reuses an existing cache
+    built from the same folder and size.
+    '''
+    import torchvision.datasets as datasets
+
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['root'] == image_dir and meta['img_size'] == img_size:
+            log('reusing image cache {0}'.format(cache_dir))
+            return cache_dir
+
+    os.makedirs(cache_dir, exist_ok=True)
+    dataset = datasets.ImageFolder(image_dir)
+    if deduplicate:
+        deduplicate_samples(dataset, log=log)
+    paths = [path for path, _ in dataset.samples]
+    cache_path = os.path.join(cache_dir, 'images.npy')
+    images = np.lib.format.open_memmap(cache_path, mode='w+', dtype=np.uint8,
+                                       shape=(len(paths), img_size, img_size, 3))
+    del images
+
+    start = time.time()
+    chunk_size = 256
+    chunks = [(cache_path, i, paths[i:i + chunk_size], img_size) for i in range(0, len(paths), chunk_size)]
+    with multiprocessing.get_context('spawn').Pool(num_workers or _available_cores()) as pool:
+        for _ in pool.starmap(_cache_images, chunks):
+            pass
+    np.save(os.path.join(cache_dir, 'labels.npy'), np.asarray(dataset.targets, dtype=np.int64))
+    with open(os.path.join(cache_dir, 'paths.txt'), 'w') as f:
+        f.write(''.join(path + '\n' for path in paths))
+    with open(meta_path, 'w') as f:
+        json.dump({'root': image_dir, 'img_size': img_size, 'classes': dataset.classes}, f)
+    log('cached {0} images of {1} in {2:.1f}s'.format(len(paths), image_dir, time.time() - start))
+    return cache_dir
+
+
+class CachedImageFolder(torch.utils.data.Dataset):
+    '''
+    ImageFolder-like dataset over a build_image_cache cache. Images come out as
+    float tensors in [0, 1] (like ToTensor after Resize), so `transform` must work on
+    tensors (RandomAffine, RandomHorizontalFlip and Normalize all do).
+    '''
+    def __init__(self, cache_dir, transform=None):
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        with open(os.path.join(cache_dir, 'paths.txt')) as f:
+            paths = [line.rstrip('\n') for line in f]
+        self.root = meta['root']
+        self.classes = meta['classes']
+        self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+        self.images = np.load(os.path.join(cache_dir, 'images.npy'), mmap_mode='r')
+        self.targets = np.load(os.path.join(cache_dir, 'labels.npy')).tolist()
+        self.samples = list(zip(paths, self.targets))
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        image = torch.from_numpy(np.array(self.images[index])).permute(2, 0, 1).float().div_(255)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, self.targets[index]
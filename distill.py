@@ -0,0 +1,253 @@
+import os
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+import torch.utils.data
+import torchvision.transforms as transforms
+import torchvision.datasets as datasets
+from tqdm import tqdm
+
+from DeformableProtoPNet.helpers import makedir
+from DeformableProtoPNet import push
+from DeformableProtoPNet.log import create_logger
+from DeformableProtoPNet.preprocess import mean, std, preprocess_input_function
+from compact_checkpoint import load_model, export_compact, construct_kwargs_from_model
+from data import class_balanced_sampler, deduplicate_samples, make_loader
+from losses import ClassSpecificCosts
+from prototype_bottleneck import construct_PPNet
+from main import prototype_layout
+import train_and_test_modified as tnt
+
+"""
+Trains a PPNet with a lighter backbone to reproduce a trained (densenet121) PPNet.
+
+python3 distill.py -teacher=./saved_models/densenet121/2/80push0.9660.pth -student_arch=resnet34 \
+                   -epochs=20 -keep_prototype_layout
+
+The student has as many prototypes as the teacher and is trained on the teacher's
+temperature-softened marginless logits (KL divergence), on the teacher's per-prototype
+max activations (MSE, prototype j of the student against prototype j of the teacher)
+and on the labels. With -keep_prototype_layout the student takes over the teacher's
+prototype class identities and last layer (kept fixed), so it reaches the teacher's
+predictions through the same prototype -> class evidence. The student's prototypes
+are pushed onto training patches at the end, then teacher and student are compared
+on the CPU.
+"""
+
+
+def load_teacher(path):
+    return load_model(path)[0]
+
+
+def build_student(teacher, student_arch, keep_prototype_layout=False, log=print):
+    prototype_shape, add_on_layers_type = prototype_layout(student_arch, teacher.num_prototypes)
+    construct_kwargs = construct_kwargs_from_model(teacher, base_architecture=student_arch,
+                                                   prototype_shape=list(prototype_shape),
+                                                   add_on_layers_type=add_on_layers_type)
+    student = construct_PPNet(pretrained=True, **dict(construct_kwargs, prototype_shape=prototype_shape))
+    if keep_prototype_layout:
+        student.prototype_class_identity = teacher.prototype_class_identity.detach().clone().cpu()
+        student.last_layer.weight.data.copy_(teacher.last_layer.weight.data)
+        log('student keeps the teacher\'s prototype class identities and last layer')
+    return student, construct_kwargs
+
+
+def distillation_loss(student_output, student_returns, teacher_returns, target, temperature=4.,
+                      logit_weight=1., activation_weight=1., label_weight=1.):
+    '''
+    Returns (loss, (logit term, activation term, label term)).
+    '''
+    teacher_logits, teacher_activations = teacher_returns[1], teacher_returns[3]
+    student_logits, student_activations = student_returns[1], student_returns[3]
+    logit_term = F.kl_div(F.log_softmax(student_logits / temperature, dim=1),
+                          F.softmax(teacher_logits / temperature, dim=1),
+                          reduction='batchmean') * temperature ** 2
+    activation_term = F.mse_loss(student_activations, teacher_activations)
+    label_term = F.cross_entropy(student_output, target)
+    loss = logit_weight * logit_term + activation_weight * activation_term + label_weight * label_term
+    return loss, (logit_term.item(), activation_term.item(), label_term.item())
+
+
+def distill_epoch(student_multi, teacher_multi, dataloader, optimizer, class_specific_costs, log=print, **loss_kwargs):
+    student_multi.train()
+    teacher_multi.eval()
+    start = time.time()
+    totals = [0., 0., 0.]
+    n_batches = 0
+    for image, label in tqdm(dataloader):
+        input = image.cuda()
+        target = label.cuda()
+        prototypes_of_wrong_class = class_specific_costs.wrong_class_mask(target)
+        with torch.no_grad():
+            _, teacher_returns = teacher_multi(input, is_train=False, prototypes_of_wrong_class=None)
+        output, student_returns = student_multi(input, is_train=True,
+                                                prototypes_of_wrong_class=prototypes_of_wrong_class)
+        loss, terms = distillation_loss(output, student_returns, teacher_returns, target, **loss_kwargs)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        totals = [total + term for total, term in zip(totals, terms)]
+        n_batches += 1
+    log('\ttime: \t{0}'.format(time.time() - start))
+    log('\tlogit KL: \t{0}\tactivation MSE: \t{1}\tcross ent: \t{2}'.format(*[t / n_batches for t in totals]))
+
+
+def cpu_report(ppnet, dataloader, max_images=None, warmup_batches=1):
+    '''
+    (accuracy, images per second, number of images) of ppnet on the CPU.
+    The upstream cos_activation allocates its epsilon channels with .cuda(), so the
+    similarity layer is switched to the device-agnostic fused one (in place).
+    '''
+    from prototype_similarity import enable_fused_similarity
+    ppnet = ppnet.cpu().eval()
+    enable_fused_similarity(ppnet, log=lambda *_: None)
+    n_examples, n_correct, n_timed, seconds = 0, 0, 0, 0.
+    with torch.inference_mode():
+        for i, (image, label) in enumerate(dataloader):
+            start = time.time()
+            _, additional_returns = ppnet(image, is_train=False, prototypes_of_wrong_class=None)
+            elapsed = time.time() - start
+            if i >= warmup_batches:
+                seconds += elapsed
+                n_timed += image.size(0)
+            n_correct += (torch.argmax(additional_returns[1], dim=1) == label).sum().item()
+            n_examples += image.size(0)
+            if max_images is not None and n_examples >= max_images:
+                break
+    return n_correct / n_examples, n_timed / max(seconds, 1e-9), n_examples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-gpuid', nargs=1, type=str, default='0')
+    parser.add_argument('-teacher', type=str, required=True)
+    parser.add_argument('-student_arch', type=str, default='resnet34')
+    parser.add_argument('-keep_prototype_layout', action='store_true')
+    parser.add_argument('-epochs', type=int, default=20)
+    parser.add_argument('-temperature', type=float, default=4.)
+    parser.add_argument('-logit_weight', type=float, default=1.)
+    parser.add_argument('-activation_weight', type=float, default=1.)
+    parser.add_argument('-label_weight', type=float, default=1.)
+    parser.add_argument('-no_push', action='store_true')
+    parser.add_argument('-cpu_batch_size', type=int, default=16)
+    parser.add_argument('-cpu_images', type=int, default=500)
+    from config import settings
+    settings.add_arguments(parser)
+    args = parser.parse_args()
+    settings.apply_args(args)
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpuid[0]
+    from config import img_size, train_dir, train_push_dir, val_dir, train_batch_size, test_batch_size, \
+                       train_push_batch_size, balanced_sampling, balanced_epoch_size, deduplicate_eval_sets, \
+                       autotune_dataloaders, joint_optimizer_lrs
+
+    model_dir = os.path.join('./saved_models', args.student_arch,
+                             'distill-' + os.path.splitext(os.path.basename(args.teacher))[0]) + '/'
+    makedir(model_dir)
+    log, logclose = create_logger(log_filename=os.path.join(model_dir, 'distill.log'))
+    log('teacher: {0}, student backbone: {1}'.format(args.teacher, args.student_arch))
+
+    teacher = load_teacher(args.teacher)
+    student, construct_kwargs = build_student(teacher, args.student_arch,
+                                              keep_prototype_layout=args.keep_prototype_layout, log=log)
+
+    normalize = transforms.Normalize(mean=mean, std=std)
+    train_dataset = datasets.ImageFolder(
+        train_dir,
+        transforms.Compose([
+            transforms.RandomAffine(degrees=(-25, 25), shear=15),
+            transforms.RandomHorizontalFlip(),
+            transforms.Resize(size=(img_size, img_size)),
+            transforms.ToTensor(),
+            normalize,
+        ]))
+    train_sampler = class_balanced_sampler(train_dataset, num_samples=balanced_epoch_size) if balanced_sampling else None
+    train_loader = make_loader(train_dataset, batch_size=train_batch_size, shuffle=True, sampler=train_sampler,
+                               autotune=autotune_dataloaders, concurrent_loaders=3, log=log)
+    test_dataset = datasets.ImageFolder(
+        val_dir,
+        transforms.Compose([
+            transforms.Resize(size=(img_size, img_size)),
+            transforms.ToTensor(),
+            normalize,
+        ]))
+    if deduplicate_eval_sets:
+        deduplicate_samples(test_dataset, log=log)
+    test_loader = make_loader(test_dataset, batch_size=test_batch_size, shuffle=False,
+                              autotune=autotune_dataloaders, concurrent_loaders=3, log=log)
+
+    teacher_multi = torch.nn.DataParallel(teacher.cuda())
+    student_multi = torch.nn.DataParallel(student.cuda())
+    tnt.joint(model=student_multi, log=log, last_layer_fixed=args.keep_prototype_layout)
+    optimizer = torch.optim.Adam([
+        {'params': student.features.parameters(), 'lr': joint_optimizer_lrs['features'], 'weight_decay': 1e-3},
+        {'params': student.add_on_layers.parameters(), 'lr': joint_optimizer_lrs['add_on_layers'], 'weight_decay': 1e-3},
+        {'params': student.prototype_vectors, 'lr': joint_optimizer_lrs['prototype_vectors']},
+        {'params': student.conv_offset.parameters(), 'lr': joint_optimizer_lrs['conv_offset']},
+        {'params': student.last_layer.parameters(), 'lr': joint_optimizer_lrs['joint_last_layer_lr']},
+    ])
+    class_specific_costs = ClassSpecificCosts(student.prototype_class_identity).cuda()
+    loss_kwargs = dict(temperature=args.temperature, logit_weight=args.logit_weight,
+                       activation_weight=args.activation_weight, label_weight=args.label_weight)
+
+    log('teacher test accuracy:')
+    tnt.test(model=teacher_multi, dataloader=test_loader, class_specific=True, log=log, lean=True)
+    for epoch in range(args.epochs):
+        log('epoch: \t{0}'.format(epoch))
+        distill_epoch(student_multi, teacher_multi, train_loader, optimizer, class_specific_costs, log=log,
+                      **loss_kwargs)
+        tnt.test(model=student_multi, dataloader=test_loader, class_specific=True, log=log, lean=True)
+
+    push_epoch = None
+    if not args.no_push:
+        train_push_dataset = datasets.ImageFolder(
+            train_push_dir,
+            transforms.Compose([
+                transforms.Resize(size=(img_size, img_size)),
+                transforms.ToTensor(),
+            ]))
+        if deduplicate_eval_sets:
+            deduplicate_samples(train_push_dataset, log=log)
+        train_push_loader = make_loader(train_push_dataset, batch_size=train_push_batch_size, shuffle=False,
+                                        autotune=autotune_dataloaders, concurrent_loaders=3, log=log)
+        img_dir = os.path.join(model_dir, 'img')
+        makedir(img_dir)
+        push_epoch = args.epochs
+        push.push_prototypes(
+            train_push_loader,
+            prototype_network_parallel=student_multi,
+            class_specific=True,
+            preprocess_input_function=preprocess_input_function,
+            prototype_layer_stride=1,
+            root_dir_for_saving_prototypes=img_dir,
+            epoch_number=push_epoch,
+            prototype_img_filename_prefix='prototype-img',
+            prototype_self_act_filename_prefix='prototype-self-act',
+            proto_bound_boxes_filename_prefix='bb',
+            save_prototype_class_identity=True,
+            log=log)
+        log('student test accuracy after push:')
+        tnt.test(model=student_multi, dataloader=test_loader, class_specific=True, log=log, lean=True)
+
+    model_name = '{0}{1}'.format(args.epochs, 'push' if push_epoch is not None else 'nopush')
+    torch.save(obj=student, f=os.path.join(model_dir, model_name + '.pth'))
+    export_compact(student, os.path.join(model_dir, model_name + '.ppnet'), construct_kwargs, push_epoch=push_epoch)
+
+    cpu_loader = torch.utils.data.DataLoader(test_dataset, batch_size=args.cpu_batch_size, shuffle=False,
+                                             num_workers=4)
+    log('CPU comparison on up to {0} test images, batch size {1}, {2} threads:'.format(
+        args.cpu_images, args.cpu_batch_size, torch.get_num_threads()))
+    results = {}
+    for name, ppnet in (('teacher', teacher), ('student', student)):
+        results[name] = cpu_report(ppnet, cpu_loader, max_images=args.cpu_images)
+        n_parameters = sum(p.numel() for p in ppnet.parameters())
+        log('\t{0}: accuracy {1:.4f}, {2:.1f} images/s, {3:.1f}M parameters'.format(
+            name, results[name][0], results[name][1], n_parameters / 1e6))
+    log('student vs teacher: {0:.2f}x throughput, {1:+.2%} accuracy'.format(
+        results['student'][1] / results['teacher'][1], results['student'][0] - results['teacher'][0]))
+    logclose()
+
+if __name__ == "__main__":
+    main()
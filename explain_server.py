@@ -0,0 +1,312 @@
+##### ON-DEMAND EXPLANATIONS
+import os
+import io
+import re
+import time
+import html
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import cv2
+import torch
+import torchvision.transforms as transforms
+from PIL import Image, UnidentifiedImageError
+
+from DeformableProtoPNet.preprocess import mean, std, undo_preprocess_input_function
+from DeformableProtoPNet.push import get_deformation_info
+from compact_checkpoint import load_model
+from explanation_cache import ActivationCache, bytes_digest, file_digest
+from tiling import Tiler
+
+"""
+python3 explain_server.py -model=./saved_models/densenet121/2/80push0.9660.pth -port=8000
+
+then open http://127.0.0.1:8000/explain?path=./test_images/DME-15208-1.jpeg
+(optionally &k=20 or &class=1 for the prototypes of one class), or upload an image:
+curl --data-binary @DME-15208-1.jpeg http://127.0.0.1:8000/explain
+?path= only reads files under the -image_root directories (./test_images/ by default).
+
+Activations, activation maps and offsets are computed once per (image, checkpoint)
+and kept in an ActivationCache; heatmaps and deformed boxes are only rendered when
+the page requests them.
+"""
+
+IMAGE_HASH = re.compile('[0-9a-f]{64}')
+
+# part colours of save_deform_info in local_analysis.py, as 0-255 RGB
+PART_COLORS = [(230, 25, 75), (60, 180, 75), (255, 225, 25), (0, 130, 200), (245, 130, 48),
+               (70, 240, 240), (240, 50, 230), (170, 110, 40), (0, 0, 0)]
+
+
+def _png(image_rgb):
+    _, encoded = cv2.imencode('.png', np.ascontiguousarray(image_rgb[..., ::-1]))
+    return encoded.tobytes()
+
+
+def deformed_boxes(offsets, activation_map, prototype_shape, dilation, image_height, image_width):
+    '''
+    Image-space boxes (row start, row end, col start, col end) of every prototype part
+    at the prototype's most activated latent location, as drawn by local_analysis.py.
+    '''
+    kh, kw = prototype_shape[-2:]
+    dh, dw = dilation if isinstance(dilation, (tuple, list)) else (dilation, dilation)
+    height, width = activation_map.shape
+    row, col = np.unravel_index(np.argmax(activation_map), activation_map.shape)
+    boxes = []
+    for i in range(kh):
+        for k in range(kw):
+            # offsets go in order height offset, width offset
+            h_index = 2 * (k + kh * i)
+            latent_row = row + offsets[h_index, row, col] + (i - kh // 2) * dh
+            latent_col = col + offsets[h_index + 1, row, col] + (k - kw // 2) * dw
+            boxes.append((int(latent_row * image_height / height), int((1 + latent_row) * image_height / height),
+                          int(latent_col * image_width / width), int((1 + latent_col) * image_width / width)))
+    return boxes
+
+
+class Explainer:
+    def __init__(self, model_path, cache, prototype_img_dir=None, tiler=None, log=print):
+        self.cache = cache
+        self.tiler = tiler
+        self.log = log
+        start = time.time()
+        ppnet, header = load_model(model_path)
+        self.checkpoint_hash = file_digest(model_path)
+        push_epoch = header.get('push_epoch')
+        if push_epoch is None:
+            push_epoch = int(re.search(r'\d+', os.path.basename(model_path)).group(0))
+        self.prototype_img_dir = prototype_img_dir or \
+            os.path.join(os.path.dirname(model_path), 'img', 'epoch-{0}'.format(push_epoch))
+        log('loaded {0} (sha256 {1}) in {2:.1f}s'.format(model_path, self.checkpoint_hash[:16], time.time() - start))
+
+        self.ppnet = ppnet.cuda().eval()
+        self.ppnet_multi = torch.nn.DataParallel(self.ppnet)
+        self.prototype_classes = torch.argmax(ppnet.prototype_class_identity, dim=1).cpu().numpy()
+        self.last_layer_weight = ppnet.last_layer.weight.detach().cpu().numpy()
+        self.prototype_shape = tuple(ppnet.prototype_shape)
+        if hasattr(ppnet, 'prototype_dilation'):
+            self.dilation = ppnet.prototype_dilation
+        else:
+            self.dilation = ppnet.prototype_dillation
+        resize = [] if tiler is not None else [transforms.Resize((ppnet.img_size, ppnet.img_size))]
+        self.preprocess = transforms.Compose(resize + [
+            transforms.Lambda(lambda img: img.convert("RGB")),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=mean, std=std),
+        ])
+        # the model runs one image at a time; cached views do not wait for it
+        self.model_lock = threading.Lock()
+
+    def explain(self, image_bytes):
+        '''
+        Returns (image hash, arrays, whether they came from the cache).
+        '''
+        image_hash = bytes_digest(image_bytes)
+        arrays = self.cache.get(image_hash, self.checkpoint_hash)
+        if arrays is not None:
+            return image_hash, arrays, True
+        start = time.time()
+        with self.model_lock:
+            arrays = self._compute(Image.open(io.BytesIO(image_bytes)))
+        self.cache.put(image_hash, self.checkpoint_hash, arrays)
+        self.log('computed explanation {0} in {1:.3f}s'.format(image_hash[:16], time.time() - start))
+        return image_hash, arrays, False
+
+    def cached(self, image_hash):
+        '''
+        Arrays of an already explained image, or None; image_hash comes from the URL and
+        must be a sha256 hex digest before it goes anywhere near a cache path.
+        '''
+        if not IMAGE_HASH.fullmatch(image_hash):
+            raise ValueError('not an image hash: {0!r}'.format(image_hash))
+        return self.cache.get(image_hash, self.checkpoint_hash)
+
+    def _compute(self, image):
+        x = self.preprocess(image).unsqueeze(0).cuda()
+        with torch.no_grad():
+            if self.tiler is not None:
+                logits, additional_returns = self.tiler(self.ppnet, [x[0]], return_maps=True)
+                activation_maps = additional_returns[4][0]
+                offsets = additional_returns[5][0]
+            else:
+                logits, additional_returns = self.ppnet_multi(x)
+                conv_output, activation_maps = self.ppnet.push_forward(x)
+                activation_maps = activation_maps[0]
+                offsets = get_deformation_info(conv_output, self.ppnet_multi)[0][0]
+        image = undo_preprocess_input_function(x.clone())[0].permute(1, 2, 0).clamp(0, 1)
+        return {
+            'image': (image * 255).round().byte().cpu().numpy(),
+            'logits': logits[0].float().cpu().numpy(),
+            'activations': additional_returns[3][0].float().cpu().numpy(),
+            'activation_maps': activation_maps.half().cpu().numpy(),
+            'offsets': offsets.half().cpu().numpy(),
+        }
+
+    def render_heatmap(self, arrays, prototype):
+        image = arrays['image']
+        pattern = cv2.resize(arrays['activation_maps'][prototype].astype(np.float32),
+                             dsize=(image.shape[1], image.shape[0]), interpolation=cv2.INTER_CUBIC)
+        pattern = pattern - np.amin(pattern)
+        pattern = pattern / max(np.amax(pattern), 1e-12)
+        heatmap = cv2.applyColorMap(np.uint8(255 * pattern), cv2.COLORMAP_JET)[..., ::-1]
+        overlay = 0.5 * image / 255 + 0.3 * heatmap / 255
+        return _png(np.uint8(255 * np.clip(overlay, 0, 1)))
+
+    def render_boxes(self, arrays, prototype):
+        image = arrays['image'].copy()
+        boxes = deformed_boxes(arrays['offsets'].astype(np.float32), arrays['activation_maps'][prototype],
+                               self.prototype_shape, self.dilation, image.shape[0], image.shape[1])
+        for part, (row_start, row_end, col_start, col_end) in enumerate(boxes):
+            cv2.rectangle(image, (col_start, row_start), (col_end, row_end),
+                          PART_COLORS[part % len(PART_COLORS)], 1)
+        return _png(image)
+
+    def prototype_image(self, prototype):
+        path = os.path.join(self.prototype_img_dir, 'prototype-img-with_box{0}.png'.format(prototype))
+        if not os.path.exists(path):
+            path = os.path.join(self.prototype_img_dir, 'prototype-img{0}.png'.format(prototype))
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def page(self, image_hash, arrays, from_cache, k=10, target_class=None):
+        logits = arrays['logits']
+        activations = arrays['activations']
+        predicted = int(np.argmax(logits))
+        if target_class is None:
+            prototypes = np.argsort(-activations)[:k]
+            title = 'Most activated {0} prototypes'.format(len(prototypes))
+        else:
+            class_prototypes = np.nonzero(self.prototype_classes == target_class)[0]
+            prototypes = class_prototypes[np.argsort(-activations[class_prototypes])][:k]
+            title = 'Most activated prototypes of class {0}'.format(target_class)
+        rows = []
+        for j in prototypes:
+            rows.append(
+                '<tr><td>{j}</td><td>{cls}</td><td>{act:.4f}</td><td>{weight:.4f}</td>'
+                '<td><img loading="lazy" src="/heatmap/{h}/{j}.png"></td>'
+                '<td><img loading="lazy" src="/boxes/{h}/{j}.png"></td>'
+                '<td><img loading="lazy" src="/prototype/{j}.png"></td></tr>'.format(
+                    j=j, cls=self.prototype_classes[j], act=activations[j],
+                    weight=self.last_layer_weight[predicted, j], h=image_hash))
+        class_links = ' '.join('<a href="/explain?image={0}&class={1}">{1}</a>'.format(image_hash, c)
+                               for c in range(len(logits)))
+        return (
+            '<html><body><h2>Predicted class {pred}</h2><p>logits: {logits}</p>'
+            '<p>{source}, image {h_short}</p><img src="/original/{h}.png">'
+            '<p>prototypes by class: {links}</p><h3>{title}</h3>'
+            '<table><tr><th>prototype</th><th>class</th><th>similarity</th><th>weight to predicted class</th>'
+            '<th>activation map</th><th>deformed parts</th><th>prototype</th></tr>{rows}</table>'
+            '</body></html>').format(pred=predicted, logits=html.escape(np.array2string(logits, precision=3)),
+                                     source='from cache' if from_cache else 'computed', h=image_hash,
+                                     h_short=image_hash[:16], links=class_links, title=title, rows=''.join(rows))
+
+
+def make_handler(explainer, image_roots=()):
+    '''
+    Request handler class for an Explainer; ?path= is limited to files under image_roots.
+    '''
+    image_roots = [os.path.realpath(root) for root in image_roots]
+
+    def read_image(path):
+        path = os.path.realpath(path)
+        if not any(os.path.commonpath([root, path]) == root for root in image_roots):
+            raise PermissionError('{0} is outside the image roots'.format(path))
+        with open(path, 'rb') as f:
+            return f.read()
+
+    class ExplanationHandler(BaseHTTPRequestHandler):
+        def _send(self, body, content_type='text/html; charset=utf-8', status=200):
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _explain_page(self, image_hash, arrays, from_cache, query):
+            k = int(query.get('k', ['10'])[0])
+            target_class = int(query['class'][0]) if 'class' in query else None
+            self._send(explainer.page(image_hash, arrays, from_cache, k=k, target_class=target_class))
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/explain':
+                return self._send('not found', status=404)
+            try:
+                image_bytes = self.rfile.read(int(self.headers['Content-Length']))
+                image_hash, arrays, from_cache = explainer.explain(image_bytes)
+                self._explain_page(image_hash, arrays, from_cache, parse_qs(url.query))
+            except (KeyError, TypeError, ValueError, UnidentifiedImageError) as e:
+                self._send('bad request: {0}'.format(html.escape(str(e))), status=400)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            parts = url.path.strip('/').split('/')
+            try:
+                if parts[0] == 'explain':
+                    if 'path' in query:
+                        image_hash, arrays, from_cache = explainer.explain(read_image(query['path'][0]))
+                    else:
+                        image_hash = query['image'][0]
+                        arrays, from_cache = explainer.cached(image_hash), True
+                        if arrays is None:
+                            return self._send('explanation not cached, open it by path or upload the image', status=404)
+                    return self._explain_page(image_hash, arrays, from_cache, query)
+                if parts[0] == 'prototype':
+                    return self._send(explainer.prototype_image(int(parts[1].split('.')[0])), 'image/png')
+                if parts[0] in ('original', 'heatmap', 'boxes'):
+                    arrays = explainer.cached(parts[1].split('.')[0])
+                    if arrays is None:
+                        return self._send('not cached', status=404)
+                    if parts[0] == 'original':
+                        return self._send(_png(arrays['image']), 'image/png')
+                    prototype = int(parts[2].split('.')[0])
+                    render = explainer.render_heatmap if parts[0] == 'heatmap' else explainer.render_boxes
+                    return self._send(render(arrays, prototype), 'image/png')
+            except PermissionError as e:
+                return self._send('forbidden: {0}'.format(html.escape(str(e))), status=403)
+            except (KeyError, IndexError, ValueError, FileNotFoundError, UnidentifiedImageError) as e:
+                return self._send('bad request: {0}'.format(html.escape(str(e))), status=400)
+            self._send('not found', status=404)
+
+    return ExplanationHandler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-gpuid', nargs=1, type=str, default='0')
+    parser.add_argument('-model', type=str, required=True)
+    parser.add_argument('-prototype_img_dir', type=str, default=None)
+    parser.add_argument('-cache_dir', type=str, default='./explanation_cache/')
+    parser.add_argument('-cache_size_mb', type=int, default=2048)
+    parser.add_argument('-host', type=str, default='127.0.0.1')
+    parser.add_argument('-port', type=int, default=8000)
+    parser.add_argument('-image_root', type=str, action='append', default=None,
+                        help='directory ?path= may read images from; repeatable (default ./test_images/)')
+    from config import settings
+    settings.add_arguments(parser)
+    args = parser.parse_args()
+    settings.apply_args(args)
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpuid[0]
+    from config import tiled_inference
+    tiler = None
+    if tiled_inference:
+        from config import img_size, tile_size, tile_overlap, tile_batch_size
+        tiler = Tiler(tile_size=tile_size or img_size, overlap=tile_overlap, tile_batch_size=tile_batch_size)
+
+    cache = ActivationCache(args.cache_dir, max_bytes=args.cache_size_mb * 2**20)
+    explainer = Explainer(args.model, cache, prototype_img_dir=args.prototype_img_dir, tiler=tiler)
+    image_roots = args.image_root or ['./test_images/']
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(explainer, image_roots))
+    print('serving explanations on http://{0}:{1}/ (cache {2}, {3:.1f} MiB used)'.format(
+        args.host, args.port, args.cache_dir, cache.total_bytes / 2**20))
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import os
+import io
+import hashlib
+import zipfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def bytes_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ActivationCache:
+    '''
+    Content-addressed store of per-image explanation arrays (activations, activation
+    maps, offsets, ...), keyed by (image hash, checkpoint hash), so the same image
+    under the same weights is only ever run through the model once.
+
+    Entries are compressed .npz files at <cache_dir>/<checkpoint hash>/<image hash>.npz.
+    Reads refresh a file's mtime, and once the directory grows past max_bytes the
+    least recently used files are deleted. The directory is only walked once, at start-up;
+    after that sizes and recency are tracked in memory. The most recent memory_entries
+    entries are also kept decoded in memory.
+    '''
+    def __init__(self, cache_dir, max_bytes=2 * 2**30, memory_entries=32):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        # path -> size of every file on disk, least recently used first
+        self.files = OrderedDict()
+        for _, path, size in sorted((os.path.getmtime(path), path, os.path.getsize(path))
+                                        for path in self._entry_paths()):
+            self.files[path] = size
+        self.total_bytes = sum(self.files.values())
+
+    def _entry_paths(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.npz'):
+                    yield os.path.join(root, name)
+
+    def _path(self, image_hash, checkpoint_hash):
+        return os.path.join(self.cache_dir, checkpoint_hash[:16], image_hash + '.npz')
+
+    def _remember(self, key, arrays):
+        self.memory[key] = arrays
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, image_hash, checkpoint_hash):
+        '''
+        {name: array} of a cached entry, or None
+        '''
+        key = (image_hash, checkpoint_hash)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+        path = self._path(image_hash, checkpoint_hash)
+        try:
+            with np.load(path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+            # missing, or evicted or replaced while being read
+            return None
+        with self.lock:
+            try:
+                os.utime(path)
+            except OSError:
+                # evicted since the read; the arrays are still good
+                pass
+            if path in self.files:
+                self.files.move_to_end(path)
+            self._remember(key, arrays)
+        return arrays
+
+    def put(self, image_hash, checkpoint_hash, arrays):
+        path = self._path(image_hash, checkpoint_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        tmp_path = '{0}.{1}.tmp'.format(path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(buffer.getbuffer())
+        with self.lock:
+            os.replace(tmp_path, path)
+            self.total_bytes += buffer.getbuffer().nbytes - self.files.pop(path, 0)
+            self.files[path] = buffer.getbuffer().nbytes
+            self._remember((image_hash, checkpoint_hash), arrays)
+            self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.files:
+            path, size = self.files.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,138 @@
+##### GLOBAL ANALYSIS: NEAREST TRAINING PATCHES PER PROTOTYPE
+import os
+import time
+import argparse
+
+import torch
+import torch.utils.data
+import torchvision.transforms as transforms
+import torchvision.datasets as datasets
+from PIL import Image
+
+from DeformableProtoPNet.helpers import makedir
+from DeformableProtoPNet.log import create_logger
+from DeformableProtoPNet.preprocess import mean, std
+from compact_checkpoint import load_model as load_checkpoint
+from data import make_loader
+from patch_index import PatchIndex
+from predictions import dataset_sample_paths
+from prototype_similarity import normalize_input
+
+"""
+python3 global_analysis.py build -model=./saved_models/densenet121/2/80push0.9660.pth -index_dir=./patch_index/
+python3 global_analysis.py update -model=... -index_dir=./patch_index/ -image_dir=/path/to/new_images/
+python3 global_analysis.py prototypes -model=... -index_dir=./patch_index/ -k=10
+python3 global_analysis.py patch -model=... -index_dir=./patch_index/ -image=img.jpeg -row=3 -col=4
+"""
+
+def load_model(model_path):
+    ppnet = load_checkpoint(model_path)[0]
+    ppnet = ppnet.cuda()
+    ppnet.eval()
+    return ppnet
+
+
+def image_loader(ppnet, image_dir, batch_size):
+    normalize = transforms.Normalize(mean=mean, std=std)
+    dataset = datasets.ImageFolder(
+        image_dir,
+        transforms.Compose([
+            transforms.Resize(size=(ppnet.img_size, ppnet.img_size)),
+            transforms.Lambda(lambda img: img.convert("RGB")),
+            transforms.ToTensor(),
+            normalize,
+        ]))
+    from config import autotune_dataloaders
+    loader = make_loader(dataset, batch_size=batch_size, shuffle=False,
+                         autotune=autotune_dataloaders, num_workers=4)
+    return loader, dataset_sample_paths(loader)
+
+
+def prototype_dilation(ppnet):
+    if hasattr(ppnet, 'prototype_dilation'):
+        return ppnet.prototype_dilation
+    return ppnet.prototype_dillation
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['build', 'update', 'prototypes', 'patch'])
+    parser.add_argument('-gpuid', nargs=1, type=str, default='0')
+    parser.add_argument('-model', type=str, required=True)
+    parser.add_argument('-index_dir', type=str, default='./patch_index/')
+    parser.add_argument('-image_dir', type=str, default=None)
+    parser.add_argument('-batch_size', type=int, default=100)
+    parser.add_argument('-nlist', type=int, default=1024)
+    parser.add_argument('-nprobe', type=int, default=16)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('-image', type=str, default=None)
+    parser.add_argument('-row', type=int, default=0)
+    parser.add_argument('-col', type=int, default=0)
+    from config import settings
+    settings.add_arguments(parser)
+    args = parser.parse_args()
+    settings.apply_args(args)
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpuid[0]
+    makedir(args.index_dir)
+    log, logclose = create_logger(log_filename=os.path.join(args.index_dir, 'global_analysis.log'))
+
+    ppnet = load_model(args.model)
+
+    if args.command in ('build', 'update'):
+        if args.image_dir is None:
+            from config import train_push_dir
+            args.image_dir = train_push_dir
+        loader, paths = image_loader(ppnet, args.image_dir, args.batch_size)
+        if args.command == 'build':
+            with torch.no_grad():
+                fmap = ppnet.conv_features(next(iter(loader))[0][:1].cuda())
+            index = PatchIndex.create(args.index_dir, dim=fmap.size(1) + ppnet.n_eps_channels,
+                                      fmap_height=fmap.size(2), fmap_width=fmap.size(3), checkpoint=args.model)
+        else:
+            index = PatchIndex(args.index_dir)
+        start = time.time()
+        index.add_images(ppnet, loader, paths, log=log)
+        if args.command == 'build':
+            index.train(nlist=args.nlist, log=log)
+        log('{0} took {1:.1f}s, index holds {2} images'.format(args.command, time.time() - start,
+                                                               index.meta['n_images']))
+
+    elif args.command == 'prototypes':
+        index = PatchIndex(args.index_dir)
+        start = time.time()
+        results = index.search_prototypes(ppnet.prototype_vectors, prototype_dilation(ppnet),
+                                          k=args.k, nprobe=args.nprobe)
+        log('searched {0} prototypes in {1:.3f}s'.format(len(results), time.time() - start))
+        prototype_classes = torch.argmax(ppnet.prototype_class_identity, dim=1).tolist()
+        for j, matches in enumerate(results):
+            log('prototype {0} (class {1}):'.format(j, prototype_classes[j]))
+            for similarity, image_index, row, col in matches:
+                log('\t{0:.4f}\t{1}\t(class {2})\tlatent location ({3}, {4})'.format(
+                    similarity, index.paths[image_index], index.labels[image_index], row, col))
+
+    else:
+        index = PatchIndex(args.index_dir)
+        normalize = transforms.Normalize(mean=mean, std=std)
+        preprocess = transforms.Compose([
+            transforms.Resize((ppnet.img_size, ppnet.img_size)),
+            transforms.Lambda(lambda img: img.convert("RGB")),
+            transforms.ToTensor(),
+            normalize,
+        ])
+        with torch.no_grad():
+            conv_features = ppnet.conv_features(preprocess(Image.open(args.image)).unsqueeze(0).cuda())
+            query = normalize_input(conv_features, ppnet.epsilon_val, ppnet.n_eps_channels, 1., 1.,
+                                    length_epsilon=ppnet.epsilon_val)[0, :, args.row, args.col]
+        start = time.time()
+        matches = index.search(query.unsqueeze(0).cpu(), k=args.k, nprobe=args.nprobe)[0]
+        log('searched patch ({0}, {1}) of {2} in {3:.3f}s'.format(args.row, args.col, args.image,
+                                                                  time.time() - start))
+        for similarity, image_index, row, col in matches:
+            log('\t{0:.4f}\t{1}\t(class {2})\tlatent location ({3}, {4})'.format(
+                similarity, index.paths[image_index], index.labels[image_index], row, col))
+
+    logclose()
+
+if __name__ == "__main__":
+    main()
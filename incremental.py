@@ -0,0 +1,299 @@
+import os
+import re
+import time
+import json
+import argparse
+
+import numpy as np
+import torch
+import torch.utils.data
+import torchvision.transforms as transforms
+import torchvision.datasets as datasets
+
+from DeformableProtoPNet.helpers import makedir
+from DeformableProtoPNet.log import create_logger
+from DeformableProtoPNet.preprocess import mean, std, preprocess_input_function
+from compact_checkpoint import load_model, export_compact, construct_kwargs_from_model
+from data import deduplicate_samples, make_loader
+from main import DEFAULT_HPARAMS
+import train_and_test_modified as tnt
+
+"""
+Updates a trained model with newly arrived labeled images instead of retraining it.
+
+python3 incremental.py -checkpoint=./saved_models/densenet121/2/80push.ppnet -new_dir=/data/OCT2017-new/ \
+                       [-mode=joint|last_only] [-epochs=3] [-replay_size=2000]
+
+new_dir is an image folder with (some of) the class subfolders of the training set. The model
+is fine-tuned for a few epochs on the new images plus a bounded, class-stratified replay
+buffer of old training images, then pushed again. The push only scans the new images and
+the images the prototypes were last pushed onto (read from bb<epoch>.npy): every
+prototype is re-projected onto its own source image unless a new image of its class
+matches it better, so only prototypes of classes with new images can move. The new
+bb<epoch>.npy and bb-receptive_field<epoch>.npy index the old push set followed by the new images.
+Finally the time taken is compared with an estimate of a full retrain from scratch.
+"""
+
+
+def load_checkpoint(path):
+    '''
+    (ppnet, push epoch) of a .ppnet or .pth checkpoint
+    '''
+    ppnet, header = load_model(path)
+    if header.get('push_epoch') is not None:
+        return ppnet, int(header['push_epoch'])
+    return ppnet, int(re.search(r'\d+', os.path.basename(path)).group(0))
+
+
+def reindex_push_record(path, combined_indices):
+    '''
+    Rewrites the image indices (column 0) of a push record saved over the restricted
+    push set as indices into the old push set followed by the new images.
+    '''
+    record = np.load(path)
+    found = record[:, 0] >= 0
+    record[found, 0] = combined_indices[record[found, 0].astype(int)]
+    np.save(path, record)
+    return record
+
+
+def align_classes(dataset, class_to_idx):
+    '''
+    Relabels an ImageFolder of new images, which may hold only some of the classes, with
+    the class indices of the original training set.
+    '''
+    unknown = set(dataset.classes) - set(class_to_idx)
+    if unknown:
+        raise ValueError('classes {0} of {1} are not in the training set'.format(sorted(unknown), dataset.root))
+    dataset.samples = [(path, class_to_idx[dataset.classes[target]]) for path, target in dataset.samples]
+    dataset.imgs = dataset.samples
+    dataset.targets = [target for _, target in dataset.samples]
+    dataset.class_to_idx = dict(class_to_idx)
+    dataset.classes = sorted(class_to_idx, key=class_to_idx.get)
+    return dataset
+
+
+def replay_indices(targets, size, seed=1):
+    '''
+    A class-stratified random subset of at most size indices of an old training set,
+    with about the same number of images per class.
+    '''
+    rng = np.random.default_rng(seed)
+    targets = np.asarray(targets)
+    classes = np.unique(targets)
+    per_class = max(1, size // len(classes))
+    chosen = [rng.choice(np.nonzero(targets == c)[0], min(per_class, np.sum(targets == c)), replace=False)
+              for c in classes]
+    return np.sort(np.concatenate(chosen)).tolist()
+
+
+def check_push_record(old_push_dataset, proto_bound_boxes, push_paths=None):
+    '''
+    Raises ValueError unless the push record can index old_push_dataset: push_paths (the
+    sample paths of the push set the record was written over, when it was not this
+    ImageFolder) must match its samples, and every recorded source image must exist and
+    have the class recorded for its prototype.
+    '''
+    if push_paths is not None and [path for path, _ in old_push_dataset.samples] != list(push_paths):
+        raise ValueError('the push record was written over a push set of {0} images in another order than {1} '
+                         '({2} images); repack it in ImageFolder order'.format(
+                             len(push_paths), old_push_dataset.root, len(old_push_dataset)))
+    found = proto_bound_boxes[:, 0] >= 0
+    indices = proto_bound_boxes[found, 0].astype(int)
+    if len(indices) and indices.max() >= len(old_push_dataset):
+        raise ValueError('the push record references image {0}, but {1} has {2} images'.format(
+            indices.max(), old_push_dataset.root, len(old_push_dataset)))
+    targets = np.asarray(old_push_dataset.targets)[indices]
+    mismatched = np.nonzero(targets != proto_bound_boxes[found, -1].astype(int))[0]
+    if len(mismatched):
+        raise ValueError('{0} prototypes have a source image of another class in {1}; the push record was not '
+                         'written over this push set'.format(len(mismatched), old_push_dataset.root))
+
+
+def restricted_push_set(old_push_dataset, new_push_dataset, proto_bound_boxes):
+    '''
+    The source images of the current prototypes followed by the new images, and for
+    each of its indices the index in the combined push set (old push set, then new).
+    '''
+    source_indices = sorted(set(int(i) for i in proto_bound_boxes[:, 0] if i >= 0))
+    dataset = torch.utils.data.ConcatDataset([torch.utils.data.Subset(old_push_dataset, source_indices),
+                                              new_push_dataset])
+    combined_indices = np.array(source_indices + [len(old_push_dataset) + i for i in range(len(new_push_dataset))])
+    return dataset, combined_indices
+
+
+def count_pushes(num_train_epochs, push_start, push_epochs):
+    return len([e for e in range(num_train_epochs)
+                if (e == push_start and push_start < 20) or (e >= push_start and e in push_epochs)])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-gpuid', nargs=1, type=str, default='0')
+    parser.add_argument('-checkpoint', type=str, required=True)
+    parser.add_argument('-bb', type=str, default=None,
+                        help='push record, defaults to <checkpoint dir>/img/epoch-<N>/bb<N>.npy')
+    parser.add_argument('-new_dir', type=str, required=True)
+    parser.add_argument('-mode', type=str, choices=['joint', 'last_only'], default='joint')
+    parser.add_argument('-epochs', type=int, default=3)
+    parser.add_argument('-replay_size', type=int, default=2000)
+    parser.add_argument('-seed', type=int, default=1)
+    from config import settings
+    settings.add_arguments(parser)
+    args = parser.parse_args()
+    settings.apply_args(args)
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpuid[0]
+    from config import train_dir, train_push_dir, val_dir, train_batch_size, test_batch_size, \
+                       train_push_batch_size, deduplicate_eval_sets, autotune_dataloaders, coefs, \
+                       joint_optimizer_lrs, last_layer_optimizer_lr, num_train_epochs, push_start, push_epochs, \
+                       balanced_epoch_size, sharded_dataset_dir
+    start = time.time()
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    ppnet, start_epoch = load_checkpoint(args.checkpoint)
+    checkpoint_dir = os.path.dirname(os.path.abspath(args.checkpoint))
+    bb_path = args.bb or os.path.join(checkpoint_dir, 'img', 'epoch-{0}'.format(start_epoch),
+                                      'bb{0}.npy'.format(start_epoch))
+    proto_bound_boxes = np.load(bb_path)
+    push_epoch = start_epoch + args.epochs
+
+    model_dir = os.path.join(checkpoint_dir, 'incremental-{0}'.format(time.strftime('%Y-%m-%d_%H-%M-%S'))) + '/'
+    makedir(model_dir)
+    log, logclose = create_logger(log_filename=os.path.join(model_dir, 'incremental.log'))
+    log('checkpoint: {0} (pushed at epoch {1}), push record: {2}'.format(args.checkpoint, start_epoch, bb_path))
+    img_size = ppnet.img_size
+
+    normalize = transforms.Normalize(mean=mean, std=std)
+    train_transform = transforms.Compose([
+        transforms.RandomAffine(degrees=(-25, 25), shear=15),
+        transforms.RandomHorizontalFlip(),
+        transforms.Resize(size=(img_size, img_size)),
+        transforms.ToTensor(),
+        normalize,
+    ])
+    push_transform = transforms.Compose([
+        transforms.Resize(size=(img_size, img_size)),
+        transforms.ToTensor(),
+    ])
+    old_train_dataset = datasets.ImageFolder(train_dir, train_transform)
+    new_train_dataset = align_classes(datasets.ImageFolder(args.new_dir, train_transform),
+                                      old_train_dataset.class_to_idx)
+    replay = replay_indices(old_train_dataset.targets, args.replay_size, seed=args.seed)
+    train_dataset = torch.utils.data.ConcatDataset([new_train_dataset,
+                                                    torch.utils.data.Subset(old_train_dataset, replay)])
+    train_loader = make_loader(train_dataset, batch_size=train_batch_size, shuffle=True,
+                               autotune=autotune_dataloaders, concurrent_loaders=3, log=log)
+    log('fine-tuning on {0} new and {1} replayed images'.format(len(new_train_dataset), len(replay)))
+
+    test_dataset = datasets.ImageFolder(val_dir, transforms.Compose([
+        transforms.Resize(size=(img_size, img_size)),
+        transforms.ToTensor(),
+        normalize,
+    ]))
+    if deduplicate_eval_sets:
+        deduplicate_samples(test_dataset, log=log)
+    test_loader = make_loader(test_dataset, batch_size=test_batch_size, shuffle=False,
+                              autotune=autotune_dataloaders, concurrent_loaders=3, log=log)
+
+    ppnet = ppnet.cuda()
+    ppnet_multi = torch.nn.DataParallel(ppnet)
+    log('test accuracy before the update:')
+    tnt.test(model=ppnet_multi, dataloader=test_loader, class_specific=True, log=log, lean=True)
+
+    last_layer_fixed = DEFAULT_HPARAMS['last_layer_fixed']
+    if args.mode == 'joint':
+        tnt.joint(model=ppnet_multi, log=log, last_layer_fixed=last_layer_fixed)
+        optimizer = torch.optim.Adam([
+            {'params': ppnet.features.parameters(), 'lr': joint_optimizer_lrs['features'], 'weight_decay': 1e-3},
+            {'params': ppnet.add_on_layers.parameters(), 'lr': joint_optimizer_lrs['add_on_layers'], 'weight_decay': 1e-3},
+            {'params': ppnet.prototype_vectors, 'lr': joint_optimizer_lrs['prototype_vectors']},
+            {'params': ppnet.conv_offset.parameters(), 'lr': joint_optimizer_lrs['conv_offset']},
+            {'params': ppnet.last_layer.parameters(), 'lr': joint_optimizer_lrs['joint_last_layer_lr']},
+        ])
+    else:
+        tnt.last_only(model=ppnet_multi, log=log, last_layer_fixed=False)
+        optimizer = torch.optim.Adam([{'params': ppnet.last_layer.parameters(), 'lr': last_layer_optimizer_lr}])
+
+    train_seconds = 0.
+    for epoch in range(args.epochs):
+        log('epoch: \t{0}'.format(start_epoch + epoch))
+        epoch_start = time.time()
+        tnt.train(model=ppnet_multi, dataloader=train_loader, optimizer=optimizer, class_specific=True,
+                  coefs=coefs, log=log, subtractive_margin=DEFAULT_HPARAMS['subtractive_margin'],
+                  use_ortho_loss=args.mode == 'joint')
+        train_seconds += time.time() - epoch_start
+
+    # push onto the new images and the current source images only
+    from DeformableProtoPNet import push
+    old_push_dataset = datasets.ImageFolder(train_push_dir, push_transform)
+    if deduplicate_eval_sets:
+        deduplicate_samples(old_push_dataset, log=log)
+    push_paths = None
+    if sharded_dataset_dir is not None:
+        # main.py pushed over the packed push split; it must hold this folder's images in this order
+        with open(os.path.join(sharded_dataset_dir, 'push', 'index.json')) as f:
+            push_paths = [entry[0] for entry in json.load(f)['samples']]
+    check_push_record(old_push_dataset, proto_bound_boxes, push_paths)
+    new_push_dataset = align_classes(datasets.ImageFolder(args.new_dir, push_transform),
+                                     old_push_dataset.class_to_idx)
+    push_dataset, combined_indices = restricted_push_set(old_push_dataset, new_push_dataset, proto_bound_boxes)
+    push_loader = make_loader(push_dataset, batch_size=train_push_batch_size, shuffle=False,
+                              autotune=autotune_dataloaders, concurrent_loaders=3, log=log)
+    log('push scans {0} images ({1} prototype sources, {2} new) instead of {3}'.format(
+        len(push_dataset), len(push_dataset) - len(new_push_dataset), len(new_push_dataset),
+        len(old_push_dataset) + len(new_push_dataset)))
+    img_dir = os.path.join(model_dir, 'img')
+    makedir(img_dir)
+    push_start_time = time.time()
+    push.push_prototypes(
+        push_loader,
+        prototype_network_parallel=ppnet_multi,
+        class_specific=True,
+        preprocess_input_function=preprocess_input_function,
+        prototype_layer_stride=1,
+        root_dir_for_saving_prototypes=img_dir,
+        epoch_number=push_epoch,
+        prototype_img_filename_prefix='prototype-img',
+        prototype_self_act_filename_prefix='prototype-self-act',
+        proto_bound_boxes_filename_prefix='bb',
+        save_prototype_class_identity=True,
+        log=log)
+    push_seconds = time.time() - push_start_time
+
+    # re-index the new push records (boxes and receptive fields) by the combined push set
+    epoch_dir = os.path.join(img_dir, 'epoch-{0}'.format(push_epoch))
+    reindex_push_record(os.path.join(epoch_dir, 'bb-receptive_field{0}.npy'.format(push_epoch)), combined_indices)
+    new_bound_boxes = reindex_push_record(os.path.join(epoch_dir, 'bb{0}.npy'.format(push_epoch)), combined_indices)
+    found = new_bound_boxes[:, 0] >= 0
+    moved = np.sum(new_bound_boxes[found, 0] >= len(old_push_dataset))
+    log('{0} of {1} prototypes moved to new images'.format(moved, len(new_bound_boxes)))
+
+    test_start = time.time()
+    log('test accuracy after the update:')
+    accu = tnt.test(model=ppnet_multi, dataloader=test_loader, class_specific=True, log=log, lean=True)
+    test_seconds = time.time() - test_start
+
+    model_name = '{0}push{1:.4f}'.format(push_epoch, accu)
+    torch.save(obj=ppnet, f=os.path.join(model_dir, model_name + '.pth'))
+    export_compact(ppnet, os.path.join(model_dir, '{0}push.ppnet'.format(push_epoch)),
+                   construct_kwargs_from_model(ppnet), push_epoch=push_epoch)
+    total_seconds = time.time() - start
+
+    # a full retrain: every epoch over the whole (old + new) training set and a test,
+    # plus every scheduled push over the whole push set, at the speeds measured here
+    full_epoch_images = balanced_epoch_size or len(old_train_dataset) + len(new_train_dataset)
+    full_push_images = len(old_push_dataset) + len(new_push_dataset)
+    estimated_full_seconds = (num_train_epochs * (full_epoch_images * train_seconds / (args.epochs * len(train_dataset))
+                                                  + test_seconds)
+                              + count_pushes(num_train_epochs, push_start, push_epochs)
+                              * full_push_images * push_seconds / len(push_dataset))
+    log('incremental update: {0:.0f}s (fine-tune {1:.0f}s, push {2:.0f}s); estimated full retrain: {3:.0f}s'.format(
+        total_seconds, train_seconds, push_seconds, estimated_full_seconds))
+    log('time saved: {0:.0f}s ({1:.1f}x faster)'.format(estimated_full_seconds - total_seconds,
+                                                        estimated_full_seconds / total_seconds))
+    logclose()
+
+if __name__ == "__main__":
+    main()
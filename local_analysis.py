@@ -1,36 +1,37 @@
 ##### MODEL AND DATA LOADING
 import datetime
-import torch
-import torch.utils.data
-import torchvision.transforms as transforms
-import torchvision.datasets as datasets
-from torch.autograd import Variable
-import numpy as np
-import matplotlib.pyplot as plt
-import cv2
-from PIL import Image
 
 import re
 
 import os
 import copy
 
-from DeformableProtoPNet.helpers import makedir, find_high_activation_crop
-import DeformableProtoPNet.train_and_test as tnt
-
-from DeformableProtoPNet.log import create_logger
-from DeformableProtoPNet.preprocess import mean, std, undo_preprocess_input_function
-from DeformableProtoPNet.push import get_deformation_info
-
 import argparse
 
-from logger import WandbLogger
+from config import settings
 
 def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-gpuid', nargs=1, type=str, default='0')
+    settings.add_arguments(parser)
     args = parser.parse_args()
+    settings.apply_args(args)
+
+    # imported after argument parsing; cv2, matplotlib and the push helpers follow once the
+    # model is loaded and checked
+    import torch
+    import torch.utils.data
+    import torchvision.transforms as transforms
+    import torchvision.datasets as datasets
+    from torch.autograd import Variable
+    import numpy as np
+    from PIL import Image
+
+    from DeformableProtoPNet.helpers import makedir, find_high_activation_crop
+    from DeformableProtoPNet.log import create_logger
+    from DeformableProtoPNet.preprocess import mean, std, undo_preprocess_input_function
+    from logger import WandbLogger
 
     prototype_layer_stride = 1
 
@@ -60,7 +61,12 @@ def main():
         {}, logger_name='DeProtoPNet_Test', project='FinalProject')
 
     load_model_path = os.path.join(load_model_dir, load_model_name)
-    epoch_number_str = re.search(r'\d+', load_model_name).group(0)
+    from compact_checkpoint import load_model
+    ppnet, checkpoint_header = load_model(load_model_path)
+    if checkpoint_header.get('push_epoch') is not None:
+        epoch_number_str = str(checkpoint_header['push_epoch'])
+    else:
+        epoch_number_str = re.search(r'\d+', load_model_name).group(0)
     start_epoch_number = int(epoch_number_str)
     if start_epoch_number == 0:
         start_epoch_number = 30
@@ -71,7 +77,6 @@ def main():
     log('experiment run: ' + experiment_run)
     log('epoch number: ' + str(start_epoch_number))
 
-    ppnet = torch.load(load_model_path)
     ppnet = ppnet.cuda()
     ppnet_multi = torch.nn.DataParallel(ppnet)
 
@@ -83,28 +88,55 @@ def main():
     normalize = transforms.Normalize(mean=mean,
                                     std=std)
 
+    # full-resolution analysis by overlapping tiles instead of resizing to img_size
+    from config import tiled_inference
+    tiler = None
+    resize = [transforms.Resize(size=(img_size, img_size))]
+    if tiled_inference:
+        from tiling import Tiler
+        from config import tile_size, tile_overlap, tile_batch_size
+        tiler = Tiler(tile_size=tile_size or img_size, overlap=tile_overlap, tile_batch_size=tile_batch_size)
+        resize = []
+
     # load the test data and check test accuracy
     from config import test_dir
     if "stanford_dogs" in load_model_path:
         test_dir = './datasets/stanford_dogs/test/'
     if check_test_accu:
+        from data import deduplicate_samples, make_loader
         test_batch_size = 100
 
-        test_dataset = datasets.ImageFolder(
-            test_dir,
-            transforms.Compose([
-                transforms.Resize(size=(img_size, img_size)),
-                transforms.Lambda(lambda img: img.convert("RGB")),
-                transforms.ToTensor(),
-                normalize,
-            ]))
-        test_loader = torch.utils.data.DataLoader(
-            test_dataset, batch_size=test_batch_size, shuffle=True,
-            num_workers=4, pin_memory=False)
+        test_transform = transforms.Compose(resize + [
+            transforms.Lambda(lambda img: img.convert("RGB")),
+            transforms.ToTensor(),
+            normalize,
+        ])
+        from config import sharded_dataset_dir
+        if sharded_dataset_dir is not None:
+            from shards import ShardedImageDataset
+            test_dataset = ShardedImageDataset(os.path.join(sharded_dataset_dir, 'test'), test_transform,
+                                               shuffle=True, batch_size=test_batch_size)
+        else:
+            test_dataset = datasets.ImageFolder(test_dir, test_transform)
+            from config import deduplicate_eval_sets
+            if deduplicate_eval_sets:
+                deduplicate_samples(test_dataset, log=log)
+        from config import autotune_dataloaders
+        from tiling import collate_images
+        test_loader = make_loader(test_dataset, batch_size=test_batch_size, shuffle=True,
+                                  autotune=autotune_dataloaders, num_workers=4,
+                                  collate_fn=collate_images if tiler is not None else None, log=log)
         log('test set size: {0}'.format(len(test_loader.dataset)))
 
-        accu = tnt.test(model=ppnet_multi, dataloader=test_loader,
-                        class_specific=class_specific, log=print, wandb_logger=wandb_logger)
+        if tiler is not None:
+            import train_and_test_modified
+            accu = train_and_test_modified.test(model=ppnet_multi, dataloader=test_loader,
+                                                class_specific=class_specific, log=print,
+                                                wandb_logger=wandb_logger, tiler=tiler)
+        else:
+            import DeformableProtoPNet.train_and_test as tnt
+            accu = tnt.test(model=ppnet_multi, dataloader=test_loader,
+                            class_specific=class_specific, log=print, wandb_logger=wandb_logger)
 
     ##### SANITY CHECK
     # confirm prototype class identity
@@ -125,6 +157,11 @@ def main():
         log('WARNING: Not all prototypes connect most strongly to their respective classes.')
             
     ##### HELPER FUNCTIONS FOR PLOTTING
+    # imported only now, so that loading the model and the accuracy check start without them
+    import matplotlib.pyplot as plt
+    import cv2
+    from DeformableProtoPNet.push import get_deformation_info
+
     def save_preprocessed_img(fname, preprocessed_imgs, index=0):
         img_copy = copy.deepcopy(preprocessed_imgs[index:index+1])
         undo_preprocessed_img = undo_preprocess_input_function(img_copy)
@@ -171,7 +208,7 @@ def main():
             dilation = model.prototype_dillation
         else:
             dilation = model.prototype_dilation
-        original_img_size = input.shape[0]
+        original_img_height, original_img_width = input.shape[:2]
 
         colors = [(230/255, 25/255, 75/255), (60/255, 180/255, 75/255), (255/255, 225/255, 25/255),
                                     (0, 130/255, 200/255), (245/255, 130/255, 48/255), (70/255, 240/255, 240/255),
@@ -200,10 +237,10 @@ def main():
                 def_latent_space_row = fmap_height_start_index + h_offset + (i - prototype_shape[-2] // 2) * dilation[0]
                 def_latent_space_col = fmap_width_start_index + w_offset + (k - prototype_shape[-1] // 2)* dilation[1]
 
-                def_image_space_row_start = int(def_latent_space_row * original_img_size / activations.shape[-2])
-                def_image_space_row_end = int((1 + def_latent_space_row) * original_img_size / activations.shape[-2])
-                def_image_space_col_start = int(def_latent_space_col * original_img_size / activations.shape[-1])
-                def_image_space_col_end = int((1 + def_latent_space_col) * original_img_size / activations.shape[-1])
+                def_image_space_row_start = int(def_latent_space_row * original_img_height / activations.shape[-2])
+                def_image_space_row_end = int((1 + def_latent_space_row) * original_img_height / activations.shape[-2])
+                def_image_space_col_start = int(def_latent_space_col * original_img_width / activations.shape[-1])
+                def_image_space_col_end = int((1 + def_latent_space_col) * original_img_width / activations.shape[-1])
     
                 img_with_just_this_box = input.copy()
                 cv2.rectangle(img_with_just_this_box,(def_image_space_col_start, def_image_space_row_start),
@@ -238,8 +275,7 @@ def main():
                     vmax=1.0)
 
     # load the test image and forward it through the network
-    preprocess = transforms.Compose([
-    transforms.Resize((img_size,img_size)),
+    preprocess = transforms.Compose(resize + [
     transforms.Lambda(lambda img: img.convert("RGB")),
     transforms.ToTensor(),
     normalize
@@ -262,12 +298,20 @@ def main():
         test_image_label = test_dataset.class_to_idx[test_image_name.split("-")[0]]
         labels_test = torch.tensor([test_image_label])
 
-        logits, additional_returns = ppnet_multi(images_test)
-        prototype_activations = additional_returns[3]
-        conv_output, prototype_activation_patterns = ppnet.push_forward(images_test)
+        if tiler is not None:
+            with torch.no_grad():
+                logits, additional_returns = tiler(ppnet, [images_test[0]], return_maps=True)
+            prototype_activations = additional_returns[3]
+            # stitched full-resolution maps, in place of push_forward / get_deformation_info
+            prototype_activation_patterns = additional_returns[4]
+            offsets = additional_returns[5][0].unsqueeze(0)
+        else:
+            logits, additional_returns = ppnet_multi(images_test)
+            prototype_activations = additional_returns[3]
+            conv_output, prototype_activation_patterns = ppnet.push_forward(images_test)
 
-        offsets, _ = get_deformation_info(conv_output, ppnet_multi)
-        offsets = offsets.detach()
+            offsets, _ = get_deformation_info(conv_output, ppnet_multi)
+            offsets = offsets.detach()
 
         tables = []
         for i in range(logits.size(0)):
@@ -304,7 +348,7 @@ def main():
             log('last layer connection with predicted class: {0}'.format(ppnet.last_layer.weight[predicted_cls][sorted_indices_act[-i].item()]))
             
             activation_pattern = prototype_activation_patterns[idx][sorted_indices_act[-i].item()].detach().cpu().numpy()
-            upsampled_activation_pattern = cv2.resize(activation_pattern, dsize=(img_size, img_size),
+            upsampled_activation_pattern = cv2.resize(activation_pattern, dsize=(original_img.shape[1], original_img.shape[0]),
                                                     interpolation=cv2.INTER_CUBIC)
             
 
@@ -373,7 +417,7 @@ def main():
                 log('last layer connection: {0}'.format(ppnet.last_layer.weight[c][prototype_index]))
                 
                 activation_pattern = prototype_activation_patterns[idx][prototype_index].detach().cpu().numpy()
-                upsampled_activation_pattern = cv2.resize(activation_pattern, dsize=(img_size, img_size),
+                upsampled_activation_pattern = cv2.resize(activation_pattern, dsize=(original_img.shape[1], original_img.shape[0]),
                                                         interpolation=cv2.INTER_CUBIC)
 
                 save_deform_info(model=ppnet, offsets=offsets, 
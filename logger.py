@@ -1,4 +1,3 @@
-import wandb
 import datetime
 import numpy as np
 
@@ -7,8 +6,16 @@ class WandbLogger:
 
     def __init__(self, config, logger_name='logger', project='inm706', **kwargs):
         logger_name = f'{logger_name}-{datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")}'
-        logger = wandb.init(project=project, name=logger_name, config=config, **kwargs)
-        self.logger = logger
+        self.init_kwargs = dict(project=project, name=logger_name, config=config, **kwargs)
+        self.run = None
+
+    @property
+    def logger(self):
+        # wandb is imported and the run started on the first log call, not before training begins
+        if self.run is None:
+            import wandb
+            self.run = wandb.init(**self.init_kwargs)
+        return self.run
 
     def log(self, data):
         self.logger.log(data)
@@ -25,6 +32,7 @@ class WandbLogger:
         np.array: Confusion matrix.
         """
         # Infer class names
+        import wandb
         class_names = [str(cl) for cl in np.unique(np.concatenate((y_true, y_pred)))]
 
         # Log the confusion matrix plot to W&B
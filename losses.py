@@ -0,0 +1,70 @@
+import torch
+import torch.nn as nn
+
+
+class ClassSpecificCosts(nn.Module):
+    '''
+    Cluster, separation and average separation costs computed from a device-resident
+    prototype -> class index instead of dense (B, P) class masks.
+    Every prototype belongs to exactly one class, so the per-class max / sum of
+    max_activations is a segmented reduction over P, done once per batch; the costs
+    are then picked out of the small (B, num_classes) result.
+    '''
+    def __init__(self, prototype_class_identity):
+        super(ClassSpecificCosts, self).__init__()
+        num_prototypes, num_classes = prototype_class_identity.shape
+        prototype_classes = torch.argmax(prototype_class_identity, dim=1)
+        self.num_classes = num_classes
+        self.register_buffer('prototype_classes', prototype_classes)
+        self.register_buffer('prototypes_per_class',
+                             torch.bincount(prototype_classes, minlength=num_classes))
+        # prototypes are usually laid out class by class with the same count per class,
+        # in which case the segmented reductions are plain reductions over a view
+        self.contiguous = num_prototypes % num_classes == 0 and torch.equal(
+            prototype_classes,
+            torch.arange(num_classes).repeat_interleave(num_prototypes // num_classes).to(prototype_classes.device))
+
+    def wrong_class_mask(self, target):
+        '''
+        Equivalent to 1 - prototype_class_identity[:, target].t(), built on target's device.
+        '''
+        return (self.prototype_classes.unsqueeze(0) != target.unsqueeze(1)).float()
+
+    def class_max_and_sum(self, max_activations):
+        batch_size = max_activations.size(0)
+        if self.contiguous:
+            per_class = max_activations.view(batch_size, self.num_classes, -1)
+            return per_class.max(dim=-1)[0], per_class.sum(dim=-1)
+        index = self.prototype_classes.unsqueeze(0).expand(batch_size, -1)
+        class_max = max_activations.new_full((batch_size, self.num_classes), float('-inf')) \
+            .scatter_reduce(1, index, max_activations, reduce='amax', include_self=True)
+        class_sum = max_activations.new_zeros((batch_size, self.num_classes)) \
+            .scatter_add(1, index, max_activations)
+        return class_max, class_sum
+
+    def forward(self, max_activations, target, sample_weights=None):
+        '''
+        Returns (cluster_cost, separation_cost, avg_separation_cost), matching the
+        masked reductions torch.max(max_activations * mask, dim=1): the masked-out
+        entries there count as 0, hence the clamp at 0 on the class maxima.
+        sample_weights: optional (B,) importance weights applied to the batch means
+        '''
+        class_max, class_sum = self.class_max_and_sum(max_activations)
+        target_index = target.unsqueeze(1)
+        is_correct_class = torch.zeros_like(class_max, dtype=torch.bool).scatter_(1, target_index, True)
+
+        correct_class_prototype_activations = class_max.gather(1, target_index).squeeze(1).clamp(min=0)
+        incorrect_class_prototype_activations = \
+            class_max.masked_fill(is_correct_class, float('-inf')).max(dim=1)[0].clamp(min=0)
+
+        num_wrong_prototypes = self.prototypes_per_class.sum() - self.prototypes_per_class[target]
+        wrong_class_sum = class_sum.sum(dim=1) - class_sum.gather(1, target_index).squeeze(1)
+        avg_separation_cost = wrong_class_sum / num_wrong_prototypes
+
+        if sample_weights is None:
+            return (torch.mean(correct_class_prototype_activations),
+                    torch.mean(incorrect_class_prototype_activations),
+                    torch.mean(avg_separation_cost))
+        return (torch.mean(correct_class_prototype_activations * sample_weights),
+                torch.mean(incorrect_class_prototype_activations * sample_weights),
+                torch.mean(avg_separation_cost * sample_weights))
@@ -1,24 +1,16 @@
 import os
+import time
 import shutil
 
-import torch
-import torch.utils.data
-import torchvision.transforms as transforms
-import torchvision.datasets as datasets
-import numpy as np
-
 import argparse
 import re
 
-from DeformableProtoPNet.helpers import makedir
-from DeformableProtoPNet import model, push, save
-from DeformableProtoPNet.log import create_logger
-from DeformableProtoPNet.preprocess import mean, std, preprocess_input_function
-from logger import WandbLogger
-import train_and_test_modified as tnt
+from config import settings
 
 """
 python3 main.py -gpuid='0, 1' \
+                    -config=oct_server.py \
+                    -set num_train_epochs=50 \
                     -m=0.1 \
                     -last_layer_fixed=True \
                     -subtractive_margin=True \
@@ -29,6 +21,48 @@ python3 main.py -gpuid='0, 1' \
                     -deformable_conv_hidden_channels=128 \
                     -rand_seed=1
 """
+# hyperparameters of a run that are not read from config.py; run() takes overrides
+# for these, for num_prototypes, prototype_bottleneck and for entries of the coefs
+# and optimizer lr dicts
+DEFAULT_HPARAMS = {
+    'm': 0.1,
+    'rand_seed': 1,
+    'last_layer_fixed': True,
+    'subtractive_margin': True,
+    'using_deform': True,
+    'topk_k': 1,
+    'deformable_conv_hidden_channels': 128,
+    'dilation': 2,
+    'incorrect_class_connection': -0.5,
+}
+CONFIG_DICT_HPARAMS = ['coefs', 'joint_optimizer_lrs', 'warm_optimizer_lrs', 'warm_pre_offset_optimizer_lrs']
+
+
+def prototype_layout(base_architecture, num_prototypes):
+    '''
+    (prototype_shape, add_on_layers_type) used for a backbone
+    '''
+    if 'resnet34' in base_architecture:
+        prototype_shape = (num_prototypes, 512, 2, 2)
+        add_on_layers_type = 'upsample'
+    elif 'resnet152' in base_architecture:
+        prototype_shape = (num_prototypes, 2048, 2, 2)
+        add_on_layers_type = 'upsample'
+    elif 'resnet50' in base_architecture:
+        prototype_shape = (num_prototypes, 2048, 2, 2)
+        add_on_layers_type = 'upsample'
+    elif 'densenet121' in base_architecture:
+        prototype_shape = (num_prototypes, 1024, 2, 2)
+        add_on_layers_type = 'upsample'
+    elif 'densenet161' in base_architecture:
+        prototype_shape = (num_prototypes, 2208, 2, 2)
+        add_on_layers_type = 'upsample'
+    else:
+        prototype_shape = (num_prototypes, 512, 2, 2)
+        add_on_layers_type = 'upsample'
+    return prototype_shape, add_on_layers_type
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-gpuid', nargs=1, type=str, default='0') # python3 main.py -gpuid=0,1,2,3
@@ -43,18 +77,52 @@ def main():
     # parser.add_argument('-incorrect_class_connection', nargs=1, type=float, default=0)
     # parser.add_argument('-rand_seed', nargs=1, type=int, default=None)
 
-    args = parser.parse_args()
+    settings.add_arguments(parser)
 
-    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpuid[0]
-    m = 0.1
-    rand_seed = 1
-    last_layer_fixed = True
-    subtractive_margin = True
-    using_deform = True
-    topk_k = 1
-    deformable_conv_hidden_channels = 128
-    dilation = 2
-    incorrect_class_connection = -0.5
+    args = parser.parse_args()
+    settings.apply_args(args)
+    run(gpuid=args.gpuid[0])
+
+
+def run(gpuid='0', hparams=None, experiment_run=None, dataset_cache_dir=None, report_epoch=None):
+    '''
+    Trains one model and returns its best test accuracy.
+    hparams: overrides of DEFAULT_HPARAMS, num_prototypes, prototype_bottleneck and
+        (as dicts) of CONFIG_DICT_HPARAMS entries
+    experiment_run: name of the run directory, defaults to config.experiment_run
+    dataset_cache_dir: directory holding 'train', 'push' and 'val' caches made by
+        data.build_image_cache, used instead of decoding the image folders
+    report_epoch: called as report_epoch(epoch, accu) after every test before push;
+        training stops early when it returns False
+    '''
+    # heavy modules are imported here rather than at module level, so that importing main
+    # (sweep workers, distill, incremental, -h) stays cheap
+    import torch
+    import torch.utils.data
+    import torchvision.transforms as transforms
+    import torchvision.datasets as datasets
+    import numpy as np
+
+    from DeformableProtoPNet.helpers import makedir
+    from DeformableProtoPNet import save
+    from DeformableProtoPNet.log import create_logger
+    from DeformableProtoPNet.preprocess import mean, std, preprocess_input_function
+    from logger import WandbLogger
+    from data import deduplicate_samples, make_loader
+    from prototype_bottleneck import construct_PPNet
+    import train_and_test_modified as tnt
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = gpuid
+    hparams = dict(DEFAULT_HPARAMS, **(hparams or {}))
+    m = hparams['m']
+    rand_seed = hparams['rand_seed']
+    last_layer_fixed = hparams['last_layer_fixed']
+    subtractive_margin = hparams['subtractive_margin']
+    using_deform = hparams['using_deform']
+    topk_k = hparams['topk_k']
+    deformable_conv_hidden_channels = hparams['deformable_conv_hidden_channels']
+    dilation = hparams['dilation']
+    incorrect_class_connection = hparams['incorrect_class_connection']
 
     print("---- USING DEFORMATION: ", using_deform)
     print("Margin set to: ", m)
@@ -70,28 +138,16 @@ def main():
         
     print(os.environ['CUDA_VISIBLE_DEVICES'])
 
-    from config import img_size, experiment_run, base_architecture, num_prototypes
+    from config import img_size, base_architecture, num_prototypes
+    if experiment_run is None:
+        from config import experiment_run
+    num_prototypes = hparams.get('num_prototypes', num_prototypes)
+    from config import prototype_bottleneck
+    prototype_bottleneck = hparams.get('prototype_bottleneck', prototype_bottleneck)
 
     print("num_prototypes set to: {}".format(num_prototypes))
 
-    if 'resnet34' in base_architecture:
-        prototype_shape = (num_prototypes, 512, 2, 2)
-        add_on_layers_type = 'upsample'
-    elif 'resnet152' in base_architecture:
-        prototype_shape = (num_prototypes, 2048, 2, 2)
-        add_on_layers_type = 'upsample'
-    elif 'resnet50' in base_architecture:
-        prototype_shape = (num_prototypes, 2048, 2, 2)
-        add_on_layers_type = 'upsample'
-    elif 'densenet121' in base_architecture:
-        prototype_shape = (num_prototypes, 1024, 2, 2)
-        add_on_layers_type = 'upsample'
-    elif 'densenet161' in base_architecture:
-        prototype_shape = (num_prototypes, 2208, 2, 2)
-        add_on_layers_type = 'upsample'
-    else:
-        prototype_shape = (num_prototypes, 512, 2, 2)
-        add_on_layers_type = 'upsample'
+    prototype_shape, add_on_layers_type = prototype_layout(base_architecture, num_prototypes)
     print("Add on layers type: ", add_on_layers_type)
 
 
@@ -119,10 +175,13 @@ def main():
     makedir(model_dir)
     shutil.copy(src=os.path.join(os.getcwd(), __file__), dst=model_dir)
     shutil.copy(src=os.path.join(os.getcwd(), 'config.py'), dst=model_dir)
+    settings.save(os.path.join(model_dir, 'settings.json'))
 
     log, logclose = create_logger(log_filename=os.path.join(model_dir, 'train.log'))
+    from config import data_path
+    log('data path: {0}'.format(data_path))
     wandb_logger = WandbLogger(
-            {'base_architecture': base_architecture, 'experiment_run': experiment_run, 'num_prototypes': num_prototypes}, logger_name='DeProtoPNet', project='FinalProject')
+            dict(hparams, base_architecture=base_architecture, experiment_run=experiment_run, num_prototypes=num_prototypes), logger_name='DeProtoPNet', project='FinalProject')
     img_dir = os.path.join(model_dir, 'img')
     makedir(img_dir)
     weight_matrix_filename = 'outputL_weights'
@@ -131,11 +190,38 @@ def main():
     proto_bound_boxes_filename_prefix = 'bb'
 
     from config import train_batch_size, test_batch_size, train_push_batch_size, num_classes
+    from config import train_micro_batch_size, gradient_accumulation_steps
 
     normalize = transforms.Normalize(mean=mean,
                                     std=std)
 
-    if 'augmented' not in train_dir:
+    from config import balanced_sampling, balanced_epoch_size, deduplicate_eval_sets, sharded_dataset_dir
+    if dataset_cache_dir is not None:
+        from data import CachedImageFolder
+    if sharded_dataset_dir is not None:
+        from shards import ShardedImageDataset
+    if dataset_cache_dir is not None:
+        # cached images are already resized tensors in [0, 1], so augment after the resize
+        train_dataset = CachedImageFolder(
+            os.path.join(dataset_cache_dir, 'train'),
+            transforms.Compose([
+                transforms.RandomAffine(degrees=(-25, 25), shear=15),
+                transforms.RandomHorizontalFlip(),
+                normalize,
+            ]))
+    elif sharded_dataset_dir is not None:
+        # the streamed dataset shuffles and class-balances by itself
+        train_dataset = ShardedImageDataset(
+            os.path.join(sharded_dataset_dir, 'train'),
+            transforms.Compose([
+                transforms.RandomAffine(degrees=(-25, 25), shear=15),
+                transforms.RandomHorizontalFlip(),
+                transforms.Resize(size=(img_size, img_size)),
+                transforms.ToTensor(),
+                normalize,
+            ]), shuffle=True, batch_size=train_batch_size, balanced=balanced_sampling,
+            epoch_size=balanced_epoch_size, seed=rand_seed)
+    elif 'augmented' not in train_dir:
         print("Using online augmentation")
         train_dataset = datasets.ImageFolder(
             train_dir,
@@ -154,53 +240,135 @@ def main():
                 transforms.ToTensor(),
                 normalize,
             ]))
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=train_batch_size, shuffle=True,
-        num_workers=8, pin_memory=False)
+    from config import importance_sampling, num_warm_epochs, num_secondary_warm_epochs
+    train_sampler = None
+    importance_sampler = None
+    if importance_sampling and sharded_dataset_dir is not None:
+        log('importance sampling needs an indexable training set, not used with sharded_dataset_dir')
+    elif importance_sampling:
+        from data import LossAwareSampler
+        from config import importance_sampling_fraction, importance_sampling_full_pass_every, \
+                            importance_sampling_uniform_mix, importance_sampling_activation_weight
+        importance_sampler = LossAwareSampler(train_dataset, num_samples=balanced_epoch_size,
+                                              balanced=balanced_sampling,
+                                              fraction=importance_sampling_fraction,
+                                              full_pass_every=importance_sampling_full_pass_every,
+                                              start_epoch=num_warm_epochs + num_secondary_warm_epochs,
+                                              uniform_mix=importance_sampling_uniform_mix,
+                                              activation_weight=importance_sampling_activation_weight,
+                                              seed=rand_seed)
+        train_sampler = importance_sampler
+    elif balanced_sampling and sharded_dataset_dir is None:
+        from data import class_balanced_sampler
+        train_sampler = class_balanced_sampler(train_dataset, num_samples=balanced_epoch_size, seed=rand_seed)
+    from config import autotune_dataloaders
+    train_loader = make_loader(train_dataset, batch_size=train_batch_size, shuffle=True, sampler=train_sampler,
+                               autotune=autotune_dataloaders, concurrent_loaders=3, log=log)
     # push set
-    train_push_dataset = datasets.ImageFolder(
-        train_push_dir,
-        transforms.Compose([
-            transforms.Resize(size=(img_size, img_size)),
-            transforms.ToTensor(),
-        ]))
-    train_push_loader = torch.utils.data.DataLoader(
-        train_push_dataset, batch_size=train_push_batch_size, shuffle=False,
-        num_workers=8, pin_memory=False)
+    if dataset_cache_dir is not None:
+        train_push_dataset = CachedImageFolder(os.path.join(dataset_cache_dir, 'push'))
+    elif sharded_dataset_dir is not None:
+        train_push_dataset = ShardedImageDataset(
+            os.path.join(sharded_dataset_dir, 'push'),
+            transforms.Compose([
+                transforms.Resize(size=(img_size, img_size)),
+                transforms.ToTensor(),
+            ]), batch_size=train_push_batch_size)
+    else:
+        train_push_dataset = datasets.ImageFolder(
+            train_push_dir,
+            transforms.Compose([
+                transforms.Resize(size=(img_size, img_size)),
+                transforms.ToTensor(),
+            ]))
+        if deduplicate_eval_sets:
+            deduplicate_samples(train_push_dataset, log=log)
+    train_push_loader = make_loader(train_push_dataset, batch_size=train_push_batch_size, shuffle=False,
+                                    autotune=autotune_dataloaders, concurrent_loaders=3, log=log)
     # test set
-    test_dataset = datasets.ImageFolder(
-        val_dir,
-        transforms.Compose([
-            transforms.Resize(size=(img_size, img_size)),
-            transforms.ToTensor(),
-            normalize,
-        ]))
-    test_loader = torch.utils.data.DataLoader(
-        test_dataset, batch_size=test_batch_size, shuffle=False,
-        num_workers=8, pin_memory=False)
+    from config import tiled_inference
+    def make_test_dataset(resize):
+        if dataset_cache_dir is not None and resize:
+            return CachedImageFolder(os.path.join(dataset_cache_dir, 'val'), normalize)
+        test_transform = transforms.Compose(
+            ([transforms.Resize(size=(img_size, img_size))] if resize else []) + [
+                transforms.ToTensor(),
+                normalize,
+            ])
+        if sharded_dataset_dir is not None:
+            return ShardedImageDataset(os.path.join(sharded_dataset_dir, 'val'), test_transform,
+                                       batch_size=test_batch_size)
+        dataset = datasets.ImageFolder(val_dir, test_transform)
+        if deduplicate_eval_sets:
+            deduplicate_samples(dataset, log=log)
+        return dataset
+    test_loader = make_loader(make_test_dataset(resize=True), batch_size=test_batch_size, shuffle=False,
+                              autotune=autotune_dataloaders, concurrent_loaders=3, log=log)
+    tiler = None
+    if tiled_inference:
+        # tiled evaluation reads the images at full resolution, in batches of differently sized
+        # images; it is reported next to the standard (resized) test, which stays the one used
+        # for checkpointing and early stopping
+        from tiling import Tiler, collate_images
+        from config import tile_size, tile_overlap, tile_batch_size
+        tiled_test_loader = make_loader(make_test_dataset(resize=False), batch_size=test_batch_size, shuffle=False,
+                                        autotune=autotune_dataloaders, collate_fn=collate_images,
+                                        concurrent_loaders=3, log=log)
+        tiler = Tiler(tile_size=tile_size or img_size, overlap=tile_overlap, tile_batch_size=tile_batch_size)
+        log('tiled evaluation: {0}px tiles, {1}px overlap, {2} tiles per batch'.format(
+            tiler.tile_size, tile_overlap, tile_batch_size))
+
+    def tiled_test():
+        if tiler is None:
+            return
+        log('tiled test (full resolution, reported only):')
+        tnt.test(model=ppnet_multi, dataloader=tiled_test_loader, class_specific=class_specific, log=log,
+                 lean=lean_evaluation, diagnostics_every=evaluation_diagnostics_every, tiler=tiler)
 
     log('training set size: {0}'.format(len(train_loader.dataset)))
+    if importance_sampler is not None:
+        log('loss-aware importance sampling: {0} images per epoch, {1:.0%} of them between full passes'.format(
+            importance_sampler.num_samples, importance_sampler.fraction))
+    elif train_sampler is not None:
+        log('class-balanced sampling: {0} images per epoch'.format(len(train_sampler)))
     log('push set size: {0}'.format(len(train_push_loader.dataset)))
     log('test set size: {0}'.format(len(test_loader.dataset)))
     log('batch size: {0}'.format(train_batch_size))
+    log('effective batch size: {0}'.format(train_batch_size * gradient_accumulation_steps))
 
     # construct the model
-    ppnet = model.construct_PPNet(base_architecture=base_architecture,
-                                pretrained=True, img_size=img_size,
-                                prototype_shape=prototype_shape,
-                                num_classes=num_classes, topk_k=topk_k, m=m,
-                                add_on_layers_type=add_on_layers_type,
-                                using_deform=using_deform,
-                                incorrect_class_connection=incorrect_class_connection,
-                                deformable_conv_hidden_channels=deformable_conv_hidden_channels,
-                                prototype_dilation=2)
+    construct_kwargs = dict(base_architecture=base_architecture,
+                            img_size=img_size,
+                            prototype_shape=prototype_shape,
+                            num_classes=num_classes, topk_k=topk_k, m=m,
+                            add_on_layers_type=add_on_layers_type,
+                            using_deform=using_deform,
+                            incorrect_class_connection=incorrect_class_connection,
+                            deformable_conv_hidden_channels=deformable_conv_hidden_channels,
+                            prototype_dilation=dilation,
+                            prototype_bottleneck=prototype_bottleneck)
+    ppnet = construct_PPNet(pretrained=True, **construct_kwargs)
+    log('prototype shape: {0}'.format(tuple(ppnet.prototype_shape)))
+
+    from config import fused_prototype_similarity, prototype_chunk_size
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if fused_prototype_similarity or device == 'cpu':
+        # the upstream cos_activation allocates its epsilon channels with .cuda(); the fused one runs anywhere
+        from prototype_similarity import enable_fused_similarity
+        enable_fused_similarity(ppnet, prototype_chunk_size=prototype_chunk_size, log=log)
+
+    from config import activation_checkpointing, activation_checkpointing_segments
+    if activation_checkpointing:
+        from checkpointing import enable_activation_checkpointing
+        enable_activation_checkpointing(ppnet, segments=activation_checkpointing_segments, log=log)
         
-    ppnet = ppnet.cuda()
+    ppnet = ppnet.to(device)
     ppnet_multi = torch.nn.DataParallel(ppnet)
     class_specific = True
 
     # define optimizer
     from config import joint_optimizer_lrs, joint_lr_step_size
+    joint_optimizer_lrs = dict(joint_optimizer_lrs, **hparams.get('joint_optimizer_lrs', {}))
     if 'resnet152' in base_architecture and 'stanford_dogs' in train_dir:
         joint_optimizer_lrs['features'] = 1e-5
     joint_optimizer_specs = \
@@ -216,6 +384,7 @@ def main():
     log(str(joint_optimizer_lrs))
 
     from config import warm_optimizer_lrs
+    warm_optimizer_lrs = dict(warm_optimizer_lrs, **hparams.get('warm_optimizer_lrs', {}))
     warm_optimizer_specs = \
     [{'params': ppnet.add_on_layers.parameters(), 'lr': warm_optimizer_lrs['add_on_layers'], 'weight_decay': 1e-3},
     {'params': ppnet.prototype_vectors, 'lr': warm_optimizer_lrs['prototype_vectors']},
@@ -225,6 +394,7 @@ def main():
     log(str(warm_optimizer_lrs))
 
     from config import warm_pre_offset_optimizer_lrs
+    warm_pre_offset_optimizer_lrs = dict(warm_pre_offset_optimizer_lrs, **hparams.get('warm_pre_offset_optimizer_lrs', {}))
     if 'resnet152' in base_architecture and 'stanford_dogs' in train_dir:
         warm_pre_offset_optimizer_lrs['features'] = 1e-5
     warm_pre_offset_optimizer_specs = \
@@ -246,26 +416,67 @@ def main():
 
     # weighting of different training losses
     from config import coefs
+    coefs = dict(coefs, **hparams.get('coefs', {}))
     # number of training epochs, number of warm epochs, push start epoch, push epochs
-    from config import num_warm_epochs, num_train_epochs, push_epochs, \
-                        num_secondary_warm_epochs, push_start
+    from config import num_train_epochs, push_epochs, push_start
+
+    from config import save_test_predictions, test_predictions_format, test_predictions_topk
+    predictions_dir = os.path.join(model_dir, 'predictions')
+    write_parquet = test_predictions_format == 'parquet'
+    if save_test_predictions and write_parquet:
+        import importlib.util
+        if importlib.util.find_spec('pyarrow') is None:
+            log('pyarrow is not installed, writing test predictions as npy columns instead of parquet')
+            write_parquet = False
+    def predictions_path(model_name):
+        if not save_test_predictions:
+            return None
+        if write_parquet:
+            return os.path.join(predictions_dir, model_name + '.parquet')
+        return os.path.join(predictions_dir, model_name)
+
+    from config import save_compact_checkpoints, compact_checkpoints_fp16
+    if save_compact_checkpoints:
+        from compact_checkpoint import export_compact
+    from config import lean_evaluation, evaluation_diagnostics_every
+    from config import adaptive_push
+    push_scheduler = None
+    if adaptive_push:
+        from push_schedule import PushScheduler
+        from config import push_drift_threshold, push_similarity_gap_threshold, push_drift_quantile, \
+                            push_min_interval, push_max_interval
+        push_scheduler = PushScheduler(drift_threshold=push_drift_threshold,
+                                       similarity_gap_threshold=push_similarity_gap_threshold,
+                                       quantile=push_drift_quantile,
+                                       min_interval=push_min_interval, max_interval=push_max_interval,
+                                       baseline_push_epochs=[e for e in range(num_train_epochs)
+                                                             if (e == push_start and push_start < 20)
+                                                             or (e >= push_start and e in push_epochs)],
+                                       log=log)
 
     # train the model
     log('start training')
     max_accu = 0
+    best_accu = 0
     for epoch in range(num_train_epochs):
         log('epoch: \t{0}'.format(epoch))
+        if importance_sampler is not None:
+            importance_sampler.set_epoch(epoch)
 
         if epoch < num_warm_epochs:
             tnt.warm_only(model=ppnet_multi, log=log, last_layer_fixed=last_layer_fixed)
             _ = tnt.train(model=ppnet_multi, dataloader=train_loader, optimizer=warm_optimizer,
                         class_specific=class_specific, coefs=coefs, log=log, subtractive_margin=subtractive_margin,
-                        use_ortho_loss=False, wandb_logger=wandb_logger)
+                        use_ortho_loss=False, wandb_logger=wandb_logger,
+                        micro_batch_size=train_micro_batch_size, accumulation_steps=gradient_accumulation_steps,
+                        push_scheduler=push_scheduler, importance_sampler=importance_sampler)
         elif epoch >= num_warm_epochs and epoch - num_warm_epochs < num_secondary_warm_epochs:
             tnt.warm_pre_offset(model=ppnet_multi, log=log, last_layer_fixed=last_layer_fixed)
             _ = tnt.train(model=ppnet_multi, dataloader=train_loader, optimizer=warm_pre_offset_optimizer,
                         class_specific=class_specific, coefs=coefs, log=log, subtractive_margin=subtractive_margin,
-                        use_ortho_loss=False, wandb_logger=wandb_logger)
+                        use_ortho_loss=False, wandb_logger=wandb_logger,
+                        micro_batch_size=train_micro_batch_size, accumulation_steps=gradient_accumulation_steps,
+                        push_scheduler=push_scheduler, importance_sampler=importance_sampler)
             if 'stanford_dogs' in train_dir:
                 warm_lr_scheduler.step()
         else:
@@ -274,15 +485,32 @@ def main():
             tnt.joint(model=ppnet_multi, log=log, last_layer_fixed=last_layer_fixed)
             _ = tnt.train(model=ppnet_multi, dataloader=train_loader, optimizer=joint_optimizer,
                         class_specific=class_specific, coefs=coefs, log=log, subtractive_margin=subtractive_margin,
-                        use_ortho_loss=True, wandb_logger=wandb_logger)
+                        use_ortho_loss=True, wandb_logger=wandb_logger,
+                        micro_batch_size=train_micro_batch_size, accumulation_steps=gradient_accumulation_steps,
+                        push_scheduler=push_scheduler, importance_sampler=importance_sampler)
             joint_lr_scheduler.step()
 
         accu = tnt.test(model=ppnet_multi, dataloader=test_loader,
-                        class_specific=class_specific, log=log, subtractive_margin=subtractive_margin, wandb_logger=wandb_logger)
+                        class_specific=class_specific, log=log, subtractive_margin=subtractive_margin, wandb_logger=wandb_logger,
+                        predictions_path=predictions_path(str(epoch) + 'nopush'), predictions_topk=test_predictions_topk,
+                        lean=lean_evaluation, diagnostics_every=evaluation_diagnostics_every)
+        tiled_test()
         save.save_model_w_condition(model=ppnet, model_dir=model_dir, model_name=str(epoch) + 'nopush', accu=accu,
                                     target_accu=max(max_accu, 0.5), log=log)
-
-        if (epoch == push_start and push_start < 20) or (epoch >= push_start and epoch in push_epochs):
+        best_accu = max(best_accu, accu)
+        if report_epoch is not None and not report_epoch(epoch, accu):
+            log('stopped early after epoch {0}'.format(epoch))
+            break
+
+        scheduled_push = (epoch == push_start and push_start < 20) or (epoch >= push_start and epoch in push_epochs)
+        if push_scheduler is not None:
+            do_push = epoch >= push_start and push_scheduler.should_push(ppnet.prototype_vectors, epoch)
+        else:
+            do_push = scheduled_push
+        if do_push:
+            # push pulls in cv2 and matplotlib, which nothing before the first push needs
+            from DeformableProtoPNet import push
+            push_start_time = time.time()
             push.push_prototypes(
                 train_push_loader, # pytorch dataloader (must be unnormalized in [0,1])
                 prototype_network_parallel=ppnet_multi, # pytorch network with prototype_vectors
@@ -297,9 +525,20 @@ def main():
                 save_prototype_class_identity=True,
                 log=log)
             accu = tnt.test(model=ppnet_multi, dataloader=test_loader,
-                            class_specific=class_specific, log=log, wandb_logger=wandb_logger)
+                            class_specific=class_specific, log=log, wandb_logger=wandb_logger,
+                            predictions_path=predictions_path(str(epoch) + 'push'), predictions_topk=test_predictions_topk,
+                            lean=lean_evaluation, diagnostics_every=evaluation_diagnostics_every)
+            # the push cost counts the push and its re-test, not the checkpoint writes below
+            if push_scheduler is not None:
+                push_scheduler.record_push(ppnet.prototype_vectors, epoch, push_start_time)
             save.save_model_w_condition(model=ppnet, model_dir=model_dir, model_name=str(epoch) + 'push', accu=accu,
                                         target_accu=max(max_accu, 0.5), log=log)
+            best_accu = max(best_accu, accu)
+            tiled_test()
+            # like the .pth above, only checkpoints that pass save_model_w_condition's accuracy bar
+            if save_compact_checkpoints and accu > max(max_accu, 0.5):
+                export_compact(ppnet, os.path.join(model_dir, str(epoch) + 'push.ppnet'), construct_kwargs,
+                               push_epoch=epoch, fp16=compact_checkpoints_fp16)
 
             if not last_layer_fixed:
                 tnt.last_only(model=ppnet_multi, log=log, last_layer_fixed=last_layer_fixed)
@@ -307,12 +546,19 @@ def main():
                     log('iteration: \t{0}'.format(i))
                     _ = tnt.train(model=ppnet_multi, dataloader=train_loader, optimizer=last_layer_optimizer,
                                 class_specific=class_specific, coefs=coefs, log=log, 
-                                subtractive_margin=subtractive_margin, wandb_logger=wandb_logger)
+                                subtractive_margin=subtractive_margin, wandb_logger=wandb_logger,
+                                micro_batch_size=train_micro_batch_size, accumulation_steps=gradient_accumulation_steps,
+                                importance_sampler=importance_sampler)
                     accu = tnt.test(model=ppnet_multi, dataloader=test_loader,
-                                    class_specific=class_specific, log=log, wandb_logger=wandb_logger)
+                                    class_specific=class_specific, log=log, wandb_logger=wandb_logger,
+                                    lean=lean_evaluation, diagnostics_every=evaluation_diagnostics_every)
                     save.save_model_w_condition(model=ppnet, model_dir=model_dir, model_name=str(epoch) + '_' + str(i) + 'push', accu=accu,
                                                 target_accu=max(max_accu, 0.5), log=log)
+                    best_accu = max(best_accu, accu)
+    if push_scheduler is not None:
+        push_scheduler.log_summary()
     logclose()
+    return best_accu
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
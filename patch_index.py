@@ -0,0 +1,253 @@
+import os
+import json
+
+import numpy as np
+import torch
+
+from prototype_similarity import normalize_input, same_padding
+
+
+class PatchIndex:
+    '''
+    Nearest-neighbour index over every latent location (patch) of a set of images.
+
+    Each location's conv feature vector (with the epsilon channels appended) is
+    normalized to unit length and stored once in fp16, in memory-mapped shards of
+    (n_images * H * W, D) rows; row r of a shard is image r // (H * W), location
+    (r % (H * W)) // W, r % W. An inverted-file (IVF) layer of spherical k-means
+    centroids groups the rows, so a query only scores the rows of its nprobe closest
+    lists. New images go into a new shard and are assigned to the existing lists,
+    so the index is updated incrementally without re-embedding anything.
+
+    index_dir layout: meta.json, paths.txt (path and label per image),
+    centroids.npy, shard-<k>.npy and shard-<k>-lists.npz (rows sorted by list).
+    '''
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(index_dir, 'paths.txt')) as f:
+            rows = [line.rstrip('\n').split('\t') for line in f]
+        self.paths = [row[0] for row in rows]
+        self.labels = [int(row[1]) for row in rows]
+        self.shards = [np.load(self._shard_path(shard['name']), mmap_mode='r') for shard in self.meta['shards']]
+        self.centroids = None
+        self.lists = []
+        if os.path.exists(os.path.join(index_dir, 'centroids.npy')):
+            self.centroids = torch.from_numpy(np.load(os.path.join(index_dir, 'centroids.npy')))
+            self.lists = [dict(np.load(self._lists_path(shard['name']))) for shard in self.meta['shards']]
+
+    @staticmethod
+    def create(index_dir, dim, fmap_height, fmap_width, checkpoint=None):
+        os.makedirs(index_dir, exist_ok=True)
+        meta = {'dim': dim, 'fmap_height': fmap_height, 'fmap_width': fmap_width,
+                'n_images': 0, 'shards': [], 'checkpoint': checkpoint}
+        with open(os.path.join(index_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        open(os.path.join(index_dir, 'paths.txt'), 'w').close()
+        return PatchIndex(index_dir)
+
+    def _shard_path(self, name):
+        return os.path.join(self.index_dir, name + '.npy')
+
+    def _lists_path(self, name):
+        return os.path.join(self.index_dir, name + '-lists.npz')
+
+    def _save_meta(self):
+        with open(os.path.join(self.index_dir, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f, indent=2)
+
+    @property
+    def locations_per_image(self):
+        return self.meta['fmap_height'] * self.meta['fmap_width']
+
+    def add_images(self, ppnet, dataloader, paths, log=print):
+        '''
+        Embeds every location of the dataloader's images into a new shard.
+        dataloader: unshuffled, yielding images preprocessed the way the model expects
+        paths: the image paths in dataloader order
+        '''
+        n_images = len(paths)
+        name = 'shard-{0:04d}'.format(len(self.meta['shards']))
+        shard = np.lib.format.open_memmap(self._shard_path(name), mode='w+', dtype=np.float16,
+                                          shape=(n_images * self.locations_per_image, self.meta['dim']))
+        labels = []
+        row = 0
+        with torch.no_grad():
+            for image, label in dataloader:
+                conv_features = ppnet.conv_features(image.cuda())
+                x = normalize_input(conv_features, ppnet.epsilon_val, ppnet.n_eps_channels, 1., 1.,
+                                    length_epsilon=ppnet.epsilon_val)
+                # (B, D, H, W) -> (B * H * W, D), rows ordered image, row, column
+                x = x.permute(0, 2, 3, 1).reshape(-1, x.size(1))
+                shard[row:row + x.size(0)] = x.half().cpu().numpy()
+                row += x.size(0)
+                labels.extend(label.tolist())
+        shard.flush()
+        assert row == shard.shape[0], 'dataloader yielded {0} locations, expected {1}'.format(row, shard.shape[0])
+
+        with open(os.path.join(self.index_dir, 'paths.txt'), 'a') as f:
+            for path, label in zip(paths, labels):
+                f.write('{0}\t{1}\n'.format(path, label))
+        self.paths.extend(paths)
+        self.labels.extend(labels)
+        self.meta['shards'].append({'name': name, 'first_image': self.meta['n_images'], 'n_images': n_images})
+        self.meta['n_images'] += n_images
+        self._save_meta()
+        self.shards.append(np.load(self._shard_path(name), mmap_mode='r'))
+        log('embedded {0} images ({1} patches) into {2}'.format(n_images, row, name))
+
+        if self.centroids is not None:
+            self._assign_shard(len(self.shards) - 1)
+
+    def _read_rows(self, shard_index, rows):
+        return torch.from_numpy(np.asarray(self.shards[shard_index][rows], dtype=np.float32))
+
+    def train(self, nlist=1024, n_iterations=10, sample_size=200000, seed=1, log=print):
+        '''
+        Trains the IVF lists (spherical k-means on a sample of patches) and assigns every shard.
+        '''
+        rng = np.random.default_rng(seed)
+        n_rows = [shard.shape[0] for shard in self.shards]
+        total = sum(n_rows)
+        sample = []
+        for shard_index, n in enumerate(n_rows):
+            n_sample = max(1, int(round(sample_size * n / total)))
+            rows = np.sort(rng.choice(n, size=min(n, n_sample), replace=False))
+            sample.append(self._read_rows(shard_index, rows))
+        sample = torch.cat(sample)
+        nlist = min(nlist, sample.size(0))
+
+        centroids = sample[torch.from_numpy(rng.choice(sample.size(0), size=nlist, replace=False))]
+        for _ in range(n_iterations):
+            assignment = torch.argmax(sample @ centroids.t(), dim=1)
+            sums = torch.zeros_like(centroids).index_add_(0, assignment, sample)
+            counts = torch.bincount(assignment, minlength=nlist)
+            # empty lists keep their previous centroid
+            centroids = torch.where((counts > 0).unsqueeze(1), sums, centroids)
+            centroids = torch.nn.functional.normalize(centroids, dim=1)
+        self.centroids = centroids
+        np.save(os.path.join(self.index_dir, 'centroids.npy'), centroids.numpy())
+        self.meta['nlist'] = nlist
+        self._save_meta()
+        log('trained {0} IVF lists on {1} patches'.format(nlist, sample.size(0)))
+
+        self.lists = []
+        for shard_index in range(len(self.shards)):
+            self._assign_shard(shard_index)
+
+    def _assign_shard(self, shard_index, chunk_size=65536):
+        n = self.shards[shard_index].shape[0]
+        assignment = np.empty(n, dtype=np.int32)
+        for start in range(0, n, chunk_size):
+            rows = np.arange(start, min(n, start + chunk_size))
+            assignment[rows] = torch.argmax(self._read_rows(shard_index, rows) @ self.centroids.t(), dim=1).numpy()
+        order = np.argsort(assignment, kind='stable').astype(np.int64)
+        offsets = np.searchsorted(assignment[order], np.arange(len(self.centroids) + 1)).astype(np.int64)
+        lists = {'order': order, 'offsets': offsets}
+        np.savez(self._lists_path(self.meta['shards'][shard_index]['name']), **lists)
+        if shard_index < len(self.lists):
+            self.lists[shard_index] = lists
+        else:
+            self.lists.append(lists)
+
+    def location(self, shard_index, row):
+        '''
+        (global image index, latent row, latent column) of a shard row
+        '''
+        image, position = divmod(int(row), self.locations_per_image)
+        return (self.meta['shards'][shard_index]['first_image'] + image,) + divmod(position, self.meta['fmap_width'])
+
+    def search(self, queries, k=10, nprobe=16, chunk_size=65536):
+        '''
+        queries: (Q, D) vectors; returns, per query, a list of
+        (similarity, global image index, latent row, latent column), best first.
+        Without trained lists every row is scored (exact search). Each list of each shard
+        is read and scored once, against all the queries that probe it.
+        '''
+        queries = torch.nn.functional.normalize(torch.as_tensor(queries, dtype=torch.float32), dim=1)
+        n_queries = queries.size(0)
+        if self.centroids is not None:
+            probed = torch.topk(queries @ self.centroids.t(), k=min(nprobe, len(self.centroids)), dim=1)[1].numpy()
+            list_queries = {}
+            for q, lists in enumerate(probed):
+                for c in lists:
+                    list_queries.setdefault(int(c), []).append(q)
+        # per query: (top scores, shard index, their shard rows) of every block it was scored against
+        candidates = [[] for _ in range(n_queries)]
+        for shard_index, shard in enumerate(self.shards):
+            if self.centroids is None:
+                blocks = [(np.arange(start, min(shard.shape[0], start + chunk_size)), list(range(n_queries)))
+                          for start in range(0, shard.shape[0], chunk_size)]
+            else:
+                order, offsets = self.lists[shard_index]['order'], self.lists[shard_index]['offsets']
+                blocks = [(np.sort(order[offsets[c]:offsets[c + 1]]), query_indices)
+                          for c, query_indices in list_queries.items()]
+            for rows, query_indices in blocks:
+                if len(rows) == 0:
+                    continue
+                scores = self._read_rows(shard_index, rows) @ queries[query_indices].t()
+                top_scores, top_rows = torch.topk(scores, k=min(k, len(rows)), dim=0)
+                top_rows = rows[top_rows.numpy()]
+                for j, q in enumerate(query_indices):
+                    candidates[q].append((top_scores[:, j], shard_index, top_rows[:, j]))
+
+        results = []
+        for q in range(n_queries):
+            if not candidates[q]:
+                results.append([])
+                continue
+            scores = torch.cat([block[0] for block in candidates[q]])
+            locations = [(shard_index, row) for _, shard_index, rows in candidates[q] for row in rows]
+            best = torch.topk(scores, k=min(k, scores.size(0)))
+            results.append([(scores[i].item(),) + self.location(*locations[i]) for i in best[1].tolist()])
+        return results
+
+    def patch_vectors(self, image_index, rows, cols):
+        '''
+        Stored vectors of one image at latent (rows, cols); zero outside the feature map.
+        '''
+        height, width = self.meta['fmap_height'], self.meta['fmap_width']
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        vectors = torch.zeros(len(rows), self.meta['dim'])
+        for shard_index, shard_meta in enumerate(self.meta['shards']):
+            local = image_index - shard_meta['first_image']
+            if 0 <= local < shard_meta['n_images']:
+                shard_rows = local * self.locations_per_image + rows[inside] * width + cols[inside]
+                vectors[torch.from_numpy(inside)] = self._read_rows(shard_index, shard_rows)
+                return vectors
+        raise IndexError('image index {0} not in index'.format(image_index))
+
+    def search_prototypes(self, prototype_vectors, dilation, k=10, nprobe=16, candidates_per_part=50):
+        '''
+        Top-k training patches per prototype under the undeformed prototype similarity
+        (mean over the prototype's parts of the cosine to the patch at that part's
+        dilated position). Each part is looked up in the IVF index and the anchors it
+        implies are re-scored exactly with all parts.
+        prototype_vectors: (P, D, kh, kw)
+        '''
+        n_prototypes, _, kh, kw = prototype_vectors.shape
+        dh, dw = dilation if isinstance(dilation, (tuple, list)) else (dilation, dilation)
+        ph, pw = same_padding((kh, kw), (dh, dw))
+        part_shifts = [(i * dh - ph, j * dw - pw) for i in range(kh) for j in range(kw)]
+        parts = torch.nn.functional.normalize(prototype_vectors.detach().float().cpu(), dim=1)
+        parts = parts.permute(0, 2, 3, 1).reshape(n_prototypes, kh * kw, -1)
+
+        part_results = self.search(parts.reshape(n_prototypes * kh * kw, -1), k=candidates_per_part, nprobe=nprobe)
+        results = []
+        for p in range(n_prototypes):
+            anchors = set()
+            for part, (shift_row, shift_col) in enumerate(part_shifts):
+                for _, image_index, row, col in part_results[p * kh * kw + part]:
+                    anchor = (image_index, row - shift_row, col - shift_col)
+                    if 0 <= anchor[1] < self.meta['fmap_height'] and 0 <= anchor[2] < self.meta['fmap_width']:
+                        anchors.add(anchor)
+            scored = []
+            for image_index, row, col in anchors:
+                vectors = self.patch_vectors(image_index, [row + s[0] for s in part_shifts],
+                                             [col + s[1] for s in part_shifts])
+                scored.append(((vectors * parts[p]).sum().item() / len(part_shifts), image_index, row, col))
+            scored.sort(reverse=True)
+            results.append(scored[:k])
+        return results
@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+import torch
+
+
+class PredictionWriter:
+    '''
+    Streams per-sample evaluation records (file path, label, prediction, logits and
+    the top-k prototype ids / similarities) to disk one batch at a time, so memory
+    stays bounded by the batch size whatever the size of the evaluated set.
+
+    path ending in '.parquet': one Parquet row group per batch (requires pyarrow).
+    any other path: a directory of memory-mapped .npy columns plus paths.txt,
+    preallocated for num_samples rows; load with np.load(..., mmap_mode='r').
+    '''
+    def __init__(self, path, num_samples, num_classes, topk=5):
+        self.path = path
+        self.num_samples = num_samples
+        self.topk = topk
+        self.n_written = 0
+        self.is_parquet = path.endswith('.parquet')
+
+        if self.is_parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            self.pa = pa
+            self.schema = pa.schema([
+                ('path', pa.string()),
+                ('label', pa.int64()),
+                ('prediction', pa.int64()),
+                ('logits', pa.list_(pa.float32(), num_classes)),
+                ('topk_prototypes', pa.list_(pa.int32(), topk)),
+                ('topk_similarities', pa.list_(pa.float32(), topk)),
+            ])
+            parent_dir = os.path.dirname(path)
+            if parent_dir:
+                os.makedirs(parent_dir, exist_ok=True)
+            self.writer = pq.ParquetWriter(path, self.schema)
+        else:
+            os.makedirs(path, exist_ok=True)
+            def column(name, dtype, shape=()):
+                return np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+',
+                                                 dtype=dtype, shape=(num_samples,) + shape)
+            self.columns = {
+                'label': column('label', np.int64),
+                'prediction': column('prediction', np.int64),
+                'logits': column('logits', np.float32, (num_classes,)),
+                'topk_prototypes': column('topk_prototypes', np.int32, (topk,)),
+                'topk_similarities': column('topk_similarities', np.float32, (topk,)),
+            }
+            self.paths_file = open(os.path.join(path, 'paths.txt'), 'w')
+
+    def write_batch(self, paths, labels, logits, prototype_activations):
+        '''
+        paths: list of file paths (or None entries when unknown)
+        labels: (B,) tensor
+        logits: (B, num_classes) tensor, prediction is its argmax
+        prototype_activations: (B, num_prototypes) tensor of per-prototype similarities
+        '''
+        with torch.no_grad():
+            logits = logits.detach().float()
+            topk_similarities, topk_prototypes = torch.topk(prototype_activations.detach().float(),
+                                                            k=self.topk, dim=1)
+            batch = {
+                'label': labels.cpu().numpy().astype(np.int64),
+                'prediction': torch.argmax(logits, dim=1).cpu().numpy().astype(np.int64),
+                'logits': logits.cpu().numpy(),
+                'topk_prototypes': topk_prototypes.cpu().numpy().astype(np.int32),
+                'topk_similarities': topk_similarities.cpu().numpy(),
+            }
+        paths = ['' if p is None else p for p in paths]
+
+        if self.is_parquet:
+            pa = self.pa
+            arrays = [pa.array(paths, type=pa.string())]
+            for field in list(self.schema)[1:]:
+                values = batch[field.name]
+                if values.ndim == 1:
+                    arrays.append(pa.array(values, type=field.type))
+                else:
+                    arrays.append(pa.FixedSizeListArray.from_arrays(
+                        pa.array(values.reshape(-1), type=field.type.value_type), values.shape[1]))
+            self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        else:
+            end = self.n_written + len(paths)
+            assert end <= self.num_samples, 'more samples written than preallocated'
+            for name, values in batch.items():
+                self.columns[name][self.n_written:end] = values
+            self.paths_file.write(''.join(p + '\n' for p in paths))
+        self.n_written += len(paths)
+
+    def close(self):
+        if self.is_parquet:
+            self.writer.close()
+        else:
+            for values in self.columns.values():
+                values.flush()
+            self.paths_file.close()
+        return self.n_written
+
+
+def dataset_sample_paths(dataloader):
+    '''
+    File paths of the dataloader's samples in iteration order, or None when they
+    cannot be recovered (no `samples` attribute, a shuffling sampler, or a streamed
+    dataset that does not keep its index order).
+    '''
+    dataset = dataloader.dataset
+    samples = getattr(dataset, 'samples', None)
+    if samples is None:
+        return None
+    if isinstance(dataset, torch.utils.data.IterableDataset):
+        if not getattr(dataset, 'ordered', False):
+            return None
+    elif not isinstance(dataloader.sampler, torch.utils.data.SequentialSampler):
+        return None
+    return [path for path, _ in samples]
@@ -0,0 +1,57 @@
+import torch.nn as nn
+
+from DeformableProtoPNet import model
+
+
+def _add_on_output_channels(ppnet):
+    '''
+    Channels coming out of the add-on layers, read from the layers instead of running the
+    backbone: the last conv of the add-on layers, else the last conv or BatchNorm of the
+    backbone (densenets end in a BatchNorm).
+    '''
+    for layers in (ppnet.add_on_layers, ppnet.features):
+        for layer in reversed(list(layers.modules())):
+            if isinstance(layer, nn.Conv2d):
+                return layer.out_channels
+            if isinstance(layer, nn.BatchNorm2d) and layers is ppnet.features:
+                return layer.num_features
+    raise ValueError('cannot tell the output channels of {0}'.format(type(ppnet.features).__name__))
+
+
+def add_prototype_bottleneck(ppnet, in_channels):
+    '''
+    Appends a 1x1 conv projection (in_channels -> prototype channels, ProtoPNet's
+    bottleneck: conv, ReLU, conv, Sigmoid) to the add-on layers, so prototypes live
+    in a space narrower than the backbone output. The epsilon channels and the offset
+    network are built by PPNet from prototype_shape[1] and need no change.
+    '''
+    channels = ppnet.prototype_shape[1]
+    projection = [nn.Conv2d(in_channels, channels, kernel_size=1), nn.ReLU(),
+                  nn.Conv2d(channels, channels, kernel_size=1), nn.Sigmoid()]
+    for layer in projection:
+        if isinstance(layer, nn.Conv2d):
+            nn.init.kaiming_normal_(layer.weight, mode='fan_out', nonlinearity='relu')
+            nn.init.constant_(layer.bias, 0)
+    ppnet.add_on_layers = nn.Sequential(*list(ppnet.add_on_layers.children()), *projection)
+    return ppnet
+
+
+def construct_PPNet(prototype_bottleneck=None, **kwargs):
+    '''
+    model.construct_PPNet with an optional reduced-dimensional prototype space.
+    prototype_bottleneck: number of prototype channels (e.g. 64, 128 or 256) replacing
+        prototype_shape[1]; None keeps the prototypes as wide as the backbone output
+    '''
+    if prototype_bottleneck is None:
+        ppnet = model.construct_PPNet(**kwargs)
+        ppnet.prototype_bottleneck = None
+        return ppnet
+    prototype_shape = tuple(kwargs.pop('prototype_shape'))
+    kwargs['prototype_shape'] = (prototype_shape[0], prototype_bottleneck) + prototype_shape[2:]
+    ppnet = model.construct_PPNet(**kwargs)
+    in_channels = _add_on_output_channels(ppnet)
+    # add-on layers that already project to prototype_shape[1] need no extra projection
+    if in_channels != prototype_bottleneck:
+        add_prototype_bottleneck(ppnet, in_channels)
+    ppnet.prototype_bottleneck = prototype_bottleneck
+    return ppnet
@@ -0,0 +1,158 @@
+import torch
+import torch.nn.functional as F
+
+from DeformableProtoPNet.model import PPNet
+
+
+def _pair(value):
+    if isinstance(value, (tuple, list)):
+        return tuple(value)
+    return (value, value)
+
+
+def normalize_input(x, epsilon_val, n_eps_channels, input_vector_length, normalizing_factor,
+                    length_epsilon=0.):
+    '''
+    Appends the epsilon channels to the conv features and scales every spatial
+    location to length input_vector_length / normalizing_factor.
+    The squared norm of the epsilon channels is a constant, so it is added to the
+    feature norm directly instead of being summed over the concatenated tensor.
+    '''
+    sq_length = torch.sum(torch.square(x), dim=-3, keepdim=True) \
+                + (n_eps_channels * epsilon_val ** 2 + length_epsilon)
+    scale = (input_vector_length / normalizing_factor) * torch.rsqrt(sq_length)
+    epsilon_channel_x = (epsilon_val * scale).expand(-1, n_eps_channels, -1, -1)
+    return torch.cat((x * scale, epsilon_channel_x), -3)
+
+
+def normalize_prototypes(prototype_vectors, epsilon_val, normalizing_factor):
+    '''
+    Normalizes every spatial part of every prototype to unit length (over channels),
+    divided by normalizing_factor so that a full prototype has length 1.
+    '''
+    prototype_vector_length = torch.sqrt(torch.sum(torch.square(prototype_vectors), dim=-3, keepdim=True)
+                                         + epsilon_val)
+    return prototype_vectors / ((prototype_vector_length + epsilon_val) * normalizing_factor)
+
+
+def same_padding(kernel_size, dilation):
+    kernel_size, dilation = _pair(kernel_size), _pair(dilation)
+    return tuple(d * (k - 1) // 2 for k, d in zip(kernel_size, dilation))
+
+
+def deformable_sample(x, offset, kernel_size, dilation=1, padding=0):
+    '''
+    Bilinearly samples x at the deformed kernel locations, with the same offset
+    layout as DCNv2 / torchvision.ops.deform_conv2d: channel 2 * (i * kw + j) holds
+    the height offset and 2 * (i * kw + j) + 1 the width offset of kernel part (i, j).
+    Locations outside of x read as zero.
+
+    x: (B, C, H, W)
+    offset: (B, 2 * kh * kw, H_out, W_out)
+    returns: (B, C, kh * kw, H_out, W_out)
+    '''
+    kh, kw = _pair(kernel_size)
+    dh, dw = _pair(dilation)
+    ph, pw = _pair(padding)
+    batch_size, n_channels, height, width = x.shape
+    out_height, out_width = offset.shape[-2:]
+    n_parts = kh * kw
+
+    offset = offset.view(batch_size, n_parts, 2, out_height, out_width)
+    base_rows = torch.arange(out_height, device=x.device, dtype=x.dtype) - ph
+    base_cols = torch.arange(out_width, device=x.device, dtype=x.dtype) - pw
+    kernel_rows = (torch.arange(kh, device=x.device, dtype=x.dtype) * dh).repeat_interleave(kw)
+    kernel_cols = (torch.arange(kw, device=x.device, dtype=x.dtype) * dw).repeat(kh)
+
+    rows = base_rows.view(1, 1, -1, 1) + kernel_rows.view(1, -1, 1, 1) + offset[:, :, 0]
+    cols = base_cols.view(1, 1, 1, -1) + kernel_cols.view(1, -1, 1, 1) + offset[:, :, 1]
+    # grid_sample with align_corners=True maps -1 and 1 to the first and last pixel centres
+    grid = torch.stack((2 * cols / max(width - 1, 1) - 1, 2 * rows / max(height - 1, 1) - 1), dim=-1)
+    grid = grid.view(batch_size, n_parts * out_height, out_width, 2)
+
+    sampled = F.grid_sample(x, grid, mode='bilinear', padding_mode='zeros', align_corners=True)
+    return sampled.view(batch_size, n_channels, n_parts, out_height, out_width)
+
+
+def deformable_prototype_similarity(x_normalized, offset, normalized_prototypes, dilation=1, padding=None,
+                                    prototype_chunk_size=None, chunk_fn=None):
+    '''
+    Dot product between every deformed location of x_normalized and every prototype,
+    i.e. deform_conv2d(x_normalized, offset, normalized_prototypes) without bias.
+    The deformed features are sampled once and shared by all prototypes; prototypes
+    are then processed prototype_chunk_size at a time as one matmul each, and
+    chunk_fn (if given) is applied to every (B, chunk, H, W) block before the next one
+    is computed, so elementwise post-processing never spans all prototypes at once.
+    '''
+    n_prototypes, n_channels, kh, kw = normalized_prototypes.shape
+    if padding is None:
+        padding = same_padding((kh, kw), dilation)
+    sampled = deformable_sample(x_normalized, offset, (kh, kw), dilation=dilation, padding=padding)
+    batch_size, _, n_parts, out_height, out_width = sampled.shape
+    columns = sampled.view(batch_size, n_channels * n_parts, out_height * out_width)
+    weights = normalized_prototypes.reshape(n_prototypes, n_channels * n_parts)
+
+    chunk_size = prototype_chunk_size or n_prototypes
+    outputs = []
+    for start in range(0, n_prototypes, chunk_size):
+        dot = torch.matmul(weights[start:start + chunk_size], columns)
+        dot = dot.view(batch_size, -1, out_height, out_width)
+        outputs.append(chunk_fn(dot, start) if chunk_fn is not None else dot)
+    if isinstance(outputs[0], tuple):
+        return tuple(torch.cat(parts, dim=1) for parts in zip(*outputs))
+    return torch.cat(outputs, dim=1)
+
+
+def fused_cos_activation(ppnet, x, prototypes_of_wrong_class=None, prototype_chunk_size=None):
+    '''
+    Normalization, offset prediction, deformable sampling and (margin-penalized)
+    cosine similarity of PPNet.cos_activation in a single pass. Like PPNet.cos_activation,
+    the subtractive margin only applies while ppnet is in training mode.
+    Returns (activations, marginless_activations), both (B, P, H, W).
+    '''
+    input_vector_length = ppnet.input_vector_length
+    normalizing_factor = (ppnet.prototype_shape[-2] * ppnet.prototype_shape[-1])**0.5
+    if hasattr(ppnet, 'prototype_dilation'):
+        dilation = ppnet.prototype_dilation
+    else:
+        dilation = ppnet.prototype_dillation
+
+    x_normalized = normalize_input(x, ppnet.epsilon_val, ppnet.n_eps_channels, input_vector_length,
+                                   normalizing_factor, length_epsilon=ppnet.epsilon_val)
+    offset = ppnet.conv_offset(x_normalized)
+    normalized_prototypes = normalize_prototypes(ppnet.prototype_vectors, ppnet.epsilon_val, normalizing_factor)
+
+    def to_activations(dot, start):
+        marginless = dot / (input_vector_length * 1.01)
+        if ppnet.m is None or prototypes_of_wrong_class is None or not ppnet.training:
+            return marginless, marginless
+        wrong_class_margin = prototypes_of_wrong_class[:, start:start + dot.size(1)] * ppnet.m
+        penalized_angles = torch.acos(marginless) - wrong_class_margin[:, :, None, None]
+        return torch.cos(torch.relu(penalized_angles)), marginless
+
+    return deformable_prototype_similarity(x_normalized, offset, normalized_prototypes,
+                                           dilation=dilation, prototype_chunk_size=prototype_chunk_size,
+                                           chunk_fn=to_activations)
+
+
+class FusedPPNet(PPNet):
+    '''
+    PPNet whose cos_activation runs through fused_cos_activation.
+    Defined at module level so checkpoints saved with torch.save stay loadable.
+    '''
+    prototype_chunk_size = None
+
+    def cos_activation(self, x, prototypes_of_wrong_class=None):
+        return fused_cos_activation(self, x, prototypes_of_wrong_class=prototypes_of_wrong_class,
+                                    prototype_chunk_size=self.prototype_chunk_size)
+
+
+def enable_fused_similarity(ppnet, prototype_chunk_size=None, log=print):
+    '''
+    ppnet: the (unwrapped) PPNet; call before enable_activation_checkpointing
+    and before wrapping it in DataParallel
+    '''
+    ppnet.__class__ = FusedPPNet
+    ppnet.prototype_chunk_size = prototype_chunk_size
+    log('fused prototype similarity (prototype chunk size: {0})'.format(prototype_chunk_size))
+    return ppnet
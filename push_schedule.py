@@ -0,0 +1,96 @@
+import time
+
+import torch
+
+
+class PushScheduler:
+    '''
+    Decides, epoch by epoch, whether a push (projection of prototypes onto training
+    patches, followed by a re-test) is worth running, instead of pushing at fixed epochs.
+
+    Two signals are tracked per prototype:
+    - drift: 1 - cosine similarity between the current prototype vector and the
+      vector it was projected to at the last push
+    - similarity gap: 1 - the best (marginless) similarity the prototype reached on
+      any training patch since the last decision; right after a push this is ~0
+    A push runs once the `quantile` of either signal over prototypes exceeds its
+    threshold and at least min_interval epochs passed since the last push, and is
+    forced every max_interval epochs.
+    '''
+    def __init__(self, drift_threshold=0.02, similarity_gap_threshold=0.05, quantile=0.9,
+                 min_interval=5, max_interval=20, baseline_push_epochs=(), log=print):
+        self.drift_threshold = drift_threshold
+        self.similarity_gap_threshold = similarity_gap_threshold
+        self.quantile = quantile
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.baseline_push_epochs = set(baseline_push_epochs)
+        self.log = log
+
+        self.last_pushed_vectors = None
+        self.last_push_epoch = None
+        self.best_similarity = None
+        self.push_durations = []
+        self.skipped_epochs = []
+
+    def update(self, prototype_activations):
+        '''
+        prototype_activations: (B, P) marginless max activations of one batch
+        '''
+        batch_best = prototype_activations.detach().max(dim=0)[0]
+        if self.best_similarity is None:
+            self.best_similarity = batch_best
+        else:
+            self.best_similarity = torch.max(self.best_similarity, batch_best)
+
+    def prototype_drift(self, prototype_vectors):
+        current = prototype_vectors.detach().flatten(start_dim=1)
+        last = self.last_pushed_vectors.to(current.device)
+        return 1 - torch.nn.functional.cosine_similarity(current, last, dim=1)
+
+    def should_push(self, prototype_vectors, epoch):
+        if self.last_push_epoch is None:
+            return True
+        epochs_since_push = epoch - self.last_push_epoch
+        if epochs_since_push >= self.max_interval:
+            self.log('\tpush forced: {0} epochs since the last push'.format(epochs_since_push))
+            return True
+
+        drift = torch.quantile(self.prototype_drift(prototype_vectors).float(), self.quantile).item()
+        if self.best_similarity is not None:
+            similarity_gap = torch.quantile(1 - self.best_similarity.float(), self.quantile).item()
+        else:
+            similarity_gap = 0.
+        self.best_similarity = None
+        self.log('\tprototype drift ({0:.0%} quantile): {1:.4f}, best-match similarity gap: {2:.4f}'.format(
+            self.quantile, drift, similarity_gap))
+
+        if epochs_since_push >= self.min_interval and \
+                (drift > self.drift_threshold or similarity_gap > self.similarity_gap_threshold):
+            return True
+        if epoch in self.baseline_push_epochs:
+            self.skipped_epochs.append(epoch)
+            self.log('\tpush skipped at epoch {0}, estimated time saved: {1:.1f}s'.format(
+                epoch, self.mean_push_duration()))
+        return False
+
+    def record_push(self, prototype_vectors, epoch, start_time):
+        '''
+        Call right after a push (and its re-test) finished; start_time is the
+        time.time() taken just before it began.
+        '''
+        self.push_durations.append(time.time() - start_time)
+        self.last_pushed_vectors = prototype_vectors.detach().flatten(start_dim=1).cpu().clone()
+        self.last_push_epoch = epoch
+        self.best_similarity = None
+
+    def mean_push_duration(self):
+        if not self.push_durations:
+            return 0.
+        return sum(self.push_durations) / len(self.push_durations)
+
+    def log_summary(self):
+        n_pushes = len(self.push_durations)
+        saved = (len(self.baseline_push_epochs) - n_pushes) * self.mean_push_duration()
+        self.log('adaptive push: {0} pushes, skipped scheduled pushes at epochs {1}, '
+                 'estimated wall time saved: {2:.1f}s'.format(n_pushes, self.skipped_epochs, saved))
@@ -0,0 +1,159 @@
+"""
+The settings object behind config.py.
+
+Every setting has a default in config.py. On first access, defaults are overridden by
+  1. a settings file named by $PPNET_CONFIG: a .json object or a .py file of assignments
+     (like config.py itself, holding only the settings that change),
+  2. environment variables PPNET_<SETTING NAME IN UPPER CASE>, e.g. PPNET_NUM_TRAIN_EPOCHS=50,
+and scripts apply their command-line overrides on top of both:
+  python3 main.py -config=oct_local.py -set num_train_epochs=50 -set coefs.sep=0.1
+Values are Python literals; anything that does not parse as one is taken as a string,
+so -set data_path=/data/OCT2017/ works unquoted. 'name.key' sets one entry of a dict.
+
+Settings defined with @derived are computed from the others when read (unless they are
+overridden themselves), so that e.g. overriding data_path also moves train_dir.
+"""
+import os
+import ast
+import json
+import types
+
+ENV_PREFIX = 'PPNET_'
+
+
+class Derived:
+    def __init__(self, fn):
+        self.fn = fn
+        self.__doc__ = fn.__doc__
+
+
+def derived(fn):
+    '''
+    Marks a config.py function fn(settings) as a setting computed from other settings.
+    '''
+    return Derived(fn)
+
+
+def public_settings(namespace):
+    '''
+    The settings in a module namespace: every public name that is not a module,
+    function or class (values and @derived settings).
+    '''
+    return {name: value for name, value in namespace.items()
+            if not name.startswith('_')
+            and not isinstance(value, (types.ModuleType, types.FunctionType, types.BuiltinFunctionType, type))}
+
+
+def parse_value(text):
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+class Settings:
+    '''
+    Read-only attribute access to the settings, with explicit override layers:
+    defaults < settings file < environment < override() (command line, callers).
+    Creating and importing it does no I/O; the file and the environment are read on
+    the first attribute access.
+    '''
+    def __init__(self, defaults, environ=None):
+        self._defaults = dict(defaults)
+        self._environ = environ
+        self._loaded = None
+        self._cache = {}
+        self.overrides = {}
+
+    @classmethod
+    def from_namespace(cls, namespace):
+        '''
+        Settings from a module namespace (see public_settings).
+        '''
+        return cls(public_settings(namespace))
+
+    def names(self):
+        return list(self._defaults)
+
+    def _layers(self):
+        if self._loaded is None:
+            environ = os.environ if self._environ is None else self._environ
+            loaded = {}
+            if environ.get(ENV_PREFIX + 'CONFIG'):
+                loaded.update(self._read_file(environ[ENV_PREFIX + 'CONFIG']))
+            for name in self._defaults:
+                if ENV_PREFIX + name.upper() in environ:
+                    loaded[name] = parse_value(environ[ENV_PREFIX + name.upper()])
+            self._check_names(loaded)
+            self._loaded = loaded
+        return self._loaded, self.overrides
+
+    def _check_names(self, values):
+        unknown = sorted(set(name.split('.')[0] for name in values) - set(self._defaults))
+        if unknown:
+            raise KeyError('unknown settings: {0}'.format(', '.join(unknown)))
+
+    @staticmethod
+    def _read_file(path):
+        if path.endswith('.json'):
+            with open(path) as f:
+                return json.load(f)
+        namespace = {}
+        with open(path) as f:
+            exec(compile(f.read(), path, 'exec'), namespace)
+        return public_settings(namespace)
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._defaults:
+            raise AttributeError('no setting named {0!r}'.format(name))
+        if name in self._cache:
+            return self._cache[name]
+        value = self._defaults[name]
+        for layer in self._layers():
+            if name in layer:
+                value = layer[name]
+            for key in layer:
+                if key.startswith(name + '.'):
+                    value = dict(value, **{key[len(name) + 1:]: layer[key]})
+        if isinstance(value, Derived):
+            value = value.fn(self)
+        self._cache[name] = value
+        return value
+
+    def override(self, **values):
+        '''
+        Sets settings by name ('name.key' for one entry of a dict setting).
+        '''
+        self._check_names(values)
+        self.overrides.update(values)
+        self._cache.clear()
+
+    def load_file(self, path):
+        self.override(**self._read_file(path))
+
+    def add_arguments(self, parser):
+        parser.add_argument('-config', type=str, default=None,
+                            help='settings file (.py or .json) overriding config.py')
+        parser.add_argument('-set', type=str, action='append', default=[], metavar='NAME=VALUE',
+                            help='override one setting; repeatable')
+
+    def apply_args(self, args):
+        if args.config is not None:
+            self.load_file(args.config)
+        values = {}
+        for assignment in args.set:
+            name, sep, text = assignment.partition('=')
+            if not sep:
+                raise ValueError('-set expects NAME=VALUE, got {0!r}'.format(assignment))
+            values[name.strip()] = parse_value(text.strip())
+        self.override(**values)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self._defaults}
+
+    def save(self, path):
+        '''
+        Writes the resolved settings of a run as JSON.
+        '''
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, default=str)
@@ -0,0 +1,311 @@
+import os
+import io
+import json
+import queue
+import random
+import tarfile
+import argparse
+import threading
+
+import numpy as np
+import torch
+import torch.utils.data
+from PIL import Image
+
+"""
+Packs image folders into large tar shards plus an index, and streams them back.
+
+python3 shards.py -out=/local/or/network/OCT2017-shards/ [-shard_size_mb=256]
+
+writes <out>/<split>/shard-<k>.tar and <out>/<split>/index.json for the train, push,
+val and test splits of config.py. Only the train split is shuffled when packing; the
+others keep ImageFolder order, so push records index the same images either way. Each tar member is the original encoded image file;
+the index holds the classes and, per sample, (original path, label, shard, byte offset
+of the data in the shard, size), so readers never list directories or open small files.
+"""
+
+TAR_BLOCK = 512
+
+
+def pack_image_folder(image_dir, out_dir, shard_size_bytes=256 * 2**20, deduplicate=False, shuffle=False, seed=1,
+                      log=print):
+    '''
+    Writes an ImageFolder into tar shards of about shard_size_bytes, in ImageFolder order,
+    so that sample i of the index is sample i of the (deduplicated) ImageFolder and push
+    records stay valid for either. shuffle=True (training sets) shuffles the samples
+    (seeded) before packing instead, so that every shard mixes all classes.
+    '''
+    import torchvision.datasets as datasets
+    from data import deduplicate_samples
+
+    dataset = datasets.ImageFolder(image_dir)
+    if deduplicate:
+        deduplicate_samples(dataset, log=log)
+    samples = list(dataset.samples)
+    if shuffle:
+        random.Random(seed).shuffle(samples)
+
+    os.makedirs(out_dir, exist_ok=True)
+    shards, entries = [], []
+    tar = None
+    for path, label in samples:
+        if tar is None or tar.offset >= shard_size_bytes:
+            if tar is not None:
+                tar.close()
+            shards.append('shard-{0:05d}.tar'.format(len(shards)))
+            tar = tarfile.open(os.path.join(out_dir, shards[-1]), 'w', format=tarfile.USTAR_FORMAT)
+        size = os.path.getsize(path)
+        info = tarfile.TarInfo('{0:08d}{1}'.format(len(entries), os.path.splitext(path)[1]))
+        info.size = size
+        with open(path, 'rb') as f:
+            tar.addfile(info, f)
+        # the data starts right after its header and is padded to whole blocks
+        data_offset = tar.offset - (size + TAR_BLOCK - 1) // TAR_BLOCK * TAR_BLOCK
+        entries.append([path, label, len(shards) - 1, data_offset, size])
+    if tar is not None:
+        tar.close()
+
+    with open(os.path.join(out_dir, 'index.json'), 'w') as f:
+        json.dump({'root': image_dir, 'classes': dataset.classes, 'shards': shards, 'samples': entries}, f)
+    log('packed {0} images of {1} into {2} shards in {3}'.format(len(entries), image_dir, len(shards), out_dir))
+
+
+def _rank_and_world_size():
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return int(os.environ.get('RANK', 0)), int(os.environ.get('WORLD_SIZE', 1))
+
+
+class ShardedImageDataset(torch.utils.data.IterableDataset):
+    '''
+    Streams a pack_image_folder directory.
+
+    shuffle=True (training): the shard order is reshuffled every epoch and split over
+    ranks and DataLoader workers. Every shard is read sequentially in chunks of about
+    chunk_bytes (taken in random order) by a background thread up to read_ahead chunks
+    ahead, and the samples of each chunk are yielded in random order; the training split
+    is shuffled when packed, so every chunk already mixes all classes. Each worker holds
+    at most (read_ahead + 1) chunks of raw data (96MB by default). With balanced=True every sample is yielded a Poisson-distributed
+    number of times so that classes are drawn equally often and an epoch holds about
+    epoch_size samples (the streaming counterpart of data.class_balanced_sampler).
+
+    shuffle=False (evaluation, push): samples come in index order. Batch b is read, as
+    one byte range, by worker b % (number of workers), so the DataLoader's round-robin
+    over workers returns full batches in exactly this order; batch_size must match the
+    DataLoader's. Ranks split the batches the same way.
+
+    samples, targets, classes and class_to_idx mirror ImageFolder's.
+    '''
+    def __init__(self, shard_dir, transform=None, shuffle=False, batch_size=1, balanced=False, epoch_size=None,
+                 read_ahead=2, chunk_bytes=32 * 2**20, seed=1):
+        with open(os.path.join(shard_dir, 'index.json')) as f:
+            index = json.load(f)
+        self.shard_dir = shard_dir
+        self.root = index['root']
+        self.classes = index['classes']
+        self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+        self.shards = index['shards']
+        entries = index['samples']
+        self.samples = [(path, label) for path, label, _, _, _ in entries]
+        self.targets = [label for _, label in self.samples]
+        self.locations = np.array([[shard, offset, size] for _, _, shard, offset, size in entries], dtype=np.int64)
+        self.locations = self.locations.reshape(-1, 3)
+        self.shard_bytes = np.zeros(len(self.shards), dtype=np.int64)
+        np.maximum.at(self.shard_bytes, self.locations[:, 0], self.locations[:, 1] + self.locations[:, 2])
+        self.transform = transform
+        self.shuffle = shuffle
+        self.batch_size = batch_size
+        self.balanced = balanced
+        self.epoch_size = epoch_size or len(self.samples)
+        self.read_ahead = read_ahead
+        self.chunk_bytes = chunk_bytes
+        self.seed = seed
+        self.epoch = 0
+        # index order is only reproduced by the loader when nothing is shuffled or split by rank
+        self.ordered = not shuffle and _rank_and_world_size()[1] == 1
+
+    def worker_buffer_bytes(self):
+        '''
+        Upper bound of the raw shard data one DataLoader worker holds: the chunk being
+        decoded plus read_ahead queued ones when shuffling, whole batches otherwise.
+        '''
+        if self.shuffle:
+            chunk_bytes = max(self.chunk_bytes, int(self.locations[:, 2].max(initial=0)))
+            return (self.read_ahead + 1) * min(chunk_bytes, int(self.shard_bytes.max(initial=0)))
+        return (self.read_ahead + 1) * self.batch_size * int(self.locations[:, 2].max(initial=0))
+
+    def __len__(self):
+        rank, world_size = _rank_and_world_size()
+        if self.shuffle:
+            n = self.epoch_size if self.balanced else len(self.samples)
+            return n // world_size
+        n_batches = (len(self.samples) + self.batch_size - 1) // self.batch_size
+        my_batches = range(rank, n_batches, world_size)
+        return sum(min(self.batch_size, len(self.samples) - b * self.batch_size) for b in my_batches)
+
+    def _worker_split(self):
+        rank, world_size = _rank_and_world_size()
+        worker_info = torch.utils.data.get_worker_info()
+        n_workers = worker_info.num_workers if worker_info is not None else 1
+        worker_id = worker_info.id if worker_info is not None else 0
+        # the base seed is shared by all workers of one DataLoader iterator and changes every epoch
+        base_seed = worker_info.seed - worker_info.id if worker_info is not None else 0
+        return rank * n_workers + worker_id, world_size * n_workers, base_seed
+
+    def _decode(self, data, label):
+        image = Image.open(io.BytesIO(data)).convert('RGB')
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, label
+
+    def _read_ahead(self, reads):
+        '''
+        Runs reads (a generator of byte blobs) in a background thread, at most
+        read_ahead blobs ahead of the consumer.
+        '''
+        blobs = queue.Queue(maxsize=self.read_ahead)
+        stop = threading.Event()
+        done = object()
+
+        def producer():
+            try:
+                for blob in reads:
+                    while not stop.is_set():
+                        try:
+                            blobs.put(blob, timeout=0.1)
+                            break
+                        except queue.Full:
+                            continue
+                    if stop.is_set():
+                        return
+                blobs.put(done)
+            except Exception as e:
+                blobs.put(e)
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        try:
+            while True:
+                blob = blobs.get()
+                if blob is done:
+                    return
+                if isinstance(blob, Exception):
+                    raise blob
+                yield blob
+        finally:
+            stop.set()
+
+    def _read_range(self, shard, start, end):
+        with open(os.path.join(self.shard_dir, self.shards[shard]), 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def _chunks(self, indices):
+        '''
+        Splits sample indices, in shard order, into runs spanning at most chunk_bytes
+        (or one sample, if that is larger).
+        '''
+        chunks, start = [], 0
+        for end in range(1, len(indices) + 1):
+            if end == len(indices) or self.locations[indices[end], 1] + self.locations[indices[end], 2] \
+                    - self.locations[indices[start], 1] > self.chunk_bytes:
+                chunks.append(indices[start:end])
+                start = end
+        return chunks
+
+    def _iter_shuffled(self, global_id, n_global, base_seed):
+        # in DataLoader workers base_seed alone changes every epoch (their copy of the
+        # dataset, and its epoch, does not outlive the iterator); only loading in the
+        # main process relies on the epoch counter
+        if torch.utils.data.get_worker_info() is None:
+            self.epoch += 1
+        rng = np.random.default_rng([self.seed, base_seed, self.epoch])
+        shard_order = rng.permutation(len(self.shards))
+        if len(self.shards) >= n_global:
+            my_shards = shard_order[global_id::n_global]
+            keep = None
+        else:
+            # fewer shards than readers: everyone reads every shard and keeps a stride of it
+            my_shards = shard_order
+            keep = global_id
+
+        expected = None
+        if self.balanced:
+            targets = np.asarray(self.targets)
+            weights = 1.0 / np.bincount(targets)[targets]
+            expected = self.epoch_size * weights / weights.sum()
+
+        # the read plan is fixed here so that the reader thread does not touch rng
+        plan = []
+        for shard in my_shards:
+            indices = np.nonzero(self.locations[:, 0] == shard)[0]
+            indices = indices[np.argsort(self.locations[indices, 1], kind='stable')]
+            if keep is not None:
+                indices = indices[keep::n_global]
+            chunks = self._chunks(indices)
+            plan.extend((shard, chunks[c]) for c in rng.permutation(len(chunks)))
+
+        def reads():
+            for shard, indices in plan:
+                start = self.locations[indices[0], 1]
+                end = self.locations[indices[-1], 1] + self.locations[indices[-1], 2]
+                yield indices, start, self._read_range(shard, start, end)
+
+        for indices, start, data in self._read_ahead(reads()):
+            if expected is not None:
+                indices = np.repeat(indices, rng.poisson(expected[indices]))
+            for i in rng.permutation(indices):
+                _, offset, size = self.locations[i]
+                yield self._decode(data[offset - start:offset - start + size], self.targets[i])
+
+    def _iter_ordered(self, global_id, n_global):
+        n_batches = (len(self.samples) + self.batch_size - 1) // self.batch_size
+        my_batches = range(global_id, n_batches, n_global)
+
+        def reads():
+            for b in my_batches:
+                indices = np.arange(b * self.batch_size, min((b + 1) * self.batch_size, len(self.samples)))
+                pieces = []
+                # consecutive samples of one shard are one contiguous byte range
+                for shard in np.unique(self.locations[indices, 0]):
+                    run = indices[self.locations[indices, 0] == shard]
+                    start = self.locations[run, 1].min()
+                    end = (self.locations[run, 1] + self.locations[run, 2]).max()
+                    pieces.append((run, start, self._read_range(shard, start, end)))
+                yield pieces
+
+        for pieces in self._read_ahead(reads()):
+            decoded = {}
+            for run, start, data in pieces:
+                for i in run:
+                    _, offset, size = self.locations[i]
+                    decoded[i] = self._decode(data[offset - start:offset - start + size], self.targets[i])
+            for i in sorted(decoded):
+                yield decoded[i]
+
+    def __iter__(self):
+        global_id, n_global, base_seed = self._worker_split()
+        if self.shuffle:
+            return self._iter_shuffled(global_id, n_global, base_seed)
+        return self._iter_ordered(global_id, n_global)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-out', type=str, required=True)
+    parser.add_argument('-splits', type=str, nargs='+', default=['train', 'push', 'val', 'test'])
+    parser.add_argument('-shard_size_mb', type=int, default=256)
+    from config import settings
+    settings.add_arguments(parser)
+    args = parser.parse_args()
+    settings.apply_args(args)
+
+    from config import train_dir, train_push_dir, val_dir, test_dir, deduplicate_eval_sets
+    split_dirs = {'train': train_dir, 'push': train_push_dir, 'val': val_dir, 'test': test_dir}
+    for split in args.splits:
+        pack_image_folder(split_dirs[split], os.path.join(args.out, split),
+                          shard_size_bytes=args.shard_size_mb * 2**20,
+                          deduplicate=deduplicate_eval_sets and split != 'train', shuffle=split == 'train')
+
+if __name__ == "__main__":
+    main()
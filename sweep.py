@@ -0,0 +1,216 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+"""
+Runs many main.run() trainings in parallel, sharing one decoded copy of the images
+and stopping the worst trials early (successive halving).
+
+python3 sweep.py -spec=sweep.json -devices=0,1 -trials_per_device=2
+
+sweep.json:
+{
+    "name": "margin",
+    "grid": {"m": [0.05, 0.1, 0.2], "coefs.clst": [-0.8, -0.5]},
+    "random": {"joint_optimizer_lrs.prototype_vectors": {"loguniform": [1e-4, 1e-2]},
+               "topk_k": {"choice": [1, 3]}},
+    "n_random": 4,
+    "eta": 2,
+    "rungs": [9, 19, 39]
+}
+
+Every grid point is crossed with n_random random draws (either part is optional).
+Keys are main.DEFAULT_HPARAMS names, num_prototypes, or "<dict>.<key>" for the
+coefs and optimizer lr dicts of config.py. rungs defaults to the last warm epoch.
+"""
+
+
+class SuccessiveHalving:
+    '''
+    Asynchronous successive halving: at every rung epoch a trial only continues if
+    its accuracy is in the top 1/eta of the accuracies reported at that rung so far.
+    The first eta - 1 reports of a rung always continue, so early trials are not
+    stopped for lack of comparison. State lives in a multiprocessing.Manager so that
+    report() can be called from the trial processes.
+    '''
+    def __init__(self, manager, rungs, eta=2):
+        self.rungs = sorted(rungs)
+        self.eta = eta
+        self.reports = manager.dict({rung: manager.list() for rung in self.rungs})
+        self.lock = manager.Lock()
+
+    def report(self, trial_id, epoch, accu):
+        if epoch not in self.rungs:
+            return True
+        with self.lock:
+            reports = self.reports[epoch]
+            reports.append(accu)
+            accuracies = sorted(reports, reverse=True)
+        if len(accuracies) < self.eta:
+            return True
+        n_continue = max(1, int(math.ceil(len(accuracies) / self.eta)))
+        return accu >= accuracies[n_continue - 1]
+
+
+def _set_nested(hparams, key, value):
+    if '.' in key:
+        group, name = key.split('.', 1)
+        hparams.setdefault(group, {})[name] = value
+    else:
+        hparams[key] = value
+
+
+def _draw(distribution, rng):
+    kind, values = next(iter(distribution.items()))
+    if kind == 'uniform':
+        return rng.uniform(*values)
+    if kind == 'loguniform':
+        return math.exp(rng.uniform(math.log(values[0]), math.log(values[1])))
+    if kind == 'choice':
+        return rng.choice(values)
+    raise ValueError('unknown distribution {0}'.format(kind))
+
+
+def expand_spec(spec, seed=1):
+    '''
+    List of hparams dicts (as taken by main.run) for a sweep spec.
+    '''
+    rng = random.Random(seed)
+    grid = spec.get('grid', {})
+    points = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+    n_random = spec.get('n_random', 1) if spec.get('random') else 1
+    trials = []
+    for point in points:
+        for _ in range(n_random):
+            flat = dict(point)
+            for key, distribution in spec.get('random', {}).items():
+                flat[key] = _draw(distribution, rng)
+            hparams = {}
+            for key, value in flat.items():
+                _set_nested(hparams, key, value)
+            trials.append(hparams)
+    return trials
+
+
+def _run_trial(trial_id, hparams, experiment_run, dataset_cache_dir, devices, scheduler, setting_overrides=None):
+    import main
+    from config import settings
+    # spawned workers start from config.py, the settings file and the environment only
+    settings.override(**(setting_overrides or {}))
+
+    device = devices.get()
+    try:
+        start = time.time()
+        stopped = []
+
+        def report_epoch(epoch, accu):
+            if scheduler.report(trial_id, epoch, accu):
+                return True
+            stopped.append(epoch)
+            return False
+
+        best_accu = main.run(gpuid=device, hparams=hparams, experiment_run=experiment_run,
+                             dataset_cache_dir=dataset_cache_dir, report_epoch=report_epoch)
+        return {'trial': trial_id, 'experiment_run': experiment_run, 'hparams': hparams, 'device': device,
+                'best_accu': best_accu, 'stopped_at_epoch': stopped[0] if stopped else None,
+                'seconds': time.time() - start}
+    finally:
+        devices.put(device)
+
+
+def _run_trial_in_fresh_process(context, *trial_args):
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(_run_trial, *trial_args).result()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-spec', type=str, required=True)
+    parser.add_argument('-devices', type=str, default='0')
+    parser.add_argument('-trials_per_device', type=int, default=1)
+    parser.add_argument('-cache_dir', type=str, default='./dataset_cache/')
+    parser.add_argument('-seed', type=int, default=1)
+    from config import settings
+    settings.add_arguments(parser)
+    args = parser.parse_args()
+    settings.apply_args(args)
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+    name = spec.get('name', os.path.splitext(os.path.basename(args.spec))[0])
+    trials = expand_spec(spec, seed=args.seed)
+
+    from config import img_size, train_dir, train_push_dir, val_dir, deduplicate_eval_sets, \
+                       num_warm_epochs, num_secondary_warm_epochs
+    from data import build_image_cache
+    # decode the images once here; every trial maps the same arrays
+    build_image_cache(train_dir, os.path.join(args.cache_dir, 'train'), img_size)
+    build_image_cache(train_push_dir, os.path.join(args.cache_dir, 'push'), img_size,
+                      deduplicate=deduplicate_eval_sets)
+    build_image_cache(val_dir, os.path.join(args.cache_dir, 'val'), img_size,
+                      deduplicate=deduplicate_eval_sets)
+
+    rungs = spec.get('rungs', [num_warm_epochs + num_secondary_warm_epochs - 1])
+    devices = [d.strip() for d in args.devices.split(',') if d.strip()]
+    n_workers = len(devices) * args.trials_per_device
+    print('sweep {0}: {1} trials on devices {2}, {3} at a time, halving (eta={4}) at epochs {5}'.format(
+        name, len(trials), devices, n_workers, spec.get('eta', 2), rungs))
+
+    context = multiprocessing.get_context('spawn')
+    with context.Manager() as manager:
+        scheduler = SuccessiveHalving(manager, rungs, eta=spec.get('eta', 2))
+        device_slots = manager.Queue()
+        for device in devices * args.trials_per_device:
+            device_slots.put(device)
+
+        results, failures = [], []
+        # main.run picks its GPU through CUDA_VISIBLE_DEVICES, which only takes effect before
+        # CUDA is initialized in a process, so every trial gets a fresh worker process
+        if sys.version_info >= (3, 11):
+            executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=context, max_tasks_per_child=1)
+            run_trial = (_run_trial,)
+        else:
+            # no max_tasks_per_child before Python 3.11: a single-use process pool per trial
+            executor = ThreadPoolExecutor(max_workers=n_workers)
+            run_trial = (_run_trial_in_fresh_process, context)
+        with executor:
+            # trials size their loader worker pools for their share of the host only
+            trial_overrides = dict(settings.overrides, concurrent_runs=n_workers)
+            futures = {executor.submit(*run_trial, i, hparams, 'sweep-{0}-{1}'.format(name, i),
+                                       args.cache_dir, device_slots, scheduler, trial_overrides): (i, hparams)
+                       for i, hparams in enumerate(trials)}
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    trial_id, hparams = futures[future]
+                    failures.append({'trial': trial_id, 'hparams': hparams, 'error': repr(e)})
+                    print('trial {0} ({1}) failed: {2!r}'.format(trial_id, json.dumps(hparams), e))
+                    continue
+                results.append(result)
+                print('trial {0} ({1}) finished on device {2}: best accuracy {3:.4f}{4}, {5:.0f}s'.format(
+                    result['trial'], json.dumps(result['hparams']), result['device'], result['best_accu'],
+                    '' if result['stopped_at_epoch'] is None
+                    else ', stopped at epoch {0}'.format(result['stopped_at_epoch']),
+                    result['seconds']))
+
+    results.sort(key=lambda r: r['best_accu'], reverse=True)
+    results_path = 'sweep-{0}.json'.format(name)
+    with open(results_path, 'w') as f:
+        json.dump(results + failures, f, indent=2)
+    if not results:
+        print('no trial finished ({0} failed); failures in {1}'.format(len(failures), results_path))
+        return
+    print('best trial {0}: {1} (accuracy {2:.4f}), {3} failed; all results in {4}'.format(
+        results[0]['trial'], json.dumps(results[0]['hparams']), results[0]['best_accu'], len(failures),
+        results_path))
+
+if __name__ == "__main__":
+    main()
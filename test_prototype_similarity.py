@@ -0,0 +1,95 @@
+'''
+CPU check of fused_cos_activation against a direct torchvision deform_conv2d
+formulation of PPNet.cos_activation, on random tensors (no GPU or checkpoint needed):
+
+python3 -m pytest -q test_prototype_similarity.py
+'''
+import pytest
+
+torch = pytest.importorskip('torch')
+ops = pytest.importorskip('torchvision.ops')
+prototype_similarity = pytest.importorskip('prototype_similarity')
+
+
+class TinyPPNet(torch.nn.Module):
+    '''
+    The attributes of PPNet that cos_activation reads, at a tiny size.
+    '''
+    def __init__(self, n_channels=6, n_prototypes=7, kernel_size=3, dilation=2, n_eps_channels=2, m=0.1):
+        super().__init__()
+        self.epsilon_val = 0.05
+        self.n_eps_channels = n_eps_channels
+        self.input_vector_length = 64.
+        self.m = m
+        self.prototype_dilation = dilation
+        self.prototype_shape = (n_prototypes, n_channels + n_eps_channels, kernel_size, kernel_size)
+        self.prototype_vectors = torch.nn.Parameter(torch.rand(self.prototype_shape, dtype=torch.float64))
+        self.conv_offset = torch.nn.Conv2d(n_channels + n_eps_channels, 2 * kernel_size * kernel_size,
+                                           kernel_size, padding=1).double()
+        # offsets of a few latent cells, so that sampling is fractional and partly off the map
+        torch.nn.init.normal_(self.conv_offset.weight, std=0.5)
+
+
+def reference_cos_activation(ppnet, x, prototypes_of_wrong_class=None):
+    '''
+    cos_activation written out the way PPNet computes it: concatenated epsilon channels,
+    normalization, deformable convolution with the normalized prototypes, margin.
+    '''
+    _, _, kh, kw = ppnet.prototype_shape
+    normalizing_factor = (kh * kw)**0.5
+    epsilon_channels = torch.full((x.size(0), ppnet.n_eps_channels) + x.shape[2:], ppnet.epsilon_val,
+                                  dtype=x.dtype)
+    x = torch.cat((x, epsilon_channels), dim=1)
+    x_length = torch.sqrt(torch.sum(x**2, dim=1, keepdim=True) + ppnet.epsilon_val)
+    x_normalized = ppnet.input_vector_length * x / x_length / normalizing_factor
+    offset = ppnet.conv_offset(x_normalized)
+    prototype_length = torch.sqrt(torch.sum(ppnet.prototype_vectors**2, dim=1, keepdim=True) + ppnet.epsilon_val)
+    prototypes = ppnet.prototype_vectors / ((prototype_length + ppnet.epsilon_val) * normalizing_factor)
+    dilation = ppnet.prototype_dilation
+    dot = ops.deform_conv2d(x_normalized, offset, prototypes, padding=(dilation * (kh - 1) // 2,) * 2,
+                            dilation=(dilation, dilation))
+    marginless = dot / (ppnet.input_vector_length * 1.01)
+    if prototypes_of_wrong_class is None or not ppnet.training:
+        return marginless, marginless
+    penalized_angles = torch.acos(marginless) - (prototypes_of_wrong_class * ppnet.m)[:, :, None, None]
+    return torch.cos(torch.relu(penalized_angles)), marginless
+
+
+def outputs_and_grads(ppnet, cos_activation, x, prototypes_of_wrong_class):
+    x = x.detach().clone().requires_grad_()
+    activations, marginless = cos_activation(ppnet, x, prototypes_of_wrong_class=prototypes_of_wrong_class)
+    loss = activations.pow(2).sum() + marginless.pow(2).sum()
+    grads = torch.autograd.grad(loss, [x, ppnet.prototype_vectors] + list(ppnet.conv_offset.parameters()))
+    return [activations.detach(), marginless.detach()] + list(grads)
+
+
+@pytest.mark.parametrize('training', [True, False])
+@pytest.mark.parametrize('with_margin', [True, False])
+@pytest.mark.parametrize('prototype_chunk_size', [None, 3])
+def test_fused_cos_activation_matches_reference(training, with_margin, prototype_chunk_size):
+    torch.manual_seed(0)
+    ppnet = TinyPPNet().train(training)
+    x = torch.randn(2, 6, 5, 6, dtype=torch.float64)
+    wrong_class = (torch.rand(2, ppnet.prototype_shape[0]) > 0.5).double() if with_margin else None
+
+    def fused(ppnet, x, prototypes_of_wrong_class=None):
+        return prototype_similarity.fused_cos_activation(ppnet, x, prototypes_of_wrong_class=prototypes_of_wrong_class,
+                                                         prototype_chunk_size=prototype_chunk_size)
+
+    expected = outputs_and_grads(ppnet, reference_cos_activation, x, wrong_class)
+    actual = outputs_and_grads(ppnet, fused, x, wrong_class)
+    names = ['activations', 'marginless activations', 'grad x', 'grad prototypes', 'grad offset weight',
+             'grad offset bias']
+    for name, e, a in zip(names, expected, actual):
+        torch.testing.assert_close(a, e, rtol=1e-6, atol=1e-8, msg='{0} differ'.format(name))
+
+
+def test_margin_is_off_in_eval_mode():
+    torch.manual_seed(0)
+    ppnet = TinyPPNet().eval()
+    x = torch.randn(2, 6, 5, 6, dtype=torch.float64)
+    wrong_class = torch.ones(2, ppnet.prototype_shape[0], dtype=torch.float64)
+    with torch.no_grad():
+        with_mask = prototype_similarity.fused_cos_activation(ppnet, x, prototypes_of_wrong_class=wrong_class)
+        without_mask = prototype_similarity.fused_cos_activation(ppnet, x)
+    torch.testing.assert_close(with_mask[0], without_mask[0])
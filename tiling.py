@@ -0,0 +1,161 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+from prototype_similarity import normalize_input
+
+
+def collate_images(batch):
+    '''
+    collate_fn for full-resolution images of different sizes: returns the images as
+    a list of (C, H, W) tensors and the labels as one tensor.
+    '''
+    images, labels = zip(*batch)
+    return list(images), torch.as_tensor(labels)
+
+
+def _tile_starts(n_cells, tile_cells, step_cells):
+    '''
+    Latent start positions of the tiles along one axis; the last tile ends at or
+    just after n_cells.
+    '''
+    last = max(n_cells - tile_cells, 0)
+    starts = list(range(0, last, step_cells))
+    starts.append(last)
+    return starts
+
+
+def _owned_ranges(starts, tile_cells):
+    '''
+    Splits the overlap between neighbouring tiles at its midpoint, so every latent
+    location is taken from the tile in which it lies furthest from the border.
+    '''
+    ranges = []
+    for i, start in enumerate(starts):
+        begin = start if i == 0 else (start + starts[i - 1] + tile_cells) // 2
+        end = start + tile_cells if i == len(starts) - 1 else (starts[i + 1] + start + tile_cells) // 2
+        ranges.append((begin, end))
+    return ranges
+
+
+class Tiler:
+    '''
+    Full-resolution inference by overlapping tiles of the size the model was trained on.
+
+    Every image is cut into tile_size x tile_size tiles overlapping by about `overlap`
+    pixels (rounded to whole latent cells, so tiles line up with the feature grid;
+    the right/bottom border is replicate-padded by less than one cell). Tiles of all
+    images in a batch are forwarded together, tile_batch_size at a time. Per tile the
+    prototype activations are pooled as in PPNet.forward (top-k mean, and max for the
+    marginless activations), the per-prototype values are maxed over the tiles of an
+    image, and only then go through the last layer.
+
+    Runs on the unwrapped PPNet, i.e. on a single device.
+    '''
+    def __init__(self, tile_size=224, overlap=64, tile_batch_size=64):
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.tile_batch_size = tile_batch_size
+        self._feature_stride = {}
+
+    def feature_stride(self, ppnet, device):
+        '''
+        Pixels per latent cell of the model at tile_size (probed once per model).
+        '''
+        if id(ppnet) not in self._feature_stride:
+            with torch.no_grad():
+                probe = ppnet.conv_features(torch.zeros(1, 3, self.tile_size, self.tile_size, device=device))
+            self._feature_stride[id(ppnet)] = (self.tile_size // probe.size(2), probe.size(2))
+        return self._feature_stride[id(ppnet)]
+
+    def layout(self, height, width, stride, tile_cells):
+        '''
+        (latent height, latent width, row starts, column starts) of one image, with
+        the starts in latent cells.
+        '''
+        step_cells = max(1, tile_cells - int(round(self.overlap / stride)))
+        n_rows, n_cols = math.ceil(height / stride), math.ceil(width / stride)
+        return n_rows, n_cols, _tile_starts(n_rows, tile_cells, step_cells), \
+            _tile_starts(n_cols, tile_cells, step_cells)
+
+    def _tiles(self, images, stride, tile_cells):
+        tiles, layouts = [], []
+        for index, image in enumerate(images):
+            n_rows, n_cols, row_starts, col_starts = self.layout(image.size(1), image.size(2), stride, tile_cells)
+            pad_bottom = max(0, (row_starts[-1] + tile_cells) * stride - image.size(1))
+            pad_right = max(0, (col_starts[-1] + tile_cells) * stride - image.size(2))
+            if pad_bottom or pad_right:
+                image = F.pad(image.unsqueeze(0), (0, pad_right, 0, pad_bottom), mode='replicate')[0]
+            for row in row_starts:
+                for col in col_starts:
+                    tiles.append((index, row, col, image[:, row * stride:row * stride + self.tile_size,
+                                                         col * stride:col * stride + self.tile_size]))
+            layouts.append((n_rows, n_cols, row_starts, col_starts))
+        return tiles, layouts
+
+    def __call__(self, ppnet, images, prototypes_of_wrong_class=None, return_maps=False):
+        '''
+        images: list of normalized (C, H, W) tensors, on the model's device
+        prototypes_of_wrong_class: (B, P) margin mask, as passed to PPNet.forward
+        return_maps: also return, per image, the stitched (P, H', W') marginless
+            activation map and (2 * kh * kw, H', W') offsets, H' = ceil(H / stride)
+        Returns (logits, [activations, marginless_logits, None, marginless_max_activations]
+        (+ [activation_maps, offset_maps] with return_maps)), mirroring PPNet.forward.
+        '''
+        device = images[0].device
+        stride, tile_cells = self.feature_stride(ppnet, device)
+        tiles, layouts = self._tiles(images, stride, tile_cells)
+        normalizing_factor = (ppnet.prototype_shape[-2] * ppnet.prototype_shape[-1])**0.5
+
+        tile_activations, tile_marginless = [], []
+        if return_maps:
+            activation_maps, offset_maps = [None] * len(images), [None] * len(images)
+        for start in range(0, len(tiles), self.tile_batch_size):
+            chunk = tiles[start:start + self.tile_batch_size]
+            tile_images = torch.stack([tile for _, _, _, tile in chunk])
+            image_indices = torch.tensor([index for index, _, _, _ in chunk], device=device)
+            mask = prototypes_of_wrong_class[image_indices] if prototypes_of_wrong_class is not None else None
+
+            conv_features = ppnet.conv_features(tile_images)
+            activations, marginless_activations = ppnet.cos_activation(conv_features, prototypes_of_wrong_class=mask)
+            topk_activations = torch.topk(activations.flatten(start_dim=2), ppnet.topk_k, dim=-1)[0]
+            tile_activations.append(topk_activations.mean(dim=-1))
+            tile_marginless.append(marginless_activations.flatten(start_dim=2).max(dim=-1)[0])
+
+            if return_maps:
+                x_normalized = normalize_input(conv_features, ppnet.epsilon_val, ppnet.n_eps_channels,
+                                               ppnet.input_vector_length, normalizing_factor,
+                                               length_epsilon=ppnet.epsilon_val)
+                offsets = ppnet.conv_offset(x_normalized)
+                for (index, row, col, _), activation_map, offset in zip(chunk, marginless_activations, offsets):
+                    self._stitch(activation_maps, offset_maps, layouts, tile_cells, index, row, col,
+                                 activation_map, offset)
+
+        tile_image_index = torch.tensor([index for index, _, _, _ in tiles], device=device)
+        tile_activations = torch.cat(tile_activations)
+        tile_marginless = torch.cat(tile_marginless)
+        max_activations = torch.stack([tile_activations[tile_image_index == i].max(dim=0)[0]
+                                       for i in range(len(images))])
+        marginless_max_activations = torch.stack([tile_marginless[tile_image_index == i].max(dim=0)[0]
+                                                  for i in range(len(images))])
+
+        logits = ppnet.last_layer(max_activations)
+        marginless_logits = ppnet.last_layer(marginless_max_activations)
+        additional_returns = [max_activations, marginless_logits, None, marginless_max_activations]
+        if return_maps:
+            additional_returns += [activation_maps, offset_maps]
+        return logits, additional_returns
+
+    def _stitch(self, activation_maps, offset_maps, layouts, tile_cells, index, row, col, activation_map, offset):
+        n_rows, n_cols, row_starts, col_starts = layouts[index]
+        if activation_maps[index] is None:
+            activation_maps[index] = activation_map.new_zeros(activation_map.size(0), n_rows, n_cols)
+            offset_maps[index] = offset.new_zeros(offset.size(0), n_rows, n_cols)
+        row_begin, row_end = _owned_ranges(row_starts, tile_cells)[row_starts.index(row)]
+        col_begin, col_end = _owned_ranges(col_starts, tile_cells)[col_starts.index(col)]
+        row_end, col_end = min(row_end, n_rows), min(col_end, n_cols)
+        target = (slice(None), slice(row_begin, row_end), slice(col_begin, col_end))
+        source = (slice(None), slice(row_begin - row, row_end - row), slice(col_begin - col, col_end - col))
+        activation_maps[index][target] = activation_map[source]
+        offset_maps[index][target] = offset[source]
@@ -2,12 +2,30 @@ import time
 import torch
 from tqdm import tqdm
 
+from losses import ClassSpecificCosts
+from predictions import PredictionWriter, dataset_sample_paths
+from prototype_similarity import normalize_input
+
 def _train_or_test(model, dataloader, optimizer=None, class_specific=True, use_l1_mask=True,
-                   coefs=None, log=print, subtractive_margin=True, use_ortho_loss=False, wandb_logger=None):
+                   coefs=None, log=print, subtractive_margin=True, use_ortho_loss=False, wandb_logger=None,
+                   micro_batch_size=None, accumulation_steps=1, prediction_writer=None, push_scheduler=None,
+                   importance_sampler=None):
     '''
     model: the multi-gpu model
     dataloader:
     optimizer: if None, will be test evaluation
+    micro_batch_size: if set, every batch from the dataloader is split into chunks of
+        at most this many images that are forwarded/backwarded one at a time. BatchNorm
+        statistics are computed per micro-batch, so this (like accumulation_steps) is
+        not exactly equivalent to one large batch for backbones with BatchNorm
+    accumulation_steps: number of dataloader batches whose gradients are accumulated
+        before each optimizer step (effective batch = batch_size * accumulation_steps)
+    prediction_writer: if given (a predictions.PredictionWriter), per-sample records
+        are streamed to it batch by batch
+    push_scheduler: if given (a push_schedule.PushScheduler), it is fed the per-prototype
+        best similarities of every batch
+    importance_sampler: the dataloader's data.LossAwareSampler, if any; per-sample losses
+        are weighted with its importance weights and fed back to it
     '''
     is_train = optimizer is not None
     start = time.time()
@@ -25,140 +43,174 @@ def _train_or_test(model, dataloader, optimizer=None, class_specific=True, use_l
 
     all_labels, all_predictions = [], []
 
+    # inputs follow the model, so the loop also runs on the CPU
+    device = next(model.parameters()).device
 
     if use_l1_mask:
-        l1_mask = 1 - torch.t(model.module.prototype_class_identity).cuda()
+        l1_mask = 1 - torch.t(model.module.prototype_class_identity).to(device)
         l1 = (model.module.last_layer.weight * l1_mask).norm(p=1)
     else:
         l1 = model.module.last_layer.weight.norm(p=1) 
 
+    if prediction_writer is not None:
+        sample_paths = dataset_sample_paths(dataloader)
+        if sample_paths is None:
+            log('\tsample paths unavailable (shuffled loader), writing predictions without them')
+
+    class_specific_costs = ClassSpecificCosts(model.module.prototype_class_identity).to(device)
+
+    if is_train:
+        optimizer.zero_grad()
+    # loader batches accumulated since the last optimizer step
+    n_pending_batches = 0
     for i, (image, label) in enumerate(tqdm(dataloader)):
-        input = image.cuda()
-        target = label.cuda()
-
-        # torch.enable_grad() has no effect outside of no_grad()
-        grad_req = torch.enable_grad() if is_train else torch.no_grad()
-        with grad_req:
-            # nn.Module has implemented __call__() function
-            # so no need to call .forward
-            prototypes_of_correct_class = torch.t(model.module.prototype_class_identity[:,label]).cuda()
-            prototypes_of_wrong_class = 1 - prototypes_of_correct_class
-            if subtractive_margin:
-                output, additional_returns = model(input, is_train=is_train, 
-                                                    prototypes_of_wrong_class=prototypes_of_wrong_class)
-            else:
-                output, additional_returns = model(input, is_train=is_train, prototypes_of_wrong_class=None)
+        batch_size = image.size(0)
+        chunk_size = micro_batch_size or batch_size
+
+        for image_chunk, label_chunk in zip(torch.split(image, chunk_size), torch.split(label, chunk_size)):
+            # share of the dataloader batch covered by this micro-batch; the per-batch
+            # means (cross entropy, cluster, separation) are recombined with this weight
+            batch_fraction = image_chunk.size(0) / batch_size
+            input = image_chunk.to(device)
+            target = label_chunk.to(device)
+
+            # torch.enable_grad() has no effect outside of no_grad()
+            grad_req = torch.enable_grad() if is_train else torch.no_grad()
+            with grad_req:
+                # nn.Module has implemented __call__() function
+                # so no need to call .forward
+                prototypes_of_wrong_class = class_specific_costs.wrong_class_mask(target)
+                if subtractive_margin:
+                    output, additional_returns = model(input, is_train=is_train, 
+                                                        prototypes_of_wrong_class=prototypes_of_wrong_class)
+                else:
+                    output, additional_returns = model(input, is_train=is_train, prototypes_of_wrong_class=None)
 
-            max_activations = additional_returns[0]
-            marginless_logits = additional_returns[1]
-            conv_features = additional_returns[2]
-            
-            with torch.no_grad():
-                prototype_shape = model.module.prototype_shape
-                epsilon_val = model.module.epsilon_val
-                n_eps_channels = model.module.n_eps_channels
-
-                x = conv_features
-                epsilon_channel_x = torch.ones(x.shape[0], n_eps_channels, x.shape[2], x.shape[3]) * epsilon_val
-                epsilon_channel_x = epsilon_channel_x.cuda()
-                x = torch.cat((x, epsilon_channel_x), -3)
-                input_vector_length = model.module.input_vector_length
-                normalizing_factor = (prototype_shape[-2] * prototype_shape[-1])**0.5
+                max_activations = additional_returns[0]
+                marginless_logits = additional_returns[1]
+                conv_features = additional_returns[2]
+                if push_scheduler is not None:
+                    push_scheduler.update(additional_returns[3])
                 
-                input_length = torch.sqrt(torch.sum(torch.square(x), dim=-3))
-                input_length = input_length.view(input_length.size()[0], 1, input_length.size()[1], input_length.size()[2]) 
-                input_normalized = input_vector_length * x / input_length
-                input_normalized = input_normalized / normalizing_factor
-                offsets = model.module.conv_offset(input_normalized)
-
-            epsilon_val = model.module.epsilon_val
-            n_eps_channels = model.module.n_eps_channels
-            epsilon_channel_x = torch.ones(conv_features.shape[0], n_eps_channels, conv_features.shape[2], conv_features.shape[3]) * epsilon_val
-            epsilon_channel_x = epsilon_channel_x.cuda()
-            conv_features = torch.cat((conv_features, epsilon_channel_x), -3)
-            # compute loss
-            cross_entropy = torch.nn.functional.cross_entropy(output, target)
-
-            if class_specific:
-                # calculate cluster cost
-                correct_class_prototype_activations, _ = torch.max(max_activations * prototypes_of_correct_class, dim=1)
-                cluster_cost = torch.mean(correct_class_prototype_activations)
-
-                # calculate separation cost
-                incorrect_class_prototype_activations, _ = \
-                    torch.max(max_activations * prototypes_of_wrong_class, dim=1)
-                separation_cost = torch.mean(incorrect_class_prototype_activations)
-
-                # calculate avg cluster cost
-                avg_separation_cost = \
-                    torch.sum(max_activations * prototypes_of_wrong_class, dim=1) / torch.sum(prototypes_of_wrong_class, dim=1)
-                avg_separation_cost = torch.mean(avg_separation_cost)
-                offset_l2 = offsets.norm()
-
-            else:
-                max_activations, _ = torch.max(max_activations, dim=1)
-                cluster_cost = torch.mean(max_activations)
-                l1 = model.module.last_layer.weight.norm(p=1)
+                with torch.no_grad():
+                    prototype_shape = model.module.prototype_shape
+                    normalizing_factor = (prototype_shape[-2] * prototype_shape[-1])**0.5
+                    input_normalized = normalize_input(conv_features, model.module.epsilon_val,
+                                                       model.module.n_eps_channels,
+                                                       model.module.input_vector_length, normalizing_factor)
+                    offsets = model.module.conv_offset(input_normalized)
+
+                # compute loss
+                sample_weights = None
+                if importance_sampler is not None:
+                    # the loader returns the sampler's indices in order
+                    chunk_indices = importance_sampler.indices[n_examples:n_examples + target.size(0)]
+                    sample_weights = importance_sampler.weights(chunk_indices).to(device)
+                    sample_cross_entropy = torch.nn.functional.cross_entropy(output, target, reduction='none')
+                    cross_entropy = torch.mean(sample_cross_entropy * sample_weights)
+                    class_max, _ = class_specific_costs.class_max_and_sum(max_activations.detach())
+                    importance_sampler.update(chunk_indices, sample_cross_entropy,
+                                              class_max.gather(1, target.unsqueeze(1)).squeeze(1))
+                else:
+                    cross_entropy = torch.nn.functional.cross_entropy(output, target)
 
-            # evaluation statistics
-            _, predicted = torch.max(marginless_logits.data, 1)
-            n_examples += target.size(0)
-            n_correct += (predicted == target).sum().item()
+                if class_specific:
+                    # calculate cluster, separation and avg separation cost
+                    cluster_cost, separation_cost, avg_separation_cost = \
+                        class_specific_costs(max_activations, target, sample_weights=sample_weights)
+                    offset_l2 = offsets.norm()
 
-            n_batches += 1
-            total_cross_entropy += cross_entropy.item()
-            total_cluster_cost += cluster_cost.item()
-            total_separation_cost += separation_cost.item()
-            total_l2 += offset_l2
-            total_avg_separation_cost += avg_separation_cost.item()
-            batch_max = torch.max(torch.abs(offsets))
-            max_offset = torch.max(torch.Tensor([batch_max, max_offset]))
-
-            '''
-            Compute keypoint-wise orthogonality loss, i.e. encourage each piece
-            of a prototype to be orthogonal to the others.
-            '''
-            orthogonalities = model.module.get_prototype_orthogonalities()
-            orthogonality_loss = torch.norm(orthogonalities)
-            total_ortho_loss += orthogonality_loss.item()
-
-        # compute gradient and do SGD step
-        if is_train:
-            if class_specific:
-                if coefs is not None:
-                    total_ortho_loss += orthogonality_loss.item()
-                    loss = (coefs['crs_ent'] * cross_entropy
-                          + coefs['clst'] * cluster_cost
-                          + coefs['sep'] * separation_cost
-                          + coefs['l1'] * l1
-                          + coefs['offset_bias_l2'] * offset_l2)
-                    if use_ortho_loss:
-                        loss += coefs['orthogonality_loss'] * orthogonality_loss
                 else:
-                    loss = cross_entropy + 0.8 * cluster_cost - 0.08 * separation_cost + 1e-4 * l1
-            else:
-                if coefs is not None:
-                    loss = (coefs['crs_ent'] * cross_entropy
-                          + coefs['clst'] * cluster_cost
-                          + coefs['l1'] * l1)
+                    max_activations, _ = torch.max(max_activations, dim=1)
+                    cluster_cost = torch.mean(max_activations)
+                    l1 = model.module.last_layer.weight.norm(p=1)
+
+                # evaluation statistics
+                _, predicted = torch.max(marginless_logits.data, 1)
+                if prediction_writer is not None:
+                    batch_paths = sample_paths[n_examples:n_examples + target.size(0)] if sample_paths is not None \
+                        else [None] * target.size(0)
+                    prediction_writer.write_batch(batch_paths, target, marginless_logits, additional_returns[3])
+                n_examples += target.size(0)
+                n_correct += (predicted == target).sum().item()
+
+                total_cross_entropy += cross_entropy.item() * batch_fraction
+                total_cluster_cost += cluster_cost.item() * batch_fraction
+                total_separation_cost += separation_cost.item() * batch_fraction
+                total_l2 += offset_l2 * batch_fraction ** 0.5
+                total_avg_separation_cost += avg_separation_cost.item() * batch_fraction
+                batch_max = torch.max(torch.abs(offsets))
+                max_offset = torch.max(torch.Tensor([batch_max, max_offset]))
+
+                '''
+                Compute keypoint-wise orthogonality loss, i.e. encourage each piece
+                of a prototype to be orthogonal to the others.
+                '''
+                orthogonalities = model.module.get_prototype_orthogonalities()
+                orthogonality_loss = torch.norm(orthogonalities)
+                total_ortho_loss += orthogonality_loss.item() * batch_fraction
+
+            # compute gradient and accumulate it for the next SGD step
+            if is_train:
+                '''
+                Weight each term so that the gradients summed over the micro-batches of an
+                accumulation window equal those of one step on the whole window: the batch
+                means scale with batch_fraction and the batch-independent l1 and orthogonality
+                terms are split by batch_fraction. The offset norm is computed under no_grad,
+                as in the original training loop, so it contributes no gradient; it only
+                enters the loss value, where sqrt(batch_fraction) roughly rescales it.
+                '''
+                if class_specific:
+                    if coefs is not None:
+                        loss = (coefs['crs_ent'] * cross_entropy
+                              + coefs['clst'] * cluster_cost
+                              + coefs['sep'] * separation_cost
+                              + coefs['l1'] * l1) * batch_fraction \
+                              + coefs['offset_bias_l2'] * offset_l2 * batch_fraction ** 0.5
+                        if use_ortho_loss:
+                            loss += coefs['orthogonality_loss'] * orthogonality_loss * batch_fraction
+                    else:
+                        loss = (cross_entropy + 0.8 * cluster_cost - 0.08 * separation_cost + 1e-4 * l1) * batch_fraction
                 else:
-                    loss = cross_entropy + 0.8 * cluster_cost + 1e-4 * l1
-            optimizer.zero_grad()
-            
-            loss.backward(retain_graph=True)
-            optimizer.step()
-
-        all_labels.extend(target.cpu().numpy())
-        all_predictions.extend(predicted.cpu().numpy())
-
-        del input, batch_max, target, output, predicted, max_activations
-        del offsets, conv_features, prototypes_of_correct_class, prototypes_of_wrong_class
-        del epsilon_channel_x, input_normalized, input_vector_length, x, additional_returns
-        del marginless_logits, offset_l2, cross_entropy, cluster_cost, separation_cost
-        del orthogonalities, orthogonality_loss, correct_class_prototype_activations
-        del incorrect_class_prototype_activations, avg_separation_cost, input_length
+                    if coefs is not None:
+                        loss = (coefs['crs_ent'] * cross_entropy
+                              + coefs['clst'] * cluster_cost
+                              + coefs['l1'] * l1) * batch_fraction
+                    else:
+                        loss = (cross_entropy + 0.8 * cluster_cost + 1e-4 * l1) * batch_fraction
+                # a window shorter than accumulation_steps is rescaled when it is flushed
+                loss = loss / accumulation_steps
+                
+                loss.backward(retain_graph=True)
+
+            all_labels.extend(target.cpu().numpy())
+            all_predictions.extend(predicted.cpu().numpy())
+
+            del input, batch_max, target, output, predicted, max_activations
+            del offsets, conv_features, prototypes_of_wrong_class
+            del input_normalized, additional_returns
+            del marginless_logits, offset_l2, cross_entropy, cluster_cost, separation_cost, sample_weights
+            del orthogonalities, orthogonality_loss, avg_separation_cost
+            if is_train:
+                del loss
+
+        n_batches += 1
         if is_train:
-            del loss
+            n_pending_batches += 1
+            if n_pending_batches == accumulation_steps:
+                optimizer.step()
+                optimizer.zero_grad()
+                n_pending_batches = 0
+
+    # flush the last, shorter window; counted at loop exit rather than from len(dataloader),
+    # which streamed datasets only estimate
+    if is_train and n_pending_batches:
+        for group in optimizer.param_groups:
+            for p in group['params']:
+                if p.grad is not None:
+                    p.grad.mul_(accumulation_steps / n_pending_batches)
+        optimizer.step()
+        optimizer.zero_grad()
 
     end = time.time()
     log('\ttime: \t{0}'.format(end -  start))
@@ -191,22 +243,157 @@ def _train_or_test(model, dataloader, optimizer=None, class_specific=True, use_l
     return n_correct / n_examples
 
 
+def _evaluate(model, dataloader, class_specific=True, log=print, subtractive_margin=True, wandb_logger=None,
+              prediction_writer=None, diagnostics_every=None, tiler=None):
+    '''
+    Inference-only evaluation: a single forward per batch under torch.inference_mode,
+    keeping only what accuracy and cross entropy need; statistics stay on the device
+    until the end of the pass.
+    diagnostics_every: if set, cluster/separation costs and the offset l2 are also
+        computed on every diagnostics_every-th batch (the orthogonality loss does not
+        depend on the data and is computed once)
+    tiler: if given (a tiling.Tiler), the dataloader yields lists of full-resolution
+        images (tiling.collate_images) that are evaluated tile by tile; the offset l2
+        is then not computed
+    '''
+    start = time.time()
+    n_examples = 0
+    n_batches = 0
+    n_diagnostic_batches = 0
+    n_offset_batches = 0
+    total_cluster_cost = 0
+    total_separation_cost = 0
+    total_avg_separation_cost = 0
+    total_l2 = 0
+
+    all_labels, all_predictions = [], []
+
+    if prediction_writer is not None:
+        sample_paths = dataset_sample_paths(dataloader)
+        if sample_paths is None:
+            log('\tsample paths unavailable (shuffled loader), writing predictions without them')
+
+    device = next(model.parameters()).device
+    class_specific_costs = ClassSpecificCosts(model.module.prototype_class_identity).to(device)
+
+    with torch.inference_mode():
+        n_correct = torch.zeros((), dtype=torch.long, device=device)
+        total_cross_entropy = torch.zeros((), device=device)
+        for i, (image, label) in enumerate(tqdm(dataloader)):
+            target = label.to(device, non_blocking=True)
+
+            prototypes_of_wrong_class = class_specific_costs.wrong_class_mask(target) if subtractive_margin else None
+            if tiler is not None:
+                input = [img.to(device, non_blocking=True) for img in image]
+                output, additional_returns = tiler(model.module, input,
+                                                   prototypes_of_wrong_class=prototypes_of_wrong_class)
+            else:
+                input = image.to(device, non_blocking=True)
+                output, additional_returns = model(input, is_train=False,
+                                                   prototypes_of_wrong_class=prototypes_of_wrong_class)
+            marginless_logits = additional_returns[1]
+
+            predicted = torch.argmax(marginless_logits, dim=1)
+            n_correct += (predicted == target).sum()
+            total_cross_entropy += torch.nn.functional.cross_entropy(output, target)
+
+            if diagnostics_every and class_specific and i % diagnostics_every == 0:
+                cluster_cost, separation_cost, avg_separation_cost = \
+                    class_specific_costs(additional_returns[0], target)
+                if additional_returns[2] is not None:
+                    prototype_shape = model.module.prototype_shape
+                    normalizing_factor = (prototype_shape[-2] * prototype_shape[-1])**0.5
+                    input_normalized = normalize_input(additional_returns[2], model.module.epsilon_val,
+                                                       model.module.n_eps_channels,
+                                                       model.module.input_vector_length, normalizing_factor)
+                    total_l2 += model.module.conv_offset(input_normalized).norm().item()
+                    n_offset_batches += 1
+                total_cluster_cost += cluster_cost.item()
+                total_separation_cost += separation_cost.item()
+                total_avg_separation_cost += avg_separation_cost.item()
+                n_diagnostic_batches += 1
+
+            if prediction_writer is not None:
+                batch_paths = sample_paths[n_examples:n_examples + target.size(0)] if sample_paths is not None \
+                    else [None] * target.size(0)
+                prediction_writer.write_batch(batch_paths, target, marginless_logits, additional_returns[3])
+
+            n_examples += target.size(0)
+            n_batches += 1
+            all_labels.append(target)
+            all_predictions.append(predicted)
+
+    n_correct = n_correct.item()
+    end = time.time()
+    log('\ttime: \t{0}'.format(end -  start))
+    log('\tcross ent: \t{0}'.format(total_cross_entropy.item() / n_batches))
+    if n_diagnostic_batches:
+        log('\tdiagnostics on {0} of {1} batches'.format(n_diagnostic_batches, n_batches))
+        log('\tcluster: \t{0}'.format(total_cluster_cost / n_diagnostic_batches))
+        log('\tseparation:\t{0}'.format(total_separation_cost / n_diagnostic_batches))
+        log('\tavg separation:\t{0}'.format(total_avg_separation_cost / n_diagnostic_batches))
+        if n_offset_batches:
+            log('\tavg l2: \t\t{0}'.format(total_l2 / n_offset_batches))
+        with torch.no_grad():
+            log('\torthogonality loss:\t{0}'.format(torch.norm(model.module.get_prototype_orthogonalities()).item()))
+    log('\taccu: \t\t{0}%'.format(n_correct / n_examples * 100))
+    log('\tl1: \t\t{0}'.format(model.module.last_layer.weight.norm(p=1).item()))
+
+    if wandb_logger:
+        wandb_log = {"accuracy": n_correct/n_examples, "cross_entropy": total_cross_entropy.item() / n_batches}
+        wandb_logger.log({'val_' + k: v for k, v in wandb_log.items()})
+        wandb_logger.log_confusion_matrix(torch.cat(all_labels).cpu().numpy(), torch.cat(all_predictions).cpu().numpy())
+
+    return n_correct / n_examples
+
+
 def train(model, dataloader, optimizer, class_specific=False, coefs=None, 
-            log=print, subtractive_margin=True, use_ortho_loss=False, wandb_logger=None):
+            log=print, subtractive_margin=True, use_ortho_loss=False, wandb_logger=None,
+            micro_batch_size=None, accumulation_steps=1, push_scheduler=None, importance_sampler=None):
     assert(optimizer is not None)
+    assert(accumulation_steps >= 1)
     
     log('\ttrain')
+    if micro_batch_size is not None or accumulation_steps > 1:
+        log('\tmicro batch size: {0}, accumulation steps: {1}'.format(micro_batch_size, accumulation_steps))
+    if importance_sampler is not None:
+        log('\timportance sampling: {0}'.format(importance_sampler.describe()))
     model.train()
     return _train_or_test(model=model, dataloader=dataloader, optimizer=optimizer,
                           class_specific=class_specific, coefs=coefs, log=log, 
-                          subtractive_margin=subtractive_margin, use_ortho_loss=use_ortho_loss, wandb_logger=wandb_logger)
+                          subtractive_margin=subtractive_margin, use_ortho_loss=use_ortho_loss, wandb_logger=wandb_logger,
+                          micro_batch_size=micro_batch_size, accumulation_steps=accumulation_steps,
+                          push_scheduler=push_scheduler, importance_sampler=importance_sampler)
 
 
-def test(model, dataloader, class_specific=False, log=print, subtractive_margin=True, wandb_logger=None):
+def test(model, dataloader, class_specific=False, log=print, subtractive_margin=True, wandb_logger=None,
+         predictions_path=None, predictions_topk=5, lean=False, diagnostics_every=None, tiler=None):
+    '''
+    predictions_path: if given, per-sample predictions are streamed there
+        (.parquet file, or a directory of memory-mapped .npy columns)
+    lean: evaluate with the inference-only _evaluate instead of _train_or_test,
+        with loss diagnostics on every diagnostics_every-th batch only
+    tiler: evaluate full-resolution images tile by tile (a tiling.Tiler; implies lean)
+    '''
     log('\ttest')
     model.eval()
-    return _train_or_test(model=model, dataloader=dataloader, optimizer=None,
-                          class_specific=class_specific, log=log, subtractive_margin=subtractive_margin, wandb_logger=wandb_logger)
+    prediction_writer = None
+    if predictions_path is not None:
+        prediction_writer = PredictionWriter(predictions_path, num_samples=len(dataloader.dataset),
+                                             num_classes=model.module.num_classes, topk=predictions_topk)
+    try:
+        if lean or tiler is not None:
+            return _evaluate(model=model, dataloader=dataloader, class_specific=class_specific, log=log,
+                             subtractive_margin=subtractive_margin, wandb_logger=wandb_logger,
+                             prediction_writer=prediction_writer, diagnostics_every=diagnostics_every,
+                             tiler=tiler)
+        return _train_or_test(model=model, dataloader=dataloader, optimizer=None,
+                              class_specific=class_specific, log=log, subtractive_margin=subtractive_margin, wandb_logger=wandb_logger,
+                              prediction_writer=prediction_writer)
+    finally:
+        if prediction_writer is not None:
+            n_written = prediction_writer.close()
+            log('\twrote {0} predictions to {1}'.format(n_written, predictions_path))
 
 
 def last_only(model, log=print, last_layer_fixed=True):